@@ -3,13 +3,14 @@ from datasets import load_dataset
 
 def check_dataset_structure():
     print("Loading dataset...")
-    dataset = load_dataset("evalplus/mbppplus")
+    # スキーマの確認には先頭の1件だけで十分なので、ストリーミングで読み込む
+    dataset = load_dataset("evalplus/mbppplus", split="test", streaming=True)
 
     print("\nDataset structure:")
     print(dataset)
 
     print("\nFirst example details:")
-    first_example = dataset["test"][0]
+    first_example = next(iter(dataset))
     for key, value in first_example.items():
         print(f"\n{key}:")
         if isinstance(value, list):
@@ -0,0 +1,95 @@
+import json
+from typing import List, Optional, Tuple
+from .connection import code_content_hash
+from .context import db_context
+
+
+def store_code_batch(
+    entries: List[
+        Tuple[
+            str, Optional[list], List[Tuple[str, str]], Optional[bytes], Optional[bytes]
+        ]
+    ]
+) -> List[Optional[int]]:
+    """コード・埋め込みベクトル・テストケースをまとめて1トランザクションで保存します。
+
+    ストリーミング取り込みで一定件数ごとに呼び出されることを想定しています。
+    既存のコードは再利用し、同じテストケースは重複して挿入しません。
+    近似重複のコードは埋め込みベクトルを持たず、代表コードの埋め込みを共有します
+    （検索では代表コードの候補にテストケースがまとめられます）。代表コードが保存されて
+    いない近似重複は、検索で到達できなくなるため保存しません。
+    コードの同一性は本文ではなく code_content_hash で判定します。
+
+    Args:
+        entries: (コード, 埋め込みベクトル, [(入力, 期待される出力)], MinHash署名,
+            代表コードのハッシュ) のタプルのリスト。近似重複でない場合、代表コードのハッシュはNone
+
+    Returns:
+        List[Optional[int]]: 各エントリに対応するコードID。保存しなかったエントリはNone、
+        失敗した場合は全てNone
+    """
+    try:
+        with db_context() as (_, cursor):
+            code_ids = []
+            for code, embedding, test_cases, signature, canonical_hash in entries:
+                canonical_id = None
+                if canonical_hash is not None:
+                    cursor.execute(
+                        "SELECT id FROM codes "
+                        "WHERE code_hash = ? AND embedding IS NOT NULL",
+                        (canonical_hash,),
+                    )
+                    canonical = cursor.fetchone()
+                    if canonical:
+                        canonical_id = canonical[0]
+                    elif embedding is None:
+                        print("Canonical code not found; skipping near-duplicate")
+                        code_ids.append(None)
+                        continue
+
+                embedding_json = (
+                    json.dumps(embedding) if embedding is not None else None
+                )
+                code_hash = code_content_hash(code)
+                cursor.execute("SELECT id FROM codes WHERE code_hash = ?", (code_hash,))
+                existing_code = cursor.fetchone()
+                if existing_code:
+                    code_id = existing_code[0]
+                    if embedding_json is not None:
+                        cursor.execute(
+                            "UPDATE codes SET embedding = ? WHERE id = ?",
+                            (embedding_json, code_id),
+                        )
+                else:
+                    cursor.execute(
+                        "INSERT INTO codes (code, embedding, code_hash) VALUES (?, ?, ?)",
+                        (code, embedding_json, code_hash),
+                    )
+                    code_id = cursor.lastrowid
+
+                if signature is not None:
+                    cursor.execute(
+                        "INSERT OR REPLACE INTO code_minhash "
+                        "(code_id, signature, canonical_id) VALUES (?, ?, ?)",
+                        (code_id, signature, canonical_id or code_id),
+                    )
+
+                cursor.executemany(
+                    """
+                    INSERT INTO test_cases (code_id, input, expected_output)
+                    SELECT ?, ?, ?
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM test_cases
+                        WHERE code_id = ? AND input = ? AND expected_output = ?
+                    )
+                    """,
+                    (
+                        (code_id, input_val, expected, code_id, input_val, expected)
+                        for input_val, expected in test_cases
+                    ),
+                )
+                code_ids.append(code_id)
+            return code_ids
+    except Exception as e:
+        print(f"Error storing code batch: {e}")
+        return [None] * len(entries)
@@ -1,5 +1,6 @@
 import json
 from typing import List, Optional, Tuple
+from .connection import code_content_hash
 from .context import db_context
 
 
@@ -7,8 +8,9 @@ def insert_code(code: str) -> Optional[int]:
     """コードをデータベースに挿入します。"""
     try:
         with db_context() as (_, cursor):
-            # 既存のコードをチェック
-            cursor.execute("SELECT id FROM codes WHERE code = ?", (code,))
+            # 既存のコードをチェック（本文ではなく固定長のハッシュで比較する）
+            code_hash = code_content_hash(code)
+            cursor.execute("SELECT id FROM codes WHERE code_hash = ?", (code_hash,))
             existing_code = cursor.fetchone()
             if existing_code:
                 print(f"Code already exists with ID: {existing_code[0]}")
@@ -17,10 +19,10 @@ def insert_code(code: str) -> Optional[int]:
             # 新しいコードを挿入
             cursor.execute(
                 """
-                INSERT INTO codes (code, embedding)
-                VALUES (?, ?)
+                INSERT INTO codes (code, embedding, code_hash)
+                VALUES (?, ?, ?)
             """,
-                (code, None),
+                (code, None, code_hash),
             )
             return cursor.lastrowid
     except Exception as e:
@@ -72,3 +74,248 @@ def get_code_by_id(code_id: int) -> Optional[str]:
     except Exception as e:
         print(f"Error getting code by ID: {e}")
         return None
+
+
+def get_code_hash_by_id(code_id: int) -> Optional[bytes]:
+    """指定されたIDのコードのハッシュ（code_content_hash）を取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute("SELECT code_hash FROM codes WHERE id = ?", (code_id,))
+            result = cursor.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        print(f"Error getting code hash by ID: {e}")
+        return None
+
+
+def get_embeddings_by_ids(code_ids: List[int]) -> List[Tuple[int, list]]:
+    """指定されたIDのコード埋め込みベクトルを取得します。"""
+    if not code_ids:
+        return []
+    try:
+        with db_context() as (_, cursor):
+            placeholders = ",".join("?" * len(code_ids))
+            cursor.execute(
+                f"SELECT id, embedding FROM codes "
+                f"WHERE embedding IS NOT NULL AND id IN ({placeholders})",
+                list(code_ids),
+            )
+            return [
+                (code_id, json.loads(embedding_json))
+                for code_id, embedding_json in cursor
+            ]
+    except Exception as e:
+        print(f"Error getting embeddings by IDs: {e}")
+        return []
+
+
+def get_unquantized_embeddings(
+    after_id: int = 0, limit: int = 500
+) -> List[Tuple[int, list]]:
+    """量子化表現がまだ保存されていないコード埋め込みベクトルをID順に取得します。
+
+    Args:
+        after_id: このIDより大きいコードのみを対象にする（ページングに使用）
+        limit: 取得する最大件数
+
+    Returns:
+        List[Tuple[int, list]]: (コードID, 埋め込みベクトル)のタプルのリスト
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                SELECT c.id, c.embedding FROM codes c
+                LEFT JOIN embedding_int8 q ON q.code_id = c.id
+                WHERE c.embedding IS NOT NULL AND q.code_id IS NULL AND c.id > ?
+                ORDER BY c.id
+                LIMIT ?
+                """,
+                (after_id, limit),
+            )
+            code_embeddings = []
+            for code_id, embedding_json in cursor:
+                try:
+                    code_embeddings.append((code_id, json.loads(embedding_json)))
+                except json.JSONDecodeError as e:
+                    print(f"Error decoding embedding for code ID {code_id}: {e}")
+            return code_embeddings
+    except Exception as e:
+        print(f"Error getting unquantized embeddings: {e}")
+        return []
+
+
+def save_quantized_embeddings(rows: List[Tuple[int, float, bytes]]) -> bool:
+    """埋め込みベクトルの量子化表現を保存します。
+
+    Args:
+        rows: (コードID, スケール, int8ベクトルのバイト列) のタプルのリスト
+
+    Returns:
+        bool: 保存に成功した場合はTrue
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.executemany(
+                "INSERT OR REPLACE INTO embedding_int8 (code_id, scale, vector) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving quantized embeddings: {e}")
+        return False
+
+
+def get_quantized_embeddings() -> List[Tuple[int, float, bytes]]:
+    """全ての埋め込みベクトルの量子化表現を取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT code_id, scale, vector FROM embedding_int8 ORDER BY code_id"
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting quantized embeddings: {e}")
+        return []
+
+
+def get_corpus_version() -> Optional[int]:
+    """コーパスの版数を取得します。codes や埋め込みの前処理の形式が変更されるたびに増加します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute("SELECT version FROM corpus_meta WHERE id = 1")
+            result = cursor.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        print(f"Error getting corpus version: {e}")
+        return None
+
+
+def get_embedding_input_format() -> Optional[str]:
+    """コーパスの埋め込みを作ったときの入力の前処理の形式を取得します。未記録の場合はNone。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute("SELECT embedding_input FROM corpus_meta WHERE id = 1")
+            result = cursor.fetchone()
+            return result[0] if result else None
+    except Exception as e:
+        print(f"Error getting embedding input format: {e}")
+        return None
+
+
+def set_embedding_input_format(input_format: str) -> bool:
+    """コーパスの埋め込みを作ったときの入力の前処理の形式を記録します。
+
+    記録済みの形式から変わる場合は、検索側が形式を読み込み直し、古い形式で作った
+    検索結果のキャッシュを使わないよう、コーパスの版数も加算します。
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                UPDATE corpus_meta SET
+                    version = version
+                        + (embedding_input IS NOT NULL AND embedding_input <> ?),
+                    embedding_input = ?
+                WHERE id = 1
+                """,
+                (input_format, input_format),
+            )
+            return True
+    except Exception as e:
+        print(f"Error setting embedding input format: {e}")
+        return False
+
+
+def has_embeddings() -> bool:
+    """埋め込み済みのコードが1件でもあるかどうかを返します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute("SELECT 1 FROM codes WHERE embedding IS NOT NULL LIMIT 1")
+            return cursor.fetchone() is not None
+    except Exception as e:
+        print(f"Error checking embeddings: {e}")
+        return False
+
+
+def get_codes_page(
+    after_id: int = 0, limit: int = 500, embedded_only: bool = False
+) -> List[Tuple[int, str]]:
+    """コードをID順に limit 件ずつ取得します。
+
+    Args:
+        after_id: このIDより後のコードを取得する
+        limit: 取得する件数
+        embedded_only: 埋め込み済みのコードだけを取得するかどうか
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT id, code FROM codes WHERE id > ? "
+                + ("AND embedding IS NOT NULL " if embedded_only else "")
+                + "ORDER BY id LIMIT ?",
+                (after_id, limit),
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting codes: {e}")
+        return []
+
+
+def save_minhash_signatures(rows: List[Tuple[int, bytes, Optional[int]]]) -> bool:
+    """コードのMinHash署名を保存します。
+
+    Args:
+        rows: (コードID, 署名のバイト列, 代表コードのID) のタプルのリスト
+
+    Returns:
+        bool: 保存に成功した場合はTrue
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.executemany(
+                "INSERT OR REPLACE INTO code_minhash (code_id, signature, canonical_id) "
+                "VALUES (?, ?, ?)",
+                rows,
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving minhash signatures: {e}")
+        return False
+
+
+def get_minhash_signatures() -> List[Tuple[int, bytes]]:
+    """代表コード（他のコードの近似重複でないコード）のMinHash署名を取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT code_id, signature FROM code_minhash "
+                "WHERE canonical_id IS NULL OR canonical_id = code_id"
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting minhash signatures: {e}")
+        return []
+
+
+def get_codes_without_minhash(
+    after_id: int = 0, limit: int = 500
+) -> List[Tuple[int, str]]:
+    """MinHash署名がまだ保存されていない埋め込み済みのコードをID順に取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                SELECT c.id, c.code FROM codes c
+                LEFT JOIN code_minhash m ON m.code_id = c.id
+                WHERE c.embedding IS NOT NULL AND m.code_id IS NULL AND c.id > ?
+                ORDER BY c.id
+                LIMIT ?
+                """,
+                (after_id, limit),
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting codes without minhash: {e}")
+        return []
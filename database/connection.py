@@ -1,26 +1,67 @@
+import hashlib
 import sqlite3
 
 DATABASE_NAME = "code_comparison.db"
 
+# code_hash はコード本文のSHA-256（32バイト）で、重複の判定に使う。
+# 本文の UNIQUE 制約は本文をまるごとインデックスに複製するため付けない
+_CODES_TABLE = """
+    CREATE TABLE IF NOT EXISTS {name} (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        code TEXT NOT NULL,
+        embedding TEXT,
+        code_hash BLOB NOT NULL
+    )
+"""
+
+
+# code_signatures のテスト入力の引数の数の範囲を test_cases から計算し直す文
+_TEST_ARG_RANGE_UPDATE = """
+    UPDATE code_signatures SET
+        test_min_args = (
+            SELECT MIN(arg_count) FROM test_cases
+            WHERE test_cases.code_id = code_signatures.code_id
+        ),
+        test_max_args = (
+            SELECT MAX(arg_count) FROM test_cases
+            WHERE test_cases.code_id = code_signatures.code_id
+        )
+"""
+
+
+def code_content_hash(code: str) -> bytes:
+    """コード本文を識別する固定長（32バイト）のハッシュを返します。"""
+    return hashlib.sha256(code.encode("utf-8")).digest()
 
-def get_connection():
-    """データベース接続を取得します。"""
-    return sqlite3.connect(DATABASE_NAME)
 
+def get_connection(database: str = None):
+    """データベース接続を取得します。
 
-def create_database():
-    """データベースとテーブルを初期化します。"""
-    conn = get_connection()
+    Args:
+        database: 接続するデータベースファイル（省略時は DATABASE_NAME）
+    """
+    return sqlite3.connect(database or DATABASE_NAME)
+
+
+def create_database(database: str = None):
+    """データベースとテーブルを初期化します。
+
+    Args:
+        database: 初期化するデータベースファイル（省略時は DATABASE_NAME）
+    """
+    conn = get_connection(database)
     cursor = conn.cursor()
 
+    # コーパスの読み込みを別スレッドで進めている間も書き込みを待たせないよう、
+    # 読み込みが書き込みをブロックしないWALモードにする（ファイルに保存される設定）
+    cursor.execute("PRAGMA journal_mode=WAL")
+
+    cursor.execute(_CODES_TABLE.format(name="codes"))
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(codes)")]
+    if "code_hash" not in columns:
+        _migrate_codes_to_hash(conn)
     cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS codes (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            code TEXT NOT NULL UNIQUE,
-            embedding TEXT
-        )
-    """
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_codes_code_hash ON codes (code_hash)"
     )
 
     cursor.execute(
@@ -35,5 +76,253 @@ def create_database():
     """
     )
 
+    # 埋め込みベクトルのint8量子化表現（検索の1段目で使用）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embedding_int8 (
+            code_id INTEGER PRIMARY KEY,
+            scale REAL NOT NULL,
+            vector BLOB NOT NULL,
+            FOREIGN KEY (code_id) REFERENCES codes(id)
+        )
+    """
+    )
+
+    # 近似重複検出のためのMinHash署名。canonical_id は埋め込みを共有する代表コードのID
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS code_minhash (
+            code_id INTEGER PRIMARY KEY,
+            signature BLOB NOT NULL,
+            canonical_id INTEGER,
+            FOREIGN KEY (code_id) REFERENCES codes(id),
+            FOREIGN KEY (canonical_id) REFERENCES codes(id)
+        )
+    """
+    )
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_code_minhash_canonical "
+        "ON code_minhash (canonical_id)"
+    )
+
+    # 類似コード検索の結果のキャッシュ。corpus_state が現在のコーパスと異なる行は使わない
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS query_result_cache (
+            query_hash TEXT PRIMARY KEY,
+            corpus_state TEXT NOT NULL,
+            candidates TEXT NOT NULL,
+            last_used REAL NOT NULL
+        )
+    """
+    )
+
+    # 生成コードと引数の数が合わない候補を検索前に除外するための関数シグネチャ。
+    # max_args が NULL の場合は可変長引数。関数を特定できないコードは min_args が NULL。
+    # test_min_args, test_max_args はそのコードのテスト入力の引数の数の範囲で、
+    # 下のトリガーで test_cases と同期する（テストケースのないコードは NULL）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS code_signatures (
+            code_id INTEGER PRIMARY KEY,
+            function_name TEXT,
+            min_args INTEGER,
+            max_args INTEGER,
+            defaults INTEGER,
+            test_min_args INTEGER,
+            test_max_args INTEGER,
+            FOREIGN KEY (code_id) REFERENCES codes(id)
+        )
+    """
+    )
+    # テスト入力を展開したときの引数の数（既存のデータベースには列を追加する）
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(test_cases)")]
+    if "arg_count" not in columns:
+        cursor.execute("ALTER TABLE test_cases ADD COLUMN arg_count INTEGER")
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_test_cases_code_arg_count "
+        "ON test_cases (code_id, arg_count)"
+    )
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(code_signatures)")]
+    if "test_min_args" not in columns:
+        cursor.execute("ALTER TABLE code_signatures ADD COLUMN test_min_args INTEGER")
+        cursor.execute("ALTER TABLE code_signatures ADD COLUMN test_max_args INTEGER")
+        cursor.execute(_TEST_ARG_RANGE_UPDATE)
+    cursor.execute(
+        "CREATE INDEX IF NOT EXISTS idx_code_signatures_test_args "
+        "ON code_signatures (test_min_args, test_max_args)"
+    )
+
+    # テスト実行結果のキャッシュ（コードのハッシュ・テストケースのハッシュ・インタプリタで識別）
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS test_result_cache (
+            code_hash TEXT NOT NULL,
+            test_case_hash TEXT NOT NULL,
+            python_version TEXT NOT NULL,
+            success INTEGER NOT NULL,
+            actual_output TEXT NOT NULL,
+            PRIMARY KEY (code_hash, test_case_hash, python_version)
+        )
+    """
+    )
+
+    # 埋め込みベクトルが更新・削除されたら古い量子化表現を破棄する
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS embedding_int8_on_update
+        AFTER UPDATE OF embedding ON codes
+        BEGIN
+            DELETE FROM embedding_int8 WHERE code_id = NEW.id;
+        END
+    """
+    )
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS embedding_int8_on_delete
+        AFTER DELETE ON codes
+        BEGIN
+            DELETE FROM embedding_int8 WHERE code_id = OLD.id;
+            DELETE FROM code_minhash WHERE code_id = OLD.id;
+        END
+    """
+    )
+
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS code_signatures_on_delete
+        AFTER DELETE ON codes
+        BEGIN
+            DELETE FROM code_signatures WHERE code_id = OLD.id;
+        END
+    """
+    )
+    # テスト入力の引数の数の範囲を、テストケースやシグネチャの追加・変更に合わせて更新する
+    for name, event, code_ids in (
+        ("test_arg_range_on_insert", "INSERT ON test_cases", "NEW.code_id"),
+        (
+            "test_arg_range_on_update",
+            "UPDATE OF code_id, arg_count ON test_cases",
+            "OLD.code_id, NEW.code_id",
+        ),
+        ("test_arg_range_on_delete", "DELETE ON test_cases", "OLD.code_id"),
+        ("test_arg_range_on_signature", "INSERT ON code_signatures", "NEW.code_id"),
+    ):
+        cursor.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {name}
+            AFTER {event}
+            BEGIN
+                {_TEST_ARG_RANGE_UPDATE} WHERE code_id IN ({code_ids});
+            END
+        """
+        )
+    # テスト入力が書き換えられたら引数の数を数え直させる
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS test_arg_count_on_update
+        AFTER UPDATE OF input ON test_cases
+        BEGIN
+            UPDATE test_cases SET arg_count = NULL WHERE id = NEW.id;
+        END
+    """
+    )
+    # コードが書き換えられたら古いシグネチャを破棄する
+    cursor.execute(
+        """
+        CREATE TRIGGER IF NOT EXISTS code_signatures_on_update
+        AFTER UPDATE OF code ON codes
+        BEGIN
+            DELETE FROM code_signatures WHERE code_id = NEW.id;
+        END
+    """
+    )
+
+    # コーパスの版数。codes が変更されるたびにトリガーで加算する
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS corpus_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+    """
+    )
+    cursor.execute("INSERT OR IGNORE INTO corpus_meta (id, version) VALUES (1, 0)")
+    # 埋め込みを作ったときの入力の前処理の形式（embedding/preprocess.py）
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(corpus_meta)")]
+    if "embedding_input" not in columns:
+        cursor.execute("ALTER TABLE corpus_meta ADD COLUMN embedding_input TEXT")
+    for name, event in (
+        ("corpus_version_on_insert", "INSERT"),
+        ("corpus_version_on_update", "UPDATE OF code, embedding"),
+        ("corpus_version_on_delete", "DELETE"),
+    ):
+        cursor.execute(
+            f"""
+            CREATE TRIGGER IF NOT EXISTS {name}
+            AFTER {event} ON codes
+            BEGIN
+                UPDATE corpus_meta SET version = version + 1 WHERE id = 1;
+            END
+        """
+        )
+    # 候補のテストケースや絞り込みの結果を変えるテーブルの版数。検索インデックスは
+    # codes だけに依存するため version とは分け、検索結果のキャッシュの判定に使う
+    columns = [row[1] for row in cursor.execute("PRAGMA table_info(corpus_meta)")]
+    if "candidates_version" not in columns:
+        cursor.execute(
+            "ALTER TABLE corpus_meta "
+            "ADD COLUMN candidates_version INTEGER NOT NULL DEFAULT 0"
+        )
+    for table in ("test_cases", "code_signatures", "code_minhash"):
+        for event in ("INSERT", "UPDATE", "DELETE"):
+            cursor.execute(
+                f"""
+                CREATE TRIGGER IF NOT EXISTS
+                    candidates_version_on_{table}_{event.lower()}
+                AFTER {event} ON {table}
+                BEGIN
+                    UPDATE corpus_meta SET candidates_version = candidates_version + 1
+                    WHERE id = 1;
+                END
+            """
+            )
+
     conn.commit()
     conn.close()
+
+
+def _migrate_codes_to_hash(conn: sqlite3.Connection) -> None:
+    """既存の codes テーブルに code_hash を埋め、本文の UNIQUE 制約を外します。
+
+    制約は ALTER TABLE で削除できないため、IDを保ったままテーブルを作り直します。
+    codes のトリガーはテーブルとともに削除され、create_database の続きで作り直されます。
+    """
+    print("Migrating codes table to content hashes...")
+    conn.create_function("code_content_hash", 1, code_content_hash, deterministic=True)
+    cursor = conn.cursor()
+    cursor.execute("BEGIN")
+    try:
+        cursor.execute("DROP TABLE IF EXISTS codes_migrating")
+        cursor.execute(_CODES_TABLE.format(name="codes_migrating"))
+        cursor.execute(
+            """
+            INSERT INTO codes_migrating (id, code, embedding, code_hash)
+            SELECT id, code, embedding, code_content_hash(code) FROM codes
+        """
+        )
+        # 削除済みのIDを再利用しないよう AUTOINCREMENT の値を引き継ぐ
+        seq = cursor.execute(
+            "SELECT seq FROM sqlite_sequence WHERE name = 'codes'"
+        ).fetchone()
+        cursor.execute("DROP TABLE codes")
+        cursor.execute("ALTER TABLE codes_migrating RENAME TO codes")
+        if seq:
+            cursor.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'codes'",
+                seq,
+            )
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
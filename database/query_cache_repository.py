@@ -0,0 +1,89 @@
+import json
+import time
+from typing import Dict, List, Optional
+from .context import db_context
+
+
+def get_corpus_state() -> Optional[str]:
+    """検索結果に影響するコーパスの状態を表す文字列を取得します。
+
+    codes の変更で増えるコーパスの版数に加え、テストケース・シグネチャ・近似重複の
+    追加・変更・削除で増える candidates_version も含めます（どちらもトリガーで加算）。
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT version, candidates_version FROM corpus_meta WHERE id = 1"
+            )
+            result = cursor.fetchone()
+            if result is None:
+                return None
+            return f"{result[0]}:{result[1]}"
+    except Exception as e:
+        print(f"Error getting corpus state: {e}")
+        return None
+
+
+def get_cached_query(query_hash: str, corpus_state: str) -> Optional[List[Dict]]:
+    """キャッシュされた検索結果を取得し、最終利用時刻を更新します。
+
+    Returns:
+        Optional[List[Dict]]: 候補のリスト。キャッシュがないか、コーパスが変わっている場合はNone
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT candidates FROM query_result_cache "
+                "WHERE query_hash = ? AND corpus_state = ?",
+                (query_hash, corpus_state),
+            )
+            result = cursor.fetchone()
+            if not result:
+                return None
+            cursor.execute(
+                "UPDATE query_result_cache SET last_used = ? WHERE query_hash = ?",
+                (time.time(), query_hash),
+            )
+            return json.loads(result[0])
+    except Exception as e:
+        print(f"Error getting cached query result: {e}")
+        return None
+
+
+def save_cached_query(
+    query_hash: str, corpus_state: str, candidates: List[Dict], max_entries: int
+) -> bool:
+    """検索結果をキャッシュに保存します。
+
+    他の状態のコーパスに対する結果は削除し、max_entries 件を超えた分は
+    最終利用時刻の古いものから削除します。
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "DELETE FROM query_result_cache WHERE corpus_state != ?",
+                (corpus_state,),
+            )
+            cursor.execute(
+                "INSERT OR REPLACE INTO query_result_cache "
+                "(query_hash, corpus_state, candidates, last_used) VALUES (?, ?, ?, ?)",
+                (
+                    query_hash,
+                    corpus_state,
+                    json.dumps(candidates, ensure_ascii=False),
+                    time.time(),
+                ),
+            )
+            cursor.execute(
+                """
+                DELETE FROM query_result_cache WHERE query_hash NOT IN (
+                    SELECT query_hash FROM query_result_cache
+                    ORDER BY last_used DESC LIMIT ?
+                )
+                """,
+                (max_entries,),
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving cached query result: {e}")
+        return False
@@ -0,0 +1,83 @@
+import hashlib
+import json
+import platform
+from typing import Optional, Tuple
+from .connection import code_content_hash
+from .context import db_context
+
+
+def result_cache_key(
+    code: str, input_val: str, expected_output: str
+) -> Tuple[str, str, str]:
+    """テスト結果キャッシュのキーを作成します。
+
+    コードが1文字でも変われば code_hash が変わるため、古い結果は参照されなくなります。
+
+    Args:
+        code: テスト対象のコード
+        input_val: テストケースの入力値
+        expected_output: テストケースの期待される出力
+
+    Returns:
+        Tuple[str, str, str]: (コードのハッシュ, テストケースのハッシュ, インタプリタのバージョン)
+    """
+    code_hash = code_content_hash(code).hex()
+    test_case_hash = hashlib.sha256(
+        json.dumps([input_val, expected_output]).encode("utf-8")
+    ).hexdigest()
+    python_version = f"{platform.python_implementation()} {platform.python_version()}"
+    return code_hash, test_case_hash, python_version
+
+
+def get_cached_result(
+    code_hash: str, test_case_hash: str, python_version: str
+) -> Optional[Tuple[bool, str]]:
+    """キャッシュされたテスト結果を取得します。
+
+    Returns:
+        Optional[Tuple[bool, str]]: (成功したかどうか, 実際の出力)。キャッシュがない場合はNone
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                SELECT success, actual_output FROM test_result_cache
+                WHERE code_hash = ? AND test_case_hash = ? AND python_version = ?
+                """,
+                (code_hash, test_case_hash, python_version),
+            )
+            result = cursor.fetchone()
+            return (bool(result[0]), result[1]) if result else None
+    except Exception as e:
+        print(f"Error getting cached test result: {e}")
+        return None
+
+
+def save_cached_result(
+    code_hash: str,
+    test_case_hash: str,
+    python_version: str,
+    success: bool,
+    actual_output: str,
+) -> bool:
+    """テスト結果をキャッシュに保存します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                INSERT OR REPLACE INTO test_result_cache
+                (code_hash, test_case_hash, python_version, success, actual_output)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                (
+                    code_hash,
+                    test_case_hash,
+                    python_version,
+                    int(success),
+                    actual_output,
+                ),
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving cached test result: {e}")
+        return False
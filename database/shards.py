@@ -0,0 +1,232 @@
+"""埋め込みベクトルをコードIDのハッシュで複数のSQLiteファイルに分割して保存します。
+
+各シャードは (コードID, float32の埋め込みベクトル) だけを持ち、検索時には
+シャードごとに別プロセスで部分的な上位k件を計算します。コードとテストケースは
+これまで通り code_comparison.db に保存されます。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from .code_repository import get_corpus_version
+from .context import db_context
+
+SHARD_DIR = "shards"
+
+
+def shard_path(shard: int, num_shards: int) -> str:
+    """シャードのデータベースファイルのパスを返します。"""
+    return os.path.join(SHARD_DIR, f"embeddings_{shard:03d}_of_{num_shards:03d}.db")
+
+
+def shard_of(code_id: int, num_shards: int) -> int:
+    """コードIDのハッシュから保存先のシャード番号を決めます。"""
+    digest = hashlib.blake2b(str(code_id).encode("ascii"), digest_size=8).digest()
+    return int.from_bytes(digest, "little") % num_shards
+
+
+def _connect(shard: int, num_shards: int, path: str = None) -> sqlite3.Connection:
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    conn = sqlite3.connect(path or shard_path(shard, num_shards))
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS embeddings (
+            code_id INTEGER PRIMARY KEY,
+            embedding BLOB NOT NULL
+        )
+    """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS shard_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            corpus_version INTEGER
+        )
+    """
+    )
+    return conn
+
+
+def write_shard(
+    shard: int,
+    num_shards: int,
+    rows: List[Tuple[int, list]],
+) -> int:
+    """1つのシャードに埋め込みベクトルを書き込みます。
+
+    Args:
+        shard: シャード番号
+        num_shards: シャード数
+        rows: (コードID, 埋め込みベクトル) のタプルのリスト
+
+    Returns:
+        int: 書き込んだ行数
+    """
+    conn = _connect(shard, num_shards)
+    try:
+        conn.executemany(
+            "INSERT OR REPLACE INTO embeddings (code_id, embedding) VALUES (?, ?)",
+            ((code_id, array("f", embedding).tobytes()) for code_id, embedding in rows),
+        )
+        conn.commit()
+        return len(rows)
+    finally:
+        conn.close()
+
+
+def write_sharded_embeddings(
+    rows: List[Tuple[int, list]],
+    num_shards: int,
+    max_workers: Optional[int] = None,
+) -> int:
+    """埋め込みベクトルをシャードごとに振り分け、各シャードへ並列に書き込みます。
+
+    シャードはそれぞれ別ファイルなので、書き込みのロックは互いに競合しません。
+
+    Returns:
+        int: 書き込んだ行数
+    """
+    groups: Dict[int, List[Tuple[int, list]]] = defaultdict(list)
+    for code_id, embedding in rows:
+        groups[shard_of(code_id, num_shards)].append((code_id, embedding))
+
+    with ThreadPoolExecutor(max_workers=max_workers or num_shards) as executor:
+        futures = [
+            executor.submit(write_shard, shard, num_shards, group)
+            for shard, group in groups.items()
+        ]
+        return sum(future.result() for future in futures)
+
+
+def read_shard(path: str) -> List[Tuple[int, bytes]]:
+    """シャードの (コードID, float32ベクトルのバイト列) を全て読み込みます。"""
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT code_id, embedding FROM embeddings").fetchall()
+    except sqlite3.OperationalError:
+        return []
+    finally:
+        conn.close()
+
+
+def count_shard(path: str) -> int:
+    """シャードに保存されている埋め込みベクトルの数を返します。"""
+    if not os.path.exists(path):
+        return 0
+    conn = sqlite3.connect(path)
+    try:
+        return conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    finally:
+        conn.close()
+
+
+def get_shards_version(num_shards: int) -> Optional[int]:
+    """シャードが作成された時点のコーパスの版数を返します。シャードが揃っていない場合はNone。"""
+    versions = set()
+    for shard in range(num_shards):
+        if not os.path.exists(shard_path(shard, num_shards)):
+            return None
+        conn = _connect(shard, num_shards)
+        try:
+            row = conn.execute(
+                "SELECT corpus_version FROM shard_meta WHERE id = 1"
+            ).fetchone()
+        finally:
+            conn.close()
+        versions.add(row[0] if row else None)
+    return versions.pop() if len(versions) == 1 else None
+
+
+def mark_shards_version(num_shards: int, version: Optional[int]) -> None:
+    """全シャードにコーパスの版数を記録します。"""
+    for shard in range(num_shards):
+        conn = _connect(shard, num_shards)
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO shard_meta (id, corpus_version) VALUES (1, ?)",
+                (version,),
+            )
+            conn.commit()
+        finally:
+            conn.close()
+
+
+def export_embeddings_to_shards(num_shards: int, batch_size: int = 1000) -> int:
+    """code_comparison.db の埋め込みベクトルから全シャードを作り直します。
+
+    新しいシャードは一時ファイルに書き込み、完成してから os.replace で置き換えるため、
+    作り直しの間に検索しても空や書きかけのシャードを読むことはありません。
+
+    Returns:
+        int: 書き込んだ行数
+    """
+    version = get_corpus_version()
+    temp_paths = [
+        shard_path(shard, num_shards) + ".building" for shard in range(num_shards)
+    ]
+    conns = []
+    try:
+        for shard, path in enumerate(temp_paths):
+            if os.path.exists(path):
+                os.remove(path)
+            conns.append(_connect(shard, num_shards, path))
+
+        count = 0
+        after_id = 0
+        while True:
+            with db_context() as (_, cursor):
+                cursor.execute(
+                    "SELECT id, embedding FROM codes "
+                    "WHERE embedding IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+                    (after_id, batch_size),
+                )
+                rows = cursor.fetchall()
+            if not rows:
+                break
+            for code_id, embedding in rows:
+                conns[shard_of(code_id, num_shards)].execute(
+                    "INSERT INTO embeddings (code_id, embedding) VALUES (?, ?)",
+                    (code_id, array("f", json.loads(embedding)).tobytes()),
+                )
+            count += len(rows)
+            after_id = rows[-1][0]
+
+        for conn in conns:
+            conn.execute(
+                "INSERT INTO shard_meta (id, corpus_version) VALUES (1, ?)", (version,)
+            )
+            conn.commit()
+    except Exception:
+        for conn in conns:
+            conn.close()
+        for path in temp_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        raise
+    for conn in conns:
+        conn.close()
+
+    for shard, path in enumerate(temp_paths):
+        os.replace(path, shard_path(shard, num_shards))
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="埋め込みベクトルのシャードを作成")
+    parser.add_argument("--shards", type=int, default=4, help="シャード数")
+    args = parser.parse_args()
+
+    written = export_embeddings_to_shards(args.shards)
+    print(
+        f"{written} 件の埋め込みベクトルを {args.shards} 個のシャードに書き込みました"
+    )
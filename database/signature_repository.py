@@ -0,0 +1,116 @@
+from typing import List, Optional, Set, Tuple
+from .context import db_context
+
+
+def save_code_signatures(
+    rows: List[Tuple[int, Optional[str], Optional[int], Optional[int], Optional[int]]]
+) -> bool:
+    """コードの関数シグネチャを保存します。
+
+    Args:
+        rows: (コードID, 関数名, 必須の引数の数, 引数の最大数, デフォルト値の数) のタプルのリスト。
+            関数を特定できないコードは関数名以降をNone、可変長引数の場合は引数の最大数をNoneとします
+
+    Returns:
+        bool: 保存に成功した場合はTrue
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.executemany(
+                "INSERT OR REPLACE INTO code_signatures "
+                "(code_id, function_name, min_args, max_args, defaults) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving code signatures: {e}")
+        return False
+
+
+def get_codes_without_signature(
+    after_id: int = 0, limit: int = 500
+) -> List[Tuple[int, str]]:
+    """シグネチャがまだ保存されていないコードをID順に取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                SELECT c.id, c.code FROM codes c
+                LEFT JOIN code_signatures s ON s.code_id = c.id
+                WHERE s.code_id IS NULL AND c.id > ?
+                ORDER BY c.id
+                LIMIT ?
+                """,
+                (after_id, limit),
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting codes without signature: {e}")
+        return []
+
+
+def get_test_cases_without_arg_count(
+    after_id: int = 0, limit: int = 500
+) -> List[Tuple[int, str]]:
+    """引数の数がまだ保存されていないテストケースの (ID, 入力) をID順に取得します。"""
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT id, input FROM test_cases "
+                "WHERE arg_count IS NULL AND id > ? ORDER BY id LIMIT ?",
+                (after_id, limit),
+            )
+            return cursor.fetchall()
+    except Exception as e:
+        print(f"Error getting test cases without arg count: {e}")
+        return []
+
+
+def save_test_arg_counts(rows: List[Tuple[int, int]]) -> bool:
+    """テストケースの入力を展開したときの引数の数を保存します。
+
+    Args:
+        rows: (テストケースID, 引数の数) のタプルのリスト
+
+    Returns:
+        bool: 保存に成功した場合はTrue
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.executemany(
+                "UPDATE test_cases SET arg_count = ? WHERE id = ?",
+                ((arg_count, test_case_id) for test_case_id, arg_count in rows),
+            )
+            return True
+    except Exception as e:
+        print(f"Error saving test arg counts: {e}")
+        return False
+
+
+def get_compatible_code_ids(
+    min_args: int, max_args: Optional[int]
+) -> Optional[Set[int]]:
+    """全てのテスト入力の引数の数が min_args 以上 max_args 以下のコードIDを取得します。
+
+    トリガーで同期している code_signatures の引数の数の範囲をインデックスで絞り込みます。
+    テストケースのないコードとシグネチャが未作成のコードは含めません。
+
+    Args:
+        min_args: 生成コードの関数の必須の引数の数
+        max_args: 生成コードの関数の引数の最大数（Noneの場合は上限なし）
+
+    Returns:
+        Optional[Set[int]]: 条件を満たすコードIDの集合。取得に失敗した場合はNone
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                "SELECT code_id FROM code_signatures "
+                "WHERE test_min_args >= ? AND (? IS NULL OR test_max_args <= ?)",
+                (min_args, max_args, max_args),
+            )
+            return {row[0] for row in cursor.fetchall()}
+    except Exception as e:
+        print(f"Error getting compatible code IDs: {e}")
+        return None
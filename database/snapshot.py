@@ -0,0 +1,452 @@
+"""コーパス（コード・テストケース・埋め込みベクトル）のスナップショットの書き出しと復元。
+
+スナップショットは1つのZIPファイルで、次のエントリを含みます。
+
+- manifest.json: 形式のバージョン、件数、埋め込みの次元数、各エントリのSHA-256
+- codes.jsonl: {"id", "code"} の行
+- test_cases.jsonl: {"id", "code_id", "input", "expected_output", "arg_count"} の行
+- embedding_ids.i64: 埋め込み行列の各行に対応するコードID（リトルエンディアンのint64）
+- embeddings.f32: 埋め込み行列（行優先、リトルエンディアンのfloat32）
+- embedding_int8.jsonl, code_minhash.jsonl, code_signatures.jsonl: 埋め込みやコードから
+  計算した派生テーブルの行（BLOBの列はBase64）。バージョン1のスナップショットには含まれず、
+  その場合は復元後にそれぞれの処理で作り直されます
+
+書き出しは1つの読み取りトランザクションで行うため、取り込み中のデータベースからでも
+一貫したスナップショットになります。復元時はネットワークにも埋め込みAPIにもアクセスせず、
+チェックサムを検証してから一時ファイルに書き込み、最後に SQLite のバックアップ機能で
+復元先に書き込みます。データベースはWALモードのため、ファイルを置き換えると
+置き換え前の -wal/-shm ファイルが新しいファイルに適用されてしまうためです。
+"""
+
+import base64
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+import time
+import zipfile
+from array import array
+from typing import Dict, Iterator, List, Tuple
+
+from .connection import (
+    DATABASE_NAME,
+    code_content_hash,
+    create_database,
+    get_connection,
+)
+
+SNAPSHOT_FORMAT = "code-comparison-snapshot"
+SNAPSHOT_VERSION = 2
+
+# スナップショットに含める派生テーブルとその列（先頭列がページングのキー）
+_DERIVED_TABLES = {
+    "embedding_int8": ("code_id", "scale", "vector"),
+    "code_minhash": ("code_id", "signature", "canonical_id"),
+    "code_signatures": (
+        "code_id",
+        "function_name",
+        "min_args",
+        "max_args",
+        "defaults",
+    ),
+}
+_BLOB_COLUMNS = {"vector", "signature"}
+
+_PAGE_SIZE = 1000
+
+
+class SnapshotError(Exception):
+    """スナップショットが壊れている、または対応していない形式の場合に送出されます。"""
+
+
+def _pack(typecode: str, values) -> bytes:
+    packed = array(typecode, values)
+    if sys.byteorder != "little":
+        packed.byteswap()
+    return packed.tobytes()
+
+
+def _unpack(typecode: str, data: bytes) -> array:
+    unpacked = array(typecode)
+    unpacked.frombytes(data)
+    if sys.byteorder != "little":
+        unpacked.byteswap()
+    return unpacked
+
+
+def _pages(conn, query: str) -> Iterator[List[tuple]]:
+    """id順のクエリ結果をページ単位で読み込みます（先頭列がページングのキー）。"""
+    after_id = 0
+    while True:
+        rows = conn.execute(query, (after_id, _PAGE_SIZE)).fetchall()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1][0]
+
+
+class _HashingWriter:
+    """ZIPエントリに書き込みながらSHA-256を計算します。
+
+    with 文で使い、途中で例外が発生してもエントリを閉じます（開いたままだと
+    ZIPファイルを閉じられず、元の例外が隠れてしまうため）。
+    """
+
+    def __init__(self, archive: zipfile.ZipFile, name: str):
+        self.name = name
+        self.file = archive.open(name, "w", force_zip64=True)
+        self.sha256 = hashlib.sha256()
+
+    def __enter__(self) -> "_HashingWriter":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.file.close()
+
+    def write(self, data: bytes) -> None:
+        self.sha256.update(data)
+        self.file.write(data)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+def _encode_value(value):
+    return (
+        base64.b64encode(value).decode("ascii") if isinstance(value, bytes) else value
+    )
+
+
+def _write_table(archive: zipfile.ZipFile, conn, table: str) -> Tuple[str, int]:
+    """派生テーブルの全行をJSON Linesのエントリに書き出し、SHA-256と行数を返します。"""
+    columns = _DERIVED_TABLES[table]
+    count = 0
+    with _HashingWriter(archive, f"{table}.jsonl") as writer:
+        for rows in _pages(
+            conn,
+            f"SELECT {', '.join(columns)} FROM {table} "
+            f"WHERE {columns[0]} > ? ORDER BY {columns[0]} LIMIT ?",
+        ):
+            for row in rows:
+                line = json.dumps(
+                    {
+                        column: _encode_value(value)
+                        for column, value in zip(columns, row)
+                    },
+                    ensure_ascii=False,
+                )
+                writer.write(line.encode("utf-8") + b"\n")
+            count += len(rows)
+    return writer.hexdigest(), count
+
+
+def export_snapshot(path: str, database: str = None) -> Dict:
+    """データベースの内容をスナップショットファイルに書き出します。
+
+    Args:
+        path: 書き出すスナップショットファイルのパス
+        database: 読み込むデータベースファイル（省略時は DATABASE_NAME）
+
+    Returns:
+        Dict: 書き出したスナップショットのマニフェスト
+    """
+    # 取り込みだけで作られた古いデータベースにも、読み込む列とテーブルを追加しておく
+    create_database(database)
+    conn = get_connection(database)
+    try:
+        # 全てのエントリを同じ時点のデータから書き出す
+        conn.execute("BEGIN")
+        with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+            return _write_snapshot(archive, conn)
+    except BaseException:
+        # 書きかけのスナップショットを残さない
+        if os.path.exists(path):
+            os.remove(path)
+        raise
+    finally:
+        conn.close()
+
+
+def _write_snapshot(archive: zipfile.ZipFile, conn) -> Dict:
+    """スナップショットの各エントリとマニフェストを書き出します。"""
+    checksums = {}
+    counts = {"codes": 0, "test_cases": 0, "embeddings": 0}
+    dim = None
+    with _HashingWriter(archive, "codes.jsonl") as writer:
+        for rows in _pages(
+            conn, "SELECT id, code FROM codes WHERE id > ? ORDER BY id LIMIT ?"
+        ):
+            for code_id, code in rows:
+                line = json.dumps({"id": code_id, "code": code}, ensure_ascii=False)
+                writer.write(line.encode("utf-8") + b"\n")
+            counts["codes"] += len(rows)
+    checksums[writer.name] = writer.hexdigest()
+
+    with _HashingWriter(archive, "test_cases.jsonl") as writer:
+        for rows in _pages(
+            conn,
+            "SELECT id, code_id, input, expected_output, arg_count "
+            "FROM test_cases WHERE id > ? ORDER BY id LIMIT ?",
+        ):
+            for test_case_id, code_id, input_val, expected_output, arg_count in rows:
+                line = json.dumps(
+                    {
+                        "id": test_case_id,
+                        "code_id": code_id,
+                        "input": input_val,
+                        "expected_output": expected_output,
+                        "arg_count": arg_count,
+                    },
+                    ensure_ascii=False,
+                )
+                writer.write(line.encode("utf-8") + b"\n")
+            counts["test_cases"] += len(rows)
+    checksums[writer.name] = writer.hexdigest()
+
+    # 行列を先に書き出し、対応するコードID（1行8バイト）だけをメモリに保持する
+    ids = array("q")
+    with _HashingWriter(archive, "embeddings.f32") as writer:
+        for rows in _pages(
+            conn,
+            "SELECT id, embedding FROM codes "
+            "WHERE embedding IS NOT NULL AND id > ? ORDER BY id LIMIT ?",
+        ):
+            for code_id, embedding_json in rows:
+                embedding = json.loads(embedding_json)
+                if dim is None:
+                    dim = len(embedding)
+                if len(embedding) != dim:
+                    print(
+                        f"Skipping embedding of code ID {code_id}: dimension mismatch"
+                    )
+                    continue
+                writer.write(_pack("f", embedding))
+                ids.append(code_id)
+    checksums[writer.name] = writer.hexdigest()
+    counts["embeddings"] = len(ids)
+
+    with _HashingWriter(archive, "embedding_ids.i64") as writer:
+        writer.write(_pack("q", ids))
+    checksums[writer.name] = writer.hexdigest()
+
+    for table in _DERIVED_TABLES:
+        name = f"{table}.jsonl"
+        checksums[name], counts[table] = _write_table(archive, conn, table)
+
+    row = conn.execute(
+        "SELECT embedding_input FROM corpus_meta WHERE id = 1"
+    ).fetchone()
+    manifest = {
+        "format": SNAPSHOT_FORMAT,
+        "version": SNAPSHOT_VERSION,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "counts": counts,
+        "embedding_dim": dim or 0,
+        "embedding_dtype": "float32",
+        # 埋め込みを作ったときの入力の前処理の形式（embedding/preprocess.py）
+        "embedding_input": row[0] if row else None,
+        "sha256": checksums,
+    }
+    archive.writestr("manifest.json", json.dumps(manifest, indent=2))
+    return manifest
+
+
+def _read_verified(archive: zipfile.ZipFile, manifest: Dict, name: str) -> bytes:
+    data = archive.read(name)
+    if hashlib.sha256(data).hexdigest() != manifest["sha256"].get(name):
+        raise SnapshotError(f"Checksum mismatch for {name}")
+    return data
+
+
+def read_manifest(archive: zipfile.ZipFile) -> Dict:
+    """スナップショットのマニフェストを読み込み、形式とバージョンを確認します。"""
+    try:
+        manifest = json.loads(archive.read("manifest.json"))
+    except KeyError:
+        raise SnapshotError("manifest.json not found")
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise SnapshotError(f"Unknown snapshot format: {manifest.get('format')}")
+    if manifest.get("version", 0) > SNAPSHOT_VERSION:
+        raise SnapshotError(
+            f"Snapshot version {manifest['version']} is newer than supported "
+            f"version {SNAPSHOT_VERSION}"
+        )
+    return manifest
+
+
+def _remove_database(path: str) -> None:
+    """データベースファイルと、残っていればその -wal/-shm ファイルを削除します。"""
+    for name in (path, path + "-wal", path + "-shm"):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _current_versions(database: str) -> Tuple[int, int]:
+    """復元先のデータベースの (version, candidates_version) を返します。ない場合は (0, 0)。"""
+    if not os.path.exists(database):
+        return 0, 0
+    conn = get_connection(database)
+    try:
+        row = conn.execute(
+            "SELECT version, candidates_version FROM corpus_meta WHERE id = 1"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        # corpus_meta や candidates_version がない古いデータベース
+        row = None
+    finally:
+        conn.close()
+    return tuple(row) if row else (0, 0)
+
+
+def import_snapshot(path: str, database: str = None, force: bool = False) -> Dict:
+    """スナップショットファイルからデータベースを復元します。
+
+    Args:
+        path: 読み込むスナップショットファイルのパス
+        database: 復元先のデータベースファイル（省略時は DATABASE_NAME）
+        force: 復元先のデータベースファイルが既にある場合に置き換えるかどうか
+
+    Returns:
+        Dict: 復元したスナップショットのマニフェスト
+
+    Raises:
+        SnapshotError: スナップショットが壊れている、または対応していない形式の場合
+        FileExistsError: 復元先が既にあり、force が False の場合
+    """
+    database = database or DATABASE_NAME
+    if os.path.exists(database) and not force:
+        raise FileExistsError(f"{database} already exists (use force to replace it)")
+
+    with zipfile.ZipFile(path) as archive:
+        manifest = read_manifest(archive)
+        codes = _read_verified(archive, manifest, "codes.jsonl")
+        test_cases = _read_verified(archive, manifest, "test_cases.jsonl")
+        ids = _unpack("q", _read_verified(archive, manifest, "embedding_ids.i64"))
+        matrix = _unpack("f", _read_verified(archive, manifest, "embeddings.f32"))
+        derived = {
+            table: _read_verified(archive, manifest, f"{table}.jsonl")
+            for table in _DERIVED_TABLES
+            if f"{table}.jsonl" in manifest["sha256"]
+        }
+
+    dim = manifest["embedding_dim"]
+    if len(matrix) != len(ids) * dim:
+        raise SnapshotError("Embedding matrix size does not match its IDs")
+
+    temp_database = database + ".importing"
+    _remove_database(temp_database)
+    create_database(temp_database)
+    conn = get_connection(temp_database)
+    try:
+        conn.executemany(
+            "INSERT INTO codes (id, code, embedding, code_hash) VALUES (?, ?, NULL, ?)",
+            (
+                (row["id"], row["code"], code_content_hash(row["code"]))
+                for row in map(json.loads, codes.decode("utf-8").splitlines())
+            ),
+        )
+        conn.executemany(
+            "UPDATE codes SET embedding = ? WHERE id = ?",
+            (
+                (json.dumps(matrix[i * dim : (i + 1) * dim].tolist()), code_id)
+                for i, code_id in enumerate(ids)
+            ),
+        )
+        conn.executemany(
+            "INSERT INTO test_cases (id, code_id, input, expected_output, arg_count) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (
+                (
+                    row.get("id"),
+                    row["code_id"],
+                    row["input"],
+                    row["expected_output"],
+                    row.get("arg_count"),
+                )
+                for row in map(json.loads, test_cases.decode("utf-8").splitlines())
+            ),
+        )
+        # 埋め込みの書き込みで消えた量子化表現も含め、派生テーブルは最後に書き込む
+        for table, data in derived.items():
+            columns = _DERIVED_TABLES[table]
+            conn.executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) "
+                f"VALUES ({', '.join('?' * len(columns))})",
+                (
+                    tuple(
+                        (
+                            base64.b64decode(row[column])
+                            if column in _BLOB_COLUMNS
+                            else row[column]
+                        )
+                        for column in columns
+                    )
+                    for row in map(json.loads, data.decode("utf-8").splitlines())
+                ),
+            )
+        missing = [table for table in _DERIVED_TABLES if table not in derived]
+        if missing:
+            print(
+                f"Snapshot has no {', '.join(missing)}; "
+                "they will be rebuilt when first needed"
+            )
+        if manifest.get("embedding_input"):
+            conn.execute(
+                "UPDATE corpus_meta SET embedding_input = ? WHERE id = 1",
+                (manifest["embedding_input"],),
+            )
+        # 復元先を読み込んでいる検索サービスが、同じ版数のままの古いインデックスや
+        # 検索結果のキャッシュを使い続けないよう、復元前のどちらの版数よりも大きくする
+        version, candidates_version = _current_versions(database)
+        conn.execute(
+            """
+            UPDATE corpus_meta SET
+                version = MAX(version, ?) + 1,
+                candidates_version = MAX(candidates_version, ?) + 1
+            WHERE id = 1
+            """,
+            (version, candidates_version),
+        )
+        conn.commit()
+        target = get_connection(database)
+        try:
+            conn.backup(target)
+        finally:
+            target.close()
+    finally:
+        conn.close()
+        _remove_database(temp_database)
+    return manifest
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="コーパスのスナップショット")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="スナップショットを書き出す")
+    export_parser.add_argument("path", help="書き出すファイル")
+    import_parser = subparsers.add_parser("import", help="スナップショットから復元する")
+    import_parser.add_argument("path", help="読み込むファイル")
+    import_parser.add_argument(
+        "--force", action="store_true", help="既存のデータベースを置き換える"
+    )
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    if args.command == "export":
+        manifest = export_snapshot(args.path)
+        print(f"スナップショットを書き出しました: {args.path}")
+    else:
+        try:
+            manifest = import_snapshot(args.path, force=args.force)
+        except (SnapshotError, FileExistsError) as e:
+            print(f"エラー: {e}")
+            sys.exit(1)
+        print(f"スナップショットから復元しました: {DATABASE_NAME}")
+    counts = manifest["counts"]
+    print(
+        f"コード: {counts['codes']}, テストケース: {counts['test_cases']}, "
+        f"埋め込み: {counts['embeddings']} ({time.perf_counter() - start:.1f}秒)"
+    )
@@ -66,6 +66,36 @@ def get_test_cases(code_id: int) -> List[Tuple[str, str]]:
         return []
 
 
+def get_test_cases_with_duplicates(code_id: int) -> List[Tuple[str, str]]:
+    """コードのテストケースに、そのコードを代表とする近似重複のテストケースを加えて取得します。
+
+    近似重複のコードは埋め込みベクトルを持たず検索結果に現れないため、
+    そのテストケースは代表コードの候補を通じて使われます。重複するテストケースは除きます。
+
+    Args:
+        code_id: 代表コードのID
+
+    Returns:
+        List[Tuple[str, str]]: (入力, 期待される出力)のタプルのリスト
+    """
+    try:
+        with db_context() as (_, cursor):
+            cursor.execute(
+                """
+                SELECT input, expected_output FROM test_cases WHERE code_id = ?
+                UNION ALL
+                SELECT t.input, t.expected_output FROM test_cases t
+                JOIN code_minhash m ON m.code_id = t.code_id
+                WHERE m.canonical_id = ? AND m.code_id != m.canonical_id
+                """,
+                (code_id, code_id),
+            )
+            return list(dict.fromkeys(cursor.fetchall()))
+    except Exception as e:
+        print(f"Error getting test cases with duplicates: {e}")
+        return []
+
+
 def get_test_case_count(code_id: int) -> int:
     """指定されたコードIDのテストケース数を取得します。
 
@@ -1,115 +1,41 @@
-import json
-import re
+import argparse
 from typing import Dict, List, Any, Optional, Tuple
-from database.code_repository import insert_code, update_embedding
+from database.code_repository import (
+    insert_code,
+    update_embedding,
+    save_minhash_signatures,
+)
 from database.test_repository import insert_test_case
 from embedding.api_client import BedrockClient
+from embedding.preprocess import resolve_input_format
+from embedding.minhash import (
+    NearDuplicateIndex,
+    load_near_duplicate_index,
+    minhash_signature,
+    signature_to_bytes,
+)
 from datasets import load_dataset
 from database.connection import create_database
-import ast
+from ingest.parsing import safe_json_dumps, extract_test_data_from_test_field
+from ingest.pipeline import DEFAULT_SOURCE, run_streaming_ingest
+from profiling import memory
+from sandbox.signature import sync_signatures
 
 
-import cmath
-
-
-def convert_complex_number(num: complex) -> Dict[str, float]:
-    """複素数をJSON シリアライズ可能な形式に変換します。
-
-    Args:
-        num: 変換する複素数
-
-    Returns:
-        Dict[str, float]: 実部と虚部を含む辞書
-    """
-    return {"real": num.real, "imag": num.imag}
-
-
-def convert_to_json_serializable(obj: Any) -> Any:
-    """オブジェクトをJSON シリアライズ可能な形式に変換します。
-
-    Args:
-        obj: 変換する対象のオブジェクト
-
-    Returns:
-        Any: JSON シリアライズ可能な形式に変換されたオブジェクト
-    """
-    if isinstance(obj, (set, frozenset)):
-        return list(obj)
-    elif isinstance(obj, complex):
-        return convert_complex_number(obj)
-    elif isinstance(obj, tuple):
-        return list(obj)
-    elif isinstance(obj, dict):
-        return {str(k): convert_to_json_serializable(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_to_json_serializable(x) for x in obj]
-    elif isinstance(obj, float) and (cmath.isinf(obj) or cmath.isnan(obj)):
-        return str(obj)
-    return obj
-
-
-def safe_json_dumps(obj: Any) -> str:
-    """オブジェクトを安全にJSONシリアライズします。
-
-    Args:
-        obj: シリアライズする対象のオブジェクト
-
-    Returns:
-        str: JSONシリアライズされた文字列
-    """
-    try:
-        return json.dumps(convert_to_json_serializable(obj))
-    except TypeError as e:
-        print(f"Error serializing object: {e}")
-        return json.dumps(str(obj))
-
-
-def extract_test_data_from_test_field(test_str: str) -> List[Tuple[Any, Any]]:
-    """テストフィールドからテストデータを抽出します。
-
-    Args:
-        test_str: テストコードを含む文字列
-
-    Returns:
-        List[Tuple[Any, Any]]: (入力値, 期待される出力値)のタプルのリスト
-    """
-    try:
-        # inputsとresultsの部分を抽出
-        inputs_match = re.search(
-            r"inputs\s*=\s*(\[.*?\])\s*results", test_str, re.DOTALL
-        )
-        results_match = re.search(r"results\s*=\s*(\[.*?\])\s*for", test_str, re.DOTALL)
-
-        if not inputs_match or not results_match:
-            return []
-
-        # 文字列を評価可能な形式に整形
-        inputs_str = inputs_match.group(1).replace("\n", "").replace(" ", "")
-        results_str = results_match.group(1).replace("\n", "").replace(" ", "")
-
-        # 文字列をPythonオブジェクトに変換
-        inputs = ast.literal_eval(inputs_str)
-        results = ast.literal_eval(results_str)
-
-        # 入力と出力のペアを作成し、JSON シリアライズ可能な形式に変換
-        test_cases = []
-        for input_val, expected in zip(inputs, results):
-            input_val = convert_to_json_serializable(input_val)
-            expected = convert_to_json_serializable(expected)
-            test_cases.append((input_val, expected))
-
-        return test_cases
-    except Exception as e:
-        print(f"Error extracting test data: {e}")
-        return []
-
-
-def process_code(code: str, bedrock_client: BedrockClient) -> int:
+def process_code(
+    code: str,
+    bedrock_client: BedrockClient,
+    dedup_index: Optional[NearDuplicateIndex] = None,
+) -> int:
     """コードを処理し、データベースに保存します。
 
+    dedup_index が指定されている場合、既存コードの近似重複であれば
+    埋め込みベクトルを取得せず、代表コードの埋め込みを共有させます。
+
     Args:
         code: 保存するコード
         bedrock_client: BedrockClientのインスタンス
+        dedup_index: 代表コードのMinHash署名のLSHインデックス
 
     Returns:
         int: 保存されたコードのID、失敗した場合は0
@@ -119,11 +45,27 @@ def process_code(code: str, bedrock_client: BedrockClient) -> int:
         if not code_id:
             return 0
 
+        signature = None
+        if dedup_index is not None:
+            signature = minhash_signature(code)
+            canonical_id = dedup_index.find_duplicate(signature)
+            if canonical_id is not None:
+                save_minhash_signatures(
+                    [(code_id, signature_to_bytes(signature), canonical_id)]
+                )
+                if canonical_id != code_id:
+                    print(f"Code ID {code_id} is a near-duplicate of {canonical_id}")
+                return code_id
+
         embedding = bedrock_client.get_embedding(code)
         if not embedding or not update_embedding(code_id, embedding):
             print(f"Failed to update embedding for code ID: {code_id}")
             return 0
 
+        if signature is not None:
+            save_minhash_signatures([(code_id, signature_to_bytes(signature), code_id)])
+            dedup_index.add(code_id, signature)
+
         return code_id
     except Exception as e:
         print(f"Error processing code: {e}")
@@ -176,7 +118,8 @@ def load_and_store_data() -> Dict[str, int]:
 
         # データセットの読み込み
         print("Loading dataset...")
-        dataset = load_dataset("evalplus/mbppplus")
+        with memory.stage("load_dataset"):
+            dataset = load_dataset("evalplus/mbppplus")
         print(f"Dataset structure: {dataset}")
 
         if not dataset or "test" not in dataset:
@@ -195,7 +138,11 @@ def load_and_store_data() -> Dict[str, int]:
                 )
 
         # BedrockClientのインスタンスを作成
-        bedrock_client = BedrockClient()
+        bedrock_client = BedrockClient(resolve_input_format())
+
+        # 近似重複検出のためのLSHインデックス
+        with memory.stage("dedup_index"):
+            dedup_index = load_near_duplicate_index()
 
         # 統計情報の初期化
         test_dataset = dataset["test"]
@@ -203,26 +150,32 @@ def load_and_store_data() -> Dict[str, int]:
         print(f"\nProcessing {stats['total_solutions']} examples...")
 
         # 各サンプルの処理
-        for i, sample in enumerate(test_dataset):
-            if i % 10 == 0:  # より頻繁に進捗を表示
-                print(f"Processing example {i}/{stats['total_solutions']}")
-
-            code = sample["code"]
-            test_data = extract_test_data_from_test_field(sample["test"])
-
-            if not test_data:
-                print(f"Failed to extract test data for example {i}")
-                stats["failed_solutions"] += 1
-                continue
-
-            code_id = process_code(code, bedrock_client)
-            if code_id:
-                stats["successful_solutions"] += 1
-                if process_test_cases(code_id, test_data):
-                    stats["successful_test_cases"] += 1
-            else:
-                stats["failed_solutions"] += 1
-
+        with memory.stage("process"):
+            for i, sample in enumerate(test_dataset):
+                if i % 10 == 0:  # より頻繁に進捗を表示
+                    print(f"Processing example {i}/{stats['total_solutions']}")
+
+                code = sample["code"]
+                test_data = extract_test_data_from_test_field(sample["test"])
+
+                if not test_data:
+                    print(f"Failed to extract test data for example {i}")
+                    stats["failed_solutions"] += 1
+                    continue
+
+                code_id = process_code(code, bedrock_client, dedup_index)
+                if code_id:
+                    stats["successful_solutions"] += 1
+                    if process_test_cases(code_id, test_data):
+                        stats["successful_test_cases"] += 1
+                else:
+                    stats["failed_solutions"] += 1
+
+        # 引数の数による候補の絞り込みに使うシグネチャを作成する
+        with memory.stage("signatures"):
+            sync_signatures()
+
+        stats["tokens_saved"] = bedrock_client.tokens_saved
         return stats
     except Exception as e:
         print(f"Error loading dataset: {e}")
@@ -233,6 +186,53 @@ def load_and_store_data() -> Dict[str, int]:
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="データベース作成とデータ読み込み")
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="データセット全体を読み込まずにストリーミングで取り込む",
+    )
+    parser.add_argument(
+        "--source",
+        default=DEFAULT_SOURCE,
+        help="Hugging Faceのデータセット名、またはJSONL/Parquetファイルのパス",
+    )
+    parser.add_argument("--split", default="test", help="データセットのスプリット名")
+    parser.add_argument(
+        "--batch-size", type=int, default=32, help="1回に書き込むレコード数"
+    )
+    parser.add_argument(
+        "--queue-size", type=int, default=64, help="ステージ間キューの最大レコード数"
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=1,
+        help="テストフィールドの解析に使うプロセス数（0の場合はCPUコア数）",
+    )
+    parser.add_argument(
+        "--parse-report", help="問題ごとの解析時間と失敗理由を書き出すJSONLファイル"
+    )
+    parser.add_argument(
+        "--no-dedup",
+        action="store_true",
+        help="近似重複のコードも個別に埋め込む（ストリーミング取り込みのみ）",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="埋め込みベクトルをN個のシャードにも並列に書き込む（ストリーミング取り込みのみ）",
+    )
+    parser.add_argument(
+        "--memory-profile",
+        metavar="FILE",
+        help="tracemallocでステージごとのメモリ使用量を計測し、結果をJSONファイルに書き出す",
+    )
+    args = parser.parse_args()
+    if args.memory_profile:
+        memory.start_profiling(args.memory_profile)
+
     print("=== データベース作成とデータ読み込み・保存の開始 ===")
 
     # データベースの作成
@@ -240,12 +240,31 @@ if __name__ == "__main__":
     print("データベースが作成されました。")
 
     # データの読み込みと保存
-    stats = load_and_store_data()
+    if args.stream:
+        stats = run_streaming_ingest(
+            source=args.source,
+            split=args.split,
+            batch_size=args.batch_size,
+            queue_size=args.queue_size,
+            parse_workers=args.parse_workers,
+            parse_report=args.parse_report,
+            dedup=not args.no_dedup,
+            shards=args.shards,
+        )
+    else:
+        stats = load_and_store_data()
 
     print("\n=== 処理結果 ===")
     print(f"総ソリューション数: {stats['total_solutions']}")
     print(f"成功したソリューション: {stats['successful_solutions']}")
     print(f"失敗したソリューション: {stats['failed_solutions']}")
     print(f"テストケース保存成功: {stats['successful_test_cases']}")
-
+    if "near_duplicates" in stats:
+        print(f"近似重複として埋め込みを省略: {stats['near_duplicates']}")
+    if "parse_seconds" in stats:
+        print(f"テストフィールド解析のCPU時間: {stats['parse_seconds']:.2f}秒")
+    if "tokens_saved" in stats:
+        print(f"埋め込み入力の前処理で削減したトークン数: {stats['tokens_saved']}")
+
+    memory.stop_profiling()
     print("\nデータベースファイルが作成され、データが保存されました。")
@@ -1,11 +1,23 @@
 import boto3
 import json
+import threading
 import torch
 from transformers import AutoTokenizer, AutoModel
+from .preprocess import RAW_FORMAT, count_tokens, prepare_embedding_input
 
 
 class BedrockClient:
-    def __init__(self):
+    def __init__(self, input_format: str = RAW_FORMAT):
+        """
+        Args:
+            input_format: 埋め込む前のコードの前処理の形式（embedding/preprocess.py）。
+                取り込みと検索で同じ形式を使う必要があるため、通常は resolve_input_format() の値
+        """
+        self.input_format = input_format
+        # 前処理の前後のおおよそのトークン数の累計
+        self.input_tokens = 0
+        self.sent_tokens = 0
+        self._token_lock = threading.Lock()
         # """
         # Bedrock client initialization (commented out but preserved)
         self.client = boto3.client(
@@ -18,8 +30,23 @@ class BedrockClient:
         # self.model = AutoModel.from_pretrained("microsoft/codebert-base")
         # self.model.eval()  # Set model to evaluation mode
 
+    @property
+    def tokens_saved(self) -> int:
+        """前処理で削減したおおよそのトークン数の累計。"""
+        return self.input_tokens - self.sent_tokens
+
     def get_embedding(self, text: str):
-        """テキストの埋め込みベクトルを取得します。"""
+        """テキストの埋め込みベクトルを取得します。
+
+        テキストは input_format に従って前処理してから送信します。
+        """
+        prepared = prepare_embedding_input(text, self.input_format)
+        if prepared is not text:
+            with self._token_lock:
+                self.input_tokens += count_tokens(text)
+                self.sent_tokens += count_tokens(prepared)
+        text = prepared
+
         # Original Bedrock implementation (commented out but preserved)
 
         model_id = "amazon.titan-embed-text-v1"
@@ -0,0 +1,236 @@
+"""MinHash/LSH によるコードの近似重複検出。
+
+空白・コメント・変数名だけが異なるコードを同じものとして扱えるよう、
+字句を正規化したトークン列のシングルからMinHash署名を計算します。
+"""
+
+import builtins
+import hashlib
+import io
+import keyword
+import random
+import threading
+import tokenize
+from array import array
+from collections import defaultdict
+from typing import Dict, Hashable, List, Optional, Set
+
+from database.code_repository import (
+    get_codes_without_minhash,
+    get_minhash_signatures,
+    save_minhash_signatures,
+)
+from database.connection import create_database
+
+NUM_PERM = 64
+SHINGLE_SIZE = 4
+LSH_BANDS = 16
+DUPLICATE_THRESHOLD = 0.8
+
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for _ in range(NUM_PERM)
+]
+
+_SKIPPED_TOKENS = {
+    tokenize.COMMENT,
+    tokenize.NL,
+    tokenize.NEWLINE,
+    tokenize.INDENT,
+    tokenize.DEDENT,
+    tokenize.ENCODING,
+    tokenize.ENDMARKER,
+}
+_RESERVED_NAMES = set(keyword.kwlist) | set(dir(builtins))
+
+
+def normalize_tokens(code: str) -> List[str]:
+    """コードを字句解析し、空白・コメントを除いて識別子を出現順の記号に置き換えます。
+
+    Args:
+        code: 正規化するコード
+
+    Returns:
+        List[str]: 正規化されたトークンのリスト
+    """
+    names = {}
+    tokens = []
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type in _SKIPPED_TOKENS:
+                continue
+            if token.type == tokenize.NAME and token.string not in _RESERVED_NAMES:
+                tokens.append(names.setdefault(token.string, f"ID{len(names)}"))
+            else:
+                tokens.append(token.string)
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        # 字句解析できないコードは空白区切りで代用する
+        return code.split()
+    return tokens
+
+
+def minhash_signature(code: str) -> List[int]:
+    """コードのMinHash署名を計算します。
+
+    Args:
+        code: 署名を計算するコード
+
+    Returns:
+        List[int]: NUM_PERM 個のハッシュ値の最小値
+    """
+    tokens = normalize_tokens(code)
+    shingles = {
+        " ".join(tokens[i : i + SHINGLE_SIZE])
+        for i in range(max(len(tokens) - SHINGLE_SIZE + 1, 1))
+    }
+    hashes = [
+        int.from_bytes(
+            hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "little"
+        )
+        for shingle in shingles
+    ]
+    return [
+        min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS
+    ]
+
+
+def signature_to_bytes(signature: List[int]) -> bytes:
+    """MinHash署名をデータベースに保存するためのバイト列に変換します。"""
+    return array("Q", signature).tobytes()
+
+
+def signature_from_bytes(data: bytes) -> List[int]:
+    """バイト列からMinHash署名を復元します。"""
+    signature = array("Q")
+    signature.frombytes(data)
+    return signature.tolist()
+
+
+def estimate_similarity(signature_a: List[int], signature_b: List[int]) -> float:
+    """2つのMinHash署名からJaccard類似度を推定します。"""
+    matches = sum(1 for a, b in zip(signature_a, signature_b) if a == b)
+    return matches / len(signature_a)
+
+
+class NearDuplicateIndex:
+    """MinHash署名のLSHインデックス。
+
+    署名をバンドに分割してバケットに登録し、いずれかのバンドが一致した
+    候補についてのみ推定類似度を計算します。取り込みパイプラインの複数の
+    ステージから操作されるため、各操作はロックで保護します。
+    """
+
+    def __init__(self, bands: int = LSH_BANDS, threshold: float = DUPLICATE_THRESHOLD):
+        self.bands = bands
+        self.rows = NUM_PERM // bands
+        self.threshold = threshold
+        self.signatures: Dict[Hashable, List[int]] = {}
+        self.buckets: Dict[tuple, Set[Hashable]] = defaultdict(set)
+        self._lock = threading.RLock()
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def _band_keys(self, signature: List[int]):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield (band, tuple(signature[start : start + self.rows]))
+
+    def add(self, key: Hashable, signature: List[int]) -> None:
+        """署名をインデックスに登録します。"""
+        with self._lock:
+            self.signatures[key] = signature
+            for band_key in self._band_keys(signature):
+                self.buckets[band_key].add(key)
+
+    def remove(self, key: Hashable) -> None:
+        """署名をインデックスから削除します。"""
+        with self._lock:
+            signature = self.signatures.pop(key, None)
+            if signature is None:
+                return
+            for band_key in self._band_keys(signature):
+                self.buckets[band_key].discard(key)
+
+    def rename(self, old_key: Hashable, new_key: Hashable) -> None:
+        """登録済みの署名のキーを付け替えます。"""
+        with self._lock:
+            signature = self.signatures.get(old_key)
+            if signature is not None:
+                self.remove(old_key)
+                self.add(new_key, signature)
+
+    def find_duplicate(self, signature: List[int]) -> Optional[Hashable]:
+        """推定類似度がしきい値以上で最も近い登録済みのキーを返します。"""
+        with self._lock:
+            candidates = set()
+            for band_key in self._band_keys(signature):
+                candidates |= self.buckets.get(band_key, set())
+
+            best_key = None
+            best_similarity = self.threshold
+            for key in candidates:
+                similarity = estimate_similarity(signature, self.signatures[key])
+                if similarity >= best_similarity:
+                    best_key, best_similarity = key, similarity
+            return best_key
+
+
+def load_near_duplicate_index(
+    threshold: float = DUPLICATE_THRESHOLD, batch_size: int = 500
+) -> NearDuplicateIndex:
+    """データベースの代表コードの署名からLSHインデックスを作成します。
+
+    署名が未作成の埋め込み済みコードは、先に署名を計算して保存します。
+    """
+    create_database()
+    after_id = 0
+    while True:
+        rows = get_codes_without_minhash(after_id, batch_size)
+        if not rows:
+            break
+        save_minhash_signatures(
+            [
+                (code_id, signature_to_bytes(minhash_signature(code)), code_id)
+                for code_id, code in rows
+            ]
+        )
+        after_id = rows[-1][0]
+
+    index = NearDuplicateIndex(threshold=threshold)
+    for code_id, data in get_minhash_signatures():
+        index.add(code_id, signature_from_bytes(data))
+    return index
+
+
+def collapse_near_duplicates(
+    candidates: List[Dict], top_n: int, threshold: float = DUPLICATE_THRESHOLD
+) -> List[Dict]:
+    """類似度順の検索結果から近似重複を取り除き、上位top_n件を返します。
+
+    Args:
+        candidates: 類似度の高い順に並んだ "code" を含む候補のリスト
+        top_n: 返す候補の数
+        threshold: 近似重複とみなす推定Jaccard類似度
+
+    Returns:
+        List[Dict]: 互いに近似重複でない候補のリスト
+    """
+    kept = []
+    kept_signatures = []
+    for candidate in candidates:
+        if not candidate.get("code"):
+            continue
+        signature = minhash_signature(candidate["code"])
+        if any(
+            estimate_similarity(signature, other) >= threshold
+            for other in kept_signatures
+        ):
+            continue
+        kept.append(candidate)
+        kept_signatures.append(signature)
+        if len(kept) >= top_n:
+            break
+    return kept
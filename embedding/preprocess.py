@@ -0,0 +1,397 @@
+"""埋め込みAPIに送る前のコードの前処理。
+
+コメント・docstring・Markdownのコードフェンスを取り除き、空白と関数内の
+ローカル変数名を正規化してから、トークン数の上限に切り詰めます。
+
+取り込み時と検索時で同じ前処理をしないとベクトルを比較できないため、
+コーパスの埋め込みを作った前処理の形式（input format）を corpus_meta に記録し、
+どちらもその形式に従います。
+"""
+
+import ast
+import io
+import re
+import tokenize
+from collections import deque
+from typing import Dict, List, Optional, Set, Tuple
+
+from database.code_repository import (
+    get_codes_page,
+    get_embedding_input_format,
+    has_embeddings,
+    set_embedding_input_format,
+    update_embedding,
+)
+from database.connection import create_database
+
+# 前処理をしない（この仕組みを導入する前に作られたコーパスの形式）
+RAW_FORMAT = "raw"
+NORMALIZED_FORMAT_PREFIX = "normalized-v1"
+DEFAULT_MAX_TOKENS = 2048
+
+_TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+_FENCE_PATTERN = re.compile(r"^\s*```[\w+-]*\s*$", re.MULTILINE)
+
+
+def input_format_name(max_tokens: int = DEFAULT_MAX_TOKENS) -> str:
+    """前処理の形式名を返します。"""
+    return f"{NORMALIZED_FORMAT_PREFIX}/{max_tokens}"
+
+
+def parse_input_format(input_format: str) -> Tuple[bool, int]:
+    """形式名を (正規化するかどうか, トークン数の上限) に変換します。上限0は切り詰めなし。"""
+    if input_format == RAW_FORMAT:
+        return False, 0
+    prefix, _, max_tokens = input_format.partition("/")
+    if prefix != NORMALIZED_FORMAT_PREFIX:
+        raise ValueError(f"Unknown embedding input format: {input_format}")
+    return True, int(max_tokens or 0)
+
+
+def count_tokens(text: str) -> int:
+    """単語と記号を1トークンとして数えた、おおよそのトークン数を返します。"""
+    return sum(1 for _ in _TOKEN_PATTERN.finditer(text))
+
+
+def truncate_tokens(text: str, max_tokens: int) -> str:
+    """おおよそのトークン数が max_tokens を超えないよう、末尾を切り詰めます。"""
+    if max_tokens <= 0:
+        return text
+    for i, match in enumerate(_TOKEN_PATTERN.finditer(text)):
+        if i == max_tokens:
+            return text[: match.start()].rstrip()
+    return text
+
+
+def strip_markdown_fences(code: str) -> str:
+    """コード生成の出力に残った ```python などのフェンス行を取り除きます。"""
+    return _FENCE_PATTERN.sub("", code).strip()
+
+
+def _strip_docstring(node: ast.AST) -> None:
+    body = node.body
+    if (
+        body
+        and isinstance(body[0], ast.Expr)
+        and isinstance(body[0].value, ast.Constant)
+        and isinstance(body[0].value.value, str)
+    ):
+        body.pop(0)
+        if not body:
+            body.append(ast.Pass())
+
+
+_FUNCTION_NODES = (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda)
+_COMPREHENSION_NODES = (ast.ListComp, ast.SetComp, ast.GeneratorExp, ast.DictComp)
+
+
+def _scope_bindings(nodes) -> Tuple[List[str], Set[str], Set[str]]:
+    """スコープの本体で代入される名前と global / nonlocal で宣言された名前を返します。
+
+    入れ子の関数・ラムダ・クラス・内包表記は別のスコープなので中に入りません。
+    ただし内包表記の := で代入される名前は外側のスコープに属します。
+
+    Returns:
+        Tuple[List[str], Set[str], Set[str]]: (出現順の代入される名前, global の名前, nonlocal の名前)
+    """
+    assigned = []
+    global_names = set()
+    nonlocal_names = set()
+    todo = deque(nodes)
+    while todo:
+        node = todo.popleft()
+        if isinstance(node, ast.Name) and isinstance(node.ctx, ast.Store):
+            if node.id not in assigned:
+                assigned.append(node.id)
+        elif isinstance(node, ast.Global):
+            global_names.update(node.names)
+        elif isinstance(node, ast.Nonlocal):
+            nonlocal_names.update(node.names)
+        elif isinstance(node, _COMPREHENSION_NODES):
+            for child in ast.walk(node):
+                if isinstance(child, ast.NamedExpr) and child.target.id not in assigned:
+                    assigned.append(child.target.id)
+            continue
+        elif isinstance(node, _FUNCTION_NODES + (ast.ClassDef,)):
+            # デコレータと引数のデフォルト値は外側のスコープで評価される
+            if isinstance(node, ast.ClassDef):
+                todo.extend(node.decorator_list + node.bases + node.keywords)
+            else:
+                todo.extend(getattr(node, "decorator_list", []))
+                todo.extend(d for d in node.args.defaults + node.args.kw_defaults if d)
+            continue
+        todo.extend(ast.iter_child_nodes(node))
+    return assigned, global_names, nonlocal_names
+
+
+class _LocalRenamer(ast.NodeTransformer):
+    """関数内で代入されるローカル変数の名前を出現順に v0, v1, ... に置き換えます。
+
+    関数名・引数名・属性名・グローバル変数・クラス変数は意味を持つため変更しません。
+    関数・ラムダ・内包表記はそれぞれ別のスコープとして名前を割り当て、外側の
+    ローカル変数を参照する名前（クロージャ）は外側と同じ名前に置き換えます。
+    新しい名前は、元のコードに現れる名前と重ならない番号を選びます。
+    """
+
+    def __init__(self, tree: ast.AST):
+        # (元の名前 → 新しい名前, クラスの本体かどうか) のスタック
+        self.scopes = [({}, False)]
+        # 関数ごとに内包表記の変数へ割り当てた名前（同じ変数名には同じ名前を使う）
+        self.comprehension_names = []
+        self.reserved = set()
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Name):
+                self.reserved.add(node.id)
+            elif isinstance(node, ast.arg):
+                self.reserved.add(node.arg)
+            elif isinstance(
+                node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)
+            ):
+                self.reserved.add(node.name)
+            elif isinstance(node, ast.alias):
+                self.reserved.add((node.asname or node.name).partition(".")[0])
+            elif isinstance(node, (ast.Global, ast.Nonlocal)):
+                self.reserved.update(node.names)
+
+    def _new_name(self, mapping, extra=()) -> str:
+        taken = set(mapping.values()) | set(extra)
+        index = len(taken)
+        while f"v{index}" in self.reserved or f"v{index}" in taken:
+            index += 1
+        return f"v{index}"
+
+    def _enclosing(self) -> Dict[str, str]:
+        # クラスの本体の名前は入れ子の関数や内包表記からは見えない
+        for mapping, is_class in reversed(self.scopes):
+            if not is_class:
+                return mapping
+        return {}
+
+    def _visit_scope(self, body, mapping, is_class=False) -> None:
+        self.scopes.append((mapping, is_class))
+        for node in body:
+            self.visit(node)
+        self.scopes.pop()
+
+    def _visit_function(self, node):
+        is_lambda = isinstance(node, ast.Lambda)
+        if not is_lambda:
+            _strip_docstring(node)
+            for decorator in node.decorator_list:
+                self.visit(decorator)
+            if node.returns is not None:
+                self.visit(node.returns)
+        self.visit(node.args)
+
+        body = [node.body] if is_lambda else node.body
+        params = {
+            arg.arg
+            for arg in node.args.posonlyargs + node.args.args + node.args.kwonlyargs
+        }
+        for arg in (node.args.vararg, node.args.kwarg):
+            if arg is not None:
+                params.add(arg.arg)
+        assigned, global_names, nonlocal_names = _scope_bindings(body)
+
+        mapping = dict(self._enclosing())
+        for name in params | global_names:
+            mapping.pop(name, None)
+        for name in assigned:
+            if name not in params and name not in global_names | nonlocal_names:
+                mapping[name] = self._new_name(mapping)
+        self.comprehension_names.append({})
+        self._visit_scope(body, mapping)
+        self.comprehension_names.pop()
+        return node
+
+    visit_FunctionDef = _visit_function
+    visit_AsyncFunctionDef = _visit_function
+    visit_Lambda = _visit_function
+
+    def visit_ClassDef(self, node):
+        _strip_docstring(node)
+        for child in node.decorator_list + node.bases + node.keywords:
+            self.visit(child)
+        # クラス変数は属性名なので変更しない
+        assigned, _, _ = _scope_bindings(node.body)
+        mapping = dict(self.scopes[-1][0])
+        for name in assigned:
+            mapping.pop(name, None)
+        self._visit_scope(node.body, mapping, is_class=True)
+        return node
+
+    def _visit_comprehension(self, node):
+        if self._enclosing() is self.scopes[0][0]:
+            # モジュールレベルの内包表記の変数はこれまでどおり変更しない
+            return self.generic_visit(node)
+        first, *rest = node.generators
+        # 最初の for の反復対象は外側のスコープで評価される
+        self.visit(first.iter)
+        mapping = dict(self._enclosing())
+        names = self.comprehension_names[-1]
+        for generator in node.generators:
+            for child in ast.walk(generator.target):
+                if isinstance(child, ast.Name):
+                    new_name = names.get(child.id)
+                    if new_name is None or new_name in mapping.values():
+                        new_name = self._new_name(mapping, names.values())
+                        names[child.id] = new_name
+                    mapping[child.id] = new_name
+        elements = (
+            [node.key, node.value] if isinstance(node, ast.DictComp) else [node.elt]
+        )
+        self._visit_scope([first.target, *first.ifs, *rest, *elements], mapping)
+        return node
+
+    visit_ListComp = _visit_comprehension
+    visit_SetComp = _visit_comprehension
+    visit_GeneratorExp = _visit_comprehension
+    visit_DictComp = _visit_comprehension
+
+    def visit_Nonlocal(self, node):
+        mapping = self.scopes[-1][0]
+        node.names = [mapping.get(name, name) for name in node.names]
+        return node
+
+    def visit_Name(self, node):
+        new_name = self.scopes[-1][0].get(node.id)
+        if new_name is not None:
+            node.id = new_name
+        return node
+
+
+def _strip_comments(code: str) -> str:
+    """構文解析できないコードから tokenize でコメントだけを取り除きます。"""
+    lines = code.splitlines()
+    try:
+        for token in tokenize.generate_tokens(io.StringIO(code).readline):
+            if token.type == tokenize.COMMENT:
+                row, col = token.start
+                lines[row - 1] = lines[row - 1][:col]
+    except (tokenize.TokenError, IndentationError, SyntaxError):
+        pass
+    return "\n".join(line.rstrip() for line in lines if line.strip())
+
+
+def normalize_code(code: str) -> str:
+    """コメントとdocstringを取り除き、空白とローカル変数名を正規化したコードを返します。
+
+    構文解析できないコードや、入れ子が深すぎて構文木を処理できないコードは、
+    コメントと空行を取り除くだけにします。
+    """
+    code = strip_markdown_fences(code)
+    try:
+        tree = ast.parse(code)
+        _strip_docstring(tree)
+        tree = _LocalRenamer(tree).visit(tree)
+        return ast.unparse(tree)
+    except (SyntaxError, ValueError, RecursionError, MemoryError):
+        return _strip_comments(code)
+
+
+def prepare_embedding_input(code: str, input_format: str = RAW_FORMAT) -> str:
+    """形式に従ってコードを前処理し、埋め込みAPIに送るテキストを返します。"""
+    normalize, max_tokens = parse_input_format(input_format)
+    if not normalize:
+        return code
+    return truncate_tokens(normalize_code(code), max_tokens)
+
+
+def resolve_input_format(default: Optional[str] = None) -> str:
+    """コーパスの埋め込みを作った前処理の形式を返します。
+
+    記録がない場合、埋め込み済みのコードがあれば前処理導入前のコーパスとして RAW_FORMAT、
+    なければ default（省略時は input_format_name()）を記録して返します。
+    """
+    create_database()
+    input_format = get_embedding_input_format()
+    if input_format is None:
+        input_format = (
+            RAW_FORMAT if has_embeddings() else default or input_format_name()
+        )
+        set_embedding_input_format(input_format)
+    return input_format
+
+
+def token_report(input_format: str, batch_size: int = 500) -> Dict[str, int]:
+    """コーパスの全コードについて、前処理の前後のおおよそのトークン数を集計します。"""
+    report = {"codes": 0, "raw_tokens": 0, "prepared_tokens": 0, "truncated": 0}
+    _, max_tokens = parse_input_format(input_format)
+    after_id = 0
+    while True:
+        rows = get_codes_page(after_id, batch_size)
+        if not rows:
+            return report
+        for _, code in rows:
+            prepared = prepare_embedding_input(code, input_format)
+            report["codes"] += 1
+            report["raw_tokens"] += count_tokens(code)
+            prepared_tokens = count_tokens(prepared)
+            report["prepared_tokens"] += prepared_tokens
+            if max_tokens and prepared_tokens >= max_tokens:
+                report["truncated"] += 1
+        after_id = rows[-1][0]
+
+
+def reembed_corpus(input_format: str, bedrock_client, batch_size: int = 100) -> int:
+    """埋め込み済みの全コードを指定した形式の前処理で埋め込み直し、形式を記録します。
+
+    途中で失敗した場合は形式を記録しないため、再実行すると最初からやり直します。
+
+    Returns:
+        int: 埋め込み直したコードの数
+    """
+    create_database()
+    bedrock_client.input_format = input_format
+    count = 0
+    after_id = 0
+    while True:
+        rows = get_codes_page(after_id, batch_size, embedded_only=True)
+        if not rows:
+            break
+        for code_id, code in rows:
+            embedding = bedrock_client.get_embedding(code)
+            if not embedding or not update_embedding(code_id, embedding):
+                print(f"Failed to re-embed code ID: {code_id}")
+                return count
+            count += 1
+        after_id = rows[-1][0]
+        print(f"Re-embedded {count} codes")
+    set_embedding_input_format(input_format)
+    return count
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="埋め込み入力の前処理")
+    parser.add_argument(
+        "--max-tokens",
+        type=int,
+        default=DEFAULT_MAX_TOKENS,
+        help="前処理後に残すおおよそのトークン数（0の場合は切り詰めない）",
+    )
+    parser.add_argument(
+        "--reembed",
+        action="store_true",
+        help="コーパス全体をこの前処理で埋め込み直す（埋め込みAPIを呼び出します）",
+    )
+    args = parser.parse_args()
+
+    create_database()
+    input_format = input_format_name(args.max_tokens)
+    print(f"コーパスの形式: {resolve_input_format()}")
+    report = token_report(input_format)
+    saved = report["raw_tokens"] - report["prepared_tokens"]
+    print(
+        f"{input_format}: {report['codes']} 件のコード, "
+        f"{report['raw_tokens']} → {report['prepared_tokens']} トークン "
+        f"({saved / max(report['raw_tokens'], 1) * 100:.1f}% 削減), "
+        f"切り詰め {report['truncated']} 件"
+    )
+
+    if args.reembed:
+        from .api_client import BedrockClient
+
+        reembedded = reembed_corpus(input_format, BedrockClient())
+        print(f"{reembedded} 件のコードを {input_format} で埋め込み直しました")
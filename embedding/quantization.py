@@ -0,0 +1,298 @@
+"""埋め込みベクトルのint8量子化と2段階検索。
+
+1段目でint8に量子化したベクトルを走査して候補を絞り込み、2段目で候補のみ
+元の精度のベクトルを読み込んで類似度を計算し直します。
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database.code_repository import (
+    get_embeddings_by_ids,
+    get_quantized_embeddings,
+    get_unquantized_embeddings,
+    save_quantized_embeddings,
+)
+from database.connection import create_database
+
+# 1段目のスコア計算で一度にfloat32へ展開する行数
+SCAN_CHUNK_ROWS = 4096
+
+
+def quantize_int8(embedding: list) -> Tuple[float, bytes]:
+    """埋め込みベクトルを単位ベクトルに正規化してからint8に量子化します。
+
+    Args:
+        embedding: 量子化する埋め込みベクトル
+
+    Returns:
+        Tuple[float, bytes]: (スケール, int8ベクトルのバイト列)。scale * int8 で元の単位ベクトルを近似します
+    """
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    if norm > 0:
+        vector = vector / norm
+    max_abs = float(np.abs(vector).max()) if vector.size else 0.0
+    scale = max_abs / 127.0 if max_abs > 0 else 1.0
+    quantized = np.clip(np.rint(vector / scale), -127, 127).astype(np.int8)
+    return scale, quantized.tobytes()
+
+
+def sync_quantized_embeddings(batch_size: int = 500) -> int:
+    """量子化表現が未作成（または埋め込み更新で破棄済み）のコードについて量子化表現を保存します。
+
+    Returns:
+        int: 新たに量子化したコードの数
+    """
+    create_database()
+    count = 0
+    after_id = 0
+    while True:
+        code_embeddings = get_unquantized_embeddings(after_id, batch_size)
+        if not code_embeddings:
+            return count
+        rows = [
+            (code_id, *quantize_int8(embedding))
+            for code_id, embedding in code_embeddings
+        ]
+        if not save_quantized_embeddings(rows):
+            return count
+        count += len(rows)
+        after_id = code_embeddings[-1][0]
+
+
+class QuantizedIndex:
+    """int8量子化ベクトルによる1段目の走査と、元の精度での再スコアリングを行う検索インデックス。"""
+
+    def __init__(
+        self,
+        code_ids: np.ndarray,
+        scales: np.ndarray,
+        vectors: np.ndarray,
+        fetch_embeddings: Callable[
+            [List[int]], List[Tuple[int, list]]
+        ] = get_embeddings_by_ids,
+    ):
+        self.code_ids = code_ids
+        self.scales = scales
+        self.vectors = vectors
+        self.fetch_embeddings = fetch_embeddings
+
+    @classmethod
+    def load(cls) -> "QuantizedIndex":
+        """データベースから量子化表現を読み込みます。未作成の分は先に作成します。"""
+        created = sync_quantized_embeddings()
+        if created:
+            print(f"Quantized {created} embeddings")
+        rows = get_quantized_embeddings()
+        return cls.from_rows(rows)
+
+    @classmethod
+    def from_rows(
+        cls, rows: List[Tuple[int, float, bytes]], **kwargs
+    ) -> "QuantizedIndex":
+        """(コードID, スケール, int8ベクトルのバイト列) のリストからインデックスを作成します。"""
+        if not rows:
+            return cls(
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float32),
+                np.empty((0, 0), dtype=np.int8),
+                **kwargs,
+            )
+        code_ids = np.fromiter(
+            (row[0] for row in rows), dtype=np.int64, count=len(rows)
+        )
+        scales = np.fromiter(
+            (row[1] for row in rows), dtype=np.float32, count=len(rows)
+        )
+        vectors = np.vstack([np.frombuffer(row[2], dtype=np.int8) for row in rows])
+        return cls(code_ids, scales, vectors, **kwargs)
+
+    @classmethod
+    def from_embeddings(
+        cls, code_embeddings: List[Tuple[int, list]], **kwargs
+    ) -> "QuantizedIndex":
+        """(コードID, 埋め込みベクトル) のリストからインデックスを作成します。"""
+        rows = [
+            (code_id, *quantize_int8(embedding))
+            for code_id, embedding in code_embeddings
+        ]
+        return cls.from_rows(rows, **kwargs)
+
+    def __len__(self) -> int:
+        return len(self.code_ids)
+
+    def approximate_scores(self, target_embedding: list) -> np.ndarray:
+        """量子化ベクトルから全コードとのコサイン類似度の近似値を計算します。"""
+        target = np.asarray(target_embedding, dtype=np.float32)
+        norm = np.linalg.norm(target)
+        if norm > 0:
+            target = target / norm
+
+        scores = np.empty(len(self), dtype=np.float32)
+        # 一度に展開する行数を制限し、float32の一時配列がキャッシュに収まるようにする
+        for start in range(0, len(self), SCAN_CHUNK_ROWS):
+            chunk = self.vectors[start : start + SCAN_CHUNK_ROWS].astype(np.float32)
+            scores[start : start + SCAN_CHUNK_ROWS] = chunk @ target
+        return scores * self.scales
+
+    def candidates(self, target_embedding: list, count: int) -> List[int]:
+        """1段目の走査で近似類似度が上位のコードIDを返します。"""
+        if not len(self):
+            return []
+        scores = self.approximate_scores(target_embedding)
+        count = min(count, len(scores))
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [int(code_id) for code_id in self.code_ids[top]]
+
+    def subset(self, allowed_ids: np.ndarray) -> "QuantizedIndex":
+        """allowed_ids に含まれるコードだけのインデックスを返します。"""
+        mask = np.isin(self.code_ids, allowed_ids)
+        return QuantizedIndex(
+            self.code_ids[mask],
+            self.scales[mask],
+            self.vectors[mask],
+            self.fetch_embeddings,
+        )
+
+    def search(
+        self,
+        target_embedding: list,
+        top_n: int = 3,
+        rerank: int = 200,
+        allowed_ids: Optional[np.ndarray] = None,
+    ) -> List[Tuple[int, float]]:
+        """2段階検索で最も類似したコードを見つけます。
+
+        Args:
+            target_embedding: 検索対象の埋め込みベクトル
+            top_n: 返す類似コードの数
+            rerank: 元の精度で再スコアリングする候補の数
+            allowed_ids: 指定した場合は、このコードIDだけを類似度の計算の対象とする
+
+        Returns:
+            [(コードID, 類似度)]の形式で上位n個の類似コードのリスト
+        """
+        if allowed_ids is not None:
+            return self.subset(allowed_ids).search(target_embedding, top_n, rerank)
+        candidate_ids = self.candidates(target_embedding, max(rerank, top_n))
+        full_embeddings = self.fetch_embeddings(candidate_ids)
+        if not full_embeddings:
+            return []
+
+        target = np.asarray(target_embedding, dtype=np.float64)
+        matrix = np.asarray(
+            [embedding for _, embedding in full_embeddings], dtype=np.float64
+        )
+        norms = np.linalg.norm(matrix, axis=1) * np.linalg.norm(target)
+        norms[norms == 0] = 1.0
+        similarities = matrix @ target / norms
+
+        order = np.argsort(-similarities)[:top_n]
+        return [(full_embeddings[i][0], float(similarities[i])) for i in order]
+
+    def memory_report(self) -> Dict[str, float]:
+        """量子化表現と元の精度（float64）の場合のメモリ使用量を比較します。"""
+        rows, dim = self.vectors.shape if len(self) else (0, 0)
+        float64_bytes = rows * dim * 8
+        quantized_bytes = (
+            self.vectors.nbytes + self.scales.nbytes + self.code_ids.nbytes
+        )
+        return {
+            "rows": rows,
+            "dim": dim,
+            "float64_bytes": float64_bytes,
+            "quantized_bytes": quantized_bytes,
+            "saving_ratio": float64_bytes / quantized_bytes if quantized_bytes else 0.0,
+        }
+
+
+def recall_at_k(
+    index: QuantizedIndex,
+    code_embeddings: List[Tuple[int, list]],
+    k: int = 10,
+    rerank: int = 200,
+    num_queries: int = 100,
+    seed: Optional[int] = 0,
+) -> Dict[str, float]:
+    """コーパス内のベクトルを問い合わせとして、厳密検索に対する2段階検索のrecall@kを測定します。
+
+    問い合わせに使ったベクトル自身は厳密検索・2段階検索の両方の結果から除外します。
+
+    Args:
+        index: 評価するインデックス
+        code_embeddings: (コードID, 埋め込みベクトル)のタプルのリスト（厳密検索に使用）
+        k: 比較する上位件数
+        rerank: 2段階検索で再スコアリングする候補の数
+        num_queries: 問い合わせに使うベクトルの数
+        seed: 問い合わせを選ぶ乱数のシード
+
+    Returns:
+        Dict[str, float]: recall（2段階検索）と first_stage_recall（1段目のみ）
+    """
+    if len(code_embeddings) < 2:
+        return {"recall": 0.0, "first_stage_recall": 0.0, "queries": 0}
+
+    ids = np.asarray([code_id for code_id, _ in code_embeddings])
+    matrix = np.asarray(
+        [embedding for _, embedding in code_embeddings], dtype=np.float64
+    )
+    matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+
+    rng = np.random.default_rng(seed)
+    query_rows = rng.choice(len(ids), size=min(num_queries, len(ids)), replace=False)
+
+    hits = 0
+    first_stage_hits = 0
+    total = 0
+    for row in query_rows:
+        query_id = int(ids[row])
+        exact_scores = matrix @ matrix[row]
+        exact_order = [
+            int(ids[i]) for i in np.argsort(-exact_scores) if ids[i] != query_id
+        ]
+        exact = set(exact_order[:k])
+
+        approx = [
+            code_id
+            for code_id, _ in index.search(matrix[row], top_n=k + 1, rerank=rerank)
+            if code_id != query_id
+        ][:k]
+        first_stage = [
+            code_id
+            for code_id in index.candidates(matrix[row], k + 1)
+            if code_id != query_id
+        ][:k]
+
+        hits += len(exact & set(approx))
+        first_stage_hits += len(exact & set(first_stage))
+        total += len(exact)
+
+    return {
+        "recall": hits / total if total else 0.0,
+        "first_stage_recall": first_stage_hits / total if total else 0.0,
+        "queries": len(query_rows),
+    }
+
+
+if __name__ == "__main__":
+    from database.code_repository import get_embeddings
+
+    index = QuantizedIndex.load()
+    report = index.memory_report()
+    print("=== 量子化インデックスのメモリ使用量 ===")
+    print(f"コード数: {report['rows']}, 次元数: {report['dim']}")
+    print(f"float64: {report['float64_bytes'] / 1024 / 1024:.2f} MB")
+    print(f"int8: {report['quantized_bytes'] / 1024 / 1024:.2f} MB")
+    print(f"削減率: {report['saving_ratio']:.1f}倍")
+
+    print("\n=== 厳密検索に対するrecall@k ===")
+    code_embeddings = get_embeddings()
+    for k in (1, 3, 10):
+        result = recall_at_k(index, code_embeddings, k=k)
+        print(
+            f"recall@{k}: {result['recall']:.4f} "
+            f"(1段目のみ: {result['first_stage_recall']:.4f}, 問い合わせ数: {result['queries']})"
+        )
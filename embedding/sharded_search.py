@@ -0,0 +1,127 @@
+"""シャードに分割した埋め込みベクトルをワーカープロセスで並列に検索します。
+
+シャードはそれぞれ決まったワーカーが担当し、各ワーカーは担当するシャードの行列だけを
+一度読み込んでキャッシュし、部分的な上位k件を返します。親プロセスはそれらを
+マージして全体の上位k件を求めます。
+"""
+
+import heapq
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database.shards import count_shard, read_shard, shard_path
+
+# ワーカープロセスごとのシャード行列のキャッシュ: パス -> (ファイルの状態, ID, 正規化済み行列)
+_SHARD_CACHE: Dict[str, Tuple[Tuple[int, int, int], np.ndarray, np.ndarray]] = {}
+
+
+def _load_shard(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """シャードを読み込み、ファイルが更新されていなければキャッシュを返します。"""
+    stat = os.stat(path)
+    # 作り直したシャードは os.replace で差し替えられるため i-node も比較する
+    state = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+    cached = _SHARD_CACHE.get(path)
+    if cached and cached[0] == state:
+        return cached[1], cached[2]
+
+    rows = read_shard(path)
+    if rows:
+        ids = np.fromiter((row[0] for row in rows), dtype=np.int64, count=len(rows))
+        matrix = np.vstack([np.frombuffer(row[1], dtype=np.float32) for row in rows])
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+    else:
+        ids = np.empty(0, dtype=np.int64)
+        matrix = np.empty((0, 0), dtype=np.float32)
+    _SHARD_CACHE[path] = (state, ids, matrix)
+    return ids, matrix
+
+
+def search_shard(
+    path: str,
+    target_embedding: List[float],
+    top_n: int,
+    allowed_ids: Optional[np.ndarray] = None,
+) -> List[Tuple[float, int]]:
+    """1つのシャードで部分的な上位top_n件を計算します。
+
+    allowed_ids を指定した場合は、そのコードIDだけを類似度の計算の対象とします。
+
+    Returns:
+        List[Tuple[float, int]]: (類似度, コードID) のリスト
+    """
+    if not os.path.exists(path):
+        return []
+    ids, matrix = _load_shard(path)
+    if allowed_ids is not None:
+        mask = np.isin(ids, allowed_ids)
+        ids, matrix = ids[mask], matrix[mask]
+    if not len(ids):
+        return []
+
+    target = np.asarray(target_embedding, dtype=np.float32)
+    target /= max(float(np.linalg.norm(target)), 1e-12)
+    scores = matrix @ target
+    count = min(top_n, len(scores))
+    top = np.argpartition(-scores, count - 1)[:count]
+    return [(float(scores[i]), int(ids[i])) for i in top]
+
+
+class ShardedSearcher:
+    """シャードに分割された埋め込みベクトルを scatter-gather で検索します。
+
+    ワーカーはそれぞれ1プロセスのプールで、シャード i は常にワーカー i % workers が
+    検索します。各プロセスが保持する行列は担当するシャードの分だけになります。
+
+    検索は準備のスレッドやHTTPサーバーのスレッドから始まるため、スレッドを動かしている
+    プロセスを fork しないよう、ワーカーは forkserver（使えない環境では spawn）で起動します。
+    使い終わったら close() でワーカーを終了します。
+    """
+
+    def __init__(self, num_shards: int, workers: Optional[int] = None):
+        self.num_shards = num_shards
+        self.paths = [shard_path(shard, num_shards) for shard in range(num_shards)]
+        workers = workers or min(num_shards, os.cpu_count() or 1)
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context(
+            "forkserver" if "forkserver" in methods else "spawn"
+        )
+        self.executors = [
+            ProcessPoolExecutor(max_workers=1, mp_context=context)
+            for _ in range(workers)
+        ]
+
+    def search(
+        self,
+        target_embedding: list,
+        top_n: int = 3,
+        allowed_ids: Optional[np.ndarray] = None,
+    ) -> List[Tuple[int, float]]:
+        """全シャードを並列に検索し、部分的な上位k件をマージします。
+
+        Returns:
+            [(コードID, 類似度)]の形式で上位n個の類似コードのリスト
+        """
+        target = list(map(float, target_embedding))
+        futures = [
+            self.executors[shard % len(self.executors)].submit(
+                search_shard, path, target, top_n, allowed_ids
+            )
+            for shard, path in enumerate(self.paths)
+        ]
+        partials = [match for future in futures for match in future.result()]
+        return [
+            (code_id, similarity)
+            for similarity, code_id in heapq.nlargest(top_n, partials)
+        ]
+
+    def size(self) -> int:
+        """シャード全体のコード数を返します。"""
+        return sum(count_shard(path) for path in self.paths)
+
+    def close(self) -> None:
+        for executor in self.executors:
+            executor.shutdown()
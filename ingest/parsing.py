@@ -0,0 +1,188 @@
+import ast
+import cmath
+import json
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+
+def convert_complex_number(num: complex) -> Dict[str, float]:
+    """複素数をJSON シリアライズ可能な形式に変換します。
+
+    Args:
+        num: 変換する複素数
+
+    Returns:
+        Dict[str, float]: 実部と虚部を含む辞書
+    """
+    return {"real": num.real, "imag": num.imag}
+
+
+def convert_to_json_serializable(obj: Any) -> Any:
+    """オブジェクトをJSON シリアライズ可能な形式に変換します。
+
+    Args:
+        obj: 変換する対象のオブジェクト
+
+    Returns:
+        Any: JSON シリアライズ可能な形式に変換されたオブジェクト
+    """
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    elif isinstance(obj, complex):
+        return convert_complex_number(obj)
+    elif isinstance(obj, tuple):
+        return list(obj)
+    elif isinstance(obj, dict):
+        return {str(k): convert_to_json_serializable(v) for k, v in obj.items()}
+    elif isinstance(obj, list):
+        return [convert_to_json_serializable(x) for x in obj]
+    elif isinstance(obj, float) and (cmath.isinf(obj) or cmath.isnan(obj)):
+        return str(obj)
+    return obj
+
+
+def safe_json_dumps(obj: Any) -> str:
+    """オブジェクトを安全にJSONシリアライズします。
+
+    Args:
+        obj: シリアライズする対象のオブジェクト
+
+    Returns:
+        str: JSONシリアライズされた文字列
+    """
+    try:
+        return json.dumps(convert_to_json_serializable(obj))
+    except TypeError as e:
+        print(f"Error serializing object: {e}")
+        return json.dumps(str(obj))
+
+
+def find_test_literals(test_str: str) -> Tuple[Optional[ast.expr], Optional[ast.expr]]:
+    """テストコードのASTを走査し、inputs と results への代入式を探します。
+
+    Args:
+        test_str: テストコードを含む文字列
+
+    Returns:
+        Tuple[Optional[ast.expr], Optional[ast.expr]]: inputs と results の右辺のノード
+    """
+    inputs_node = None
+    results_node = None
+    for node in ast.walk(ast.parse(test_str)):
+        if not isinstance(node, ast.Assign):
+            continue
+        for target in node.targets:
+            if isinstance(target, ast.Name) and target.id == "inputs":
+                inputs_node = node.value
+            elif isinstance(target, ast.Name) and target.id == "results":
+                results_node = node.value
+    return inputs_node, results_node
+
+
+def parse_test_field(test_str: str) -> List[Tuple[Any, Any]]:
+    """テストフィールドからテストデータを抽出します。解析に失敗した場合は例外を送出します。
+
+    Args:
+        test_str: テストコードを含む文字列
+
+    Returns:
+        List[Tuple[Any, Any]]: (入力値, 期待される出力値)のタプルのリスト
+    """
+    inputs_node, results_node = find_test_literals(test_str)
+    if inputs_node is None or results_node is None:
+        return []
+
+    # 文字列を整形せずにノードを直接評価するので、文字列中の空白も保持される
+    inputs = ast.literal_eval(inputs_node)
+    results = ast.literal_eval(results_node)
+
+    # 入力と出力のペアを作成し、JSON シリアライズ可能な形式に変換
+    return [
+        (
+            convert_to_json_serializable(input_val),
+            convert_to_json_serializable(expected),
+        )
+        for input_val, expected in zip(inputs, results)
+    ]
+
+
+def extract_test_data_from_test_field(test_str: str) -> List[Tuple[Any, Any]]:
+    """テストフィールドからテストデータを抽出します。
+
+    Args:
+        test_str: テストコードを含む文字列
+
+    Returns:
+        List[Tuple[Any, Any]]: (入力値, 期待される出力値)のタプルのリスト
+    """
+    try:
+        return parse_test_field(test_str)
+    except Exception as e:
+        print(f"Error extracting test data: {e}")
+        return []
+
+
+def parse_problem(index: int, test_str: str) -> Dict[str, Any]:
+    """1問分のテストフィールドを解析し、保存用のテストケースに変換します。
+
+    プロセスプールのワーカーで実行されるため、例外は送出せず結果に含めて返します。
+
+    Args:
+        index: データセット内のサンプル番号
+        test_str: テストコードを含む文字列
+
+    Returns:
+        Dict[str, Any]: index, test_cases（JSON文字列のペア）, elapsed（経過時間の秒）,
+        cpu_seconds（ワーカーのCPU時間の秒）, error を含む辞書
+    """
+    start = time.perf_counter()
+    cpu_start = time.process_time()
+    test_cases = []
+    error = None
+    try:
+        test_cases = [
+            (safe_json_dumps(input_val), safe_json_dumps(expected))
+            for input_val, expected in parse_test_field(test_str)
+        ]
+        if not test_cases:
+            error = "inputs/results assignment not found"
+    except Exception as e:
+        error = f"{type(e).__name__}: {e}"
+    return {
+        "index": index,
+        "test_cases": test_cases,
+        "elapsed": time.perf_counter() - start,
+        "cpu_seconds": time.process_time() - cpu_start,
+        "error": error,
+    }
+
+
+def parse_problems_parallel(
+    problems: Iterable[Tuple[int, str]], workers: int = 0, max_pending: int = 0
+) -> Iterator[Dict[str, Any]]:
+    """複数の問題のテストフィールドをプロセスプールで並列に解析します。
+
+    同時に投入する問題数を max_pending に制限しているため、入力が
+    ジェネレータであっても全件をメモリに展開しません。結果は入力順に返します。
+
+    Args:
+        problems: (サンプル番号, テストコード) のタプルのイテレータ
+        workers: ワーカープロセス数（0の場合はCPUコア数）
+        max_pending: 同時に処理中にできる問題数（0の場合はworkersの4倍）
+
+    Yields:
+        Dict[str, Any]: parse_problem の結果
+    """
+    workers = workers or os.cpu_count() or 1
+    max_pending = max_pending or workers * 4
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for index, test_str in problems:
+            pending.append(executor.submit(parse_problem, index, test_str))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
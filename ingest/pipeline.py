@@ -0,0 +1,424 @@
+"""ストリーミング取り込みパイプライン。
+
+read → parse → embed → write の各ステージをジェネレータで連結し、
+データセット全体をメモリに展開せずにデータベースへ格納します。
+"""
+
+import json
+import queue
+import threading
+from typing import Any, Dict, Iterable, Iterator, List, Optional
+
+from database.batch_repository import store_code_batch
+from database.code_repository import get_code_hash_by_id, get_corpus_version
+from database.connection import code_content_hash, create_database
+from database.shards import (
+    export_embeddings_to_shards,
+    get_shards_version,
+    mark_shards_version,
+    write_sharded_embeddings,
+)
+from embedding.api_client import BedrockClient
+from embedding.preprocess import resolve_input_format
+from embedding.minhash import (
+    NearDuplicateIndex,
+    load_near_duplicate_index,
+    minhash_signature,
+    signature_to_bytes,
+)
+from profiling import memory
+from sandbox.signature import sync_signatures
+from .parsing import parse_problem, parse_problems_parallel
+
+DEFAULT_SOURCE = "evalplus/mbppplus"
+
+_SENTINEL = object()
+
+
+class PipelineStats(dict):
+    """パイプラインの統計情報。
+
+    各ステージは別々のスレッドで動くため、カウンタの更新は add でロックを取って行います。
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._lock = threading.Lock()
+
+    def add(self, key: str, amount: Any = 1) -> None:
+        """カウンタ key に amount を加算します。"""
+        with self._lock:
+            self[key] = self.get(key, 0) + amount
+
+
+def iter_samples(source: str = DEFAULT_SOURCE, split: str = "test") -> Iterator[Dict]:
+    """データソースからサンプルを1件ずつ読み込みます。
+
+    Args:
+        source: ローカルのJSONL/Parquetファイルのパス、またはHugging Faceのデータセット名
+        split: Hugging Faceのデータセットを使う場合のスプリット名
+
+    Yields:
+        Dict: "code" と "test" を含むサンプル
+    """
+    if source.endswith(".jsonl"):
+        with open(source, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+    elif source.endswith(".parquet"):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(source)
+        for record_batch in parquet_file.iter_batches(
+            batch_size=64, columns=["code", "test"]
+        ):
+            yield from record_batch.to_pylist()
+    else:
+        from datasets import load_dataset
+
+        yield from load_dataset(source, split=split, streaming=True)
+
+
+def parse_stage(
+    samples: Iterable[Dict],
+    stats: PipelineStats,
+    workers: int = 1,
+    report_path: Optional[str] = None,
+) -> Iterator[Dict]:
+    """サンプルのテストフィールドを解析し、テストデータ付きのレコードを生成します。
+
+    Args:
+        samples: iter_samples が返すサンプルのイテレータ
+        stats: 統計情報（parse_seconds に解析のCPU時間の合計を加算します）
+        workers: 解析に使うプロセス数（1の場合はメインプロセスで解析、0の場合はCPUコア数）
+        report_path: 問題ごとの解析時間と失敗理由をJSONLで書き出すファイルのパス
+    """
+    # 解析中の問題のコードだけを保持する（最大でも投入中の問題数まで）
+    codes = {}
+
+    def problems():
+        for i, sample in enumerate(samples):
+            stats.add("total_solutions")
+            if i % 10 == 0:
+                print(f"Processing example {i}")
+            codes[i] = sample["code"]
+            yield i, sample["test"]
+
+    if workers == 1:
+        results = (parse_problem(i, test_str) for i, test_str in problems())
+    else:
+        results = parse_problems_parallel(problems(), workers)
+
+    report = open(report_path, "w", encoding="utf-8") if report_path else None
+    try:
+        for result in results:
+            i = result["index"]
+            code = codes.pop(i)
+            stats.add("parse_seconds", result["cpu_seconds"])
+            if report:
+                report.write(
+                    json.dumps(
+                        {
+                            "index": i,
+                            "elapsed": result["elapsed"],
+                            "cpu_seconds": result["cpu_seconds"],
+                            "test_cases": len(result["test_cases"]),
+                            "error": result["error"],
+                        }
+                    )
+                    + "\n"
+                )
+
+            if result["error"]:
+                print(
+                    f"Failed to extract test data for example {i}: "
+                    f"{result['error']} ({result['elapsed']:.3f}s)"
+                )
+                stats.add("failed_solutions")
+                continue
+
+            yield {"index": i, "code": code, "test_cases": result["test_cases"]}
+    finally:
+        # 途中で閉じられた場合も解析用のプロセスプールを終了させる
+        results.close()
+        if report:
+            report.close()
+
+
+def dedup_stage(
+    records: Iterable[Dict], index: NearDuplicateIndex, stats: PipelineStats
+) -> Iterator[Dict]:
+    """MinHash署名を計算し、既に取り込んだコードの近似重複かどうかを判定します。
+
+    近似重複のレコードには canonical_hash（代表コードのハッシュ）を設定し、埋め込みの取得を
+    省略させます。近似重複でないレコードは、コードIDが確定するまでコードのハッシュ
+    （code_content_hash）をキーとして登録します。
+    """
+    for record in records:
+        signature = minhash_signature(record["code"])
+        record["signature"] = signature
+        record["code_hash"] = code_content_hash(record["code"])
+        record["canonical_hash"] = None
+
+        key = index.find_duplicate(signature)
+        if key is None:
+            index.add(record["code_hash"], signature)
+        else:
+            canonical_hash = key if isinstance(key, bytes) else get_code_hash_by_id(key)
+            if canonical_hash is None:
+                index.add(record["code_hash"], signature)
+            else:
+                record["canonical_hash"] = canonical_hash
+                stats.add("near_duplicates")
+        yield record
+
+
+def embed_stage(
+    records: Iterable[Dict],
+    bedrock_client: BedrockClient,
+    stats: PipelineStats,
+    index: Optional[NearDuplicateIndex] = None,
+) -> Iterator[Dict]:
+    """各レコードのコードの埋め込みベクトルを取得します。近似重複のレコードは取得しません。
+
+    代表コードの埋め込みの取得に失敗した場合、その近似重複のうち最初のレコードが
+    埋め込みを取得して代わりの代表コードになり、残りはそれを参照します。
+    """
+    # 埋め込みに失敗した代表コードのハッシュ → 代わりの代表コードのハッシュ（未定ならNone）
+    replacements: Dict[bytes, Optional[bytes]] = {}
+    for record in records:
+        canonical_hash = record.get("canonical_hash")
+        if canonical_hash in replacements:
+            canonical_hash = replacements[canonical_hash]
+            if canonical_hash is None:
+                replacements[record["canonical_hash"]] = record["code_hash"]
+                stats.add("near_duplicates", -1)
+                if index is not None:
+                    index.add(record["code_hash"], record["signature"])
+            record["canonical_hash"] = canonical_hash
+        if canonical_hash is not None:
+            record["embedding"] = None
+            yield record
+            continue
+
+        try:
+            embedding = bedrock_client.get_embedding(record["code"])
+        except Exception as e:
+            print(f"Error getting embedding for example {record['index']}: {e}")
+            embedding = None
+
+        if not embedding:
+            stats.add("failed_solutions")
+            # 保存されないコードを代表コードとして参照させない
+            if index is not None:
+                index.remove(record["code_hash"])
+                replacements[record["code_hash"]] = None
+            continue
+
+        record["embedding"] = embedding
+        yield record
+
+
+def batched(records: Iterable[Dict], batch_size: int) -> Iterator[List[Dict]]:
+    """レコードを最大batch_size件ずつのリストにまとめます。"""
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def prefetch(items: Iterable[Any], maxsize: int) -> Iterator[Any]:
+    """上流のイテレータを別スレッドで先読みします。
+
+    キューの大きさをmaxsizeに制限しているため、下流が詰まると上流は
+    put で待たされます（バックプレッシャー）。下流が途中で読むのをやめた場合や
+    例外が発生した場合は、先読みスレッドを止めてから上流のイテレータを close します。
+
+    Args:
+        items: 先読みするイテレータ
+        maxsize: キューに保持する最大件数
+
+    Yields:
+        Any: 上流から受け取った要素
+    """
+    buffer = queue.Queue(maxsize=maxsize)
+    stop = threading.Event()
+
+    def put(item) -> bool:
+        # 下流が読むのをやめた場合は待たずに諦める
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        try:
+            for item in items:
+                if not put(item):
+                    return
+            put(_SENTINEL)
+        except Exception as e:
+            put(e)
+
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = buffer.get()
+            if item is _SENTINEL:
+                break
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        # 先読みスレッドが上流を進めている間は close できないため、止まるのを待つ
+        thread.join()
+        close = getattr(items, "close", None)
+        if close is not None:
+            close()
+
+
+def write_stage(
+    batches: Iterable[List[Dict]],
+    stats: PipelineStats,
+    index: Optional[NearDuplicateIndex] = None,
+    shards: int = 0,
+) -> None:
+    """バッチ単位でコード・埋め込み・テストケースをデータベースに書き込みます。
+
+    shards が指定されている場合は、埋め込みベクトルを各シャードにも並列に書き込みます。
+    """
+    for batch in batches:
+        code_ids = store_code_batch(
+            [
+                (
+                    record["code"],
+                    record["embedding"],
+                    record["test_cases"],
+                    (
+                        signature_to_bytes(record["signature"])
+                        if "signature" in record
+                        else None
+                    ),
+                    record.get("canonical_hash"),
+                )
+                for record in batch
+            ]
+        )
+        for record, code_id in zip(batch, code_ids):
+            if code_id:
+                stats.add("successful_solutions")
+                stats.add("successful_test_cases")
+            else:
+                stats.add("failed_solutions")
+
+            # 書き込みが終わった代表コードはコードIDをキーに付け替える
+            if index is not None and record.get("canonical_hash") is None:
+                if code_id:
+                    index.rename(record["code_hash"], code_id)
+                else:
+                    index.remove(record["code_hash"])
+
+        if shards:
+            write_sharded_embeddings(
+                [
+                    (code_id, record["embedding"])
+                    for record, code_id in zip(batch, code_ids)
+                    if code_id and record["embedding"] is not None
+                ],
+                shards,
+            )
+
+
+def run_streaming_ingest(
+    source: str = DEFAULT_SOURCE,
+    split: str = "test",
+    batch_size: int = 32,
+    queue_size: int = 64,
+    parse_workers: int = 1,
+    parse_report: Optional[str] = None,
+    dedup: bool = True,
+    shards: int = 0,
+) -> Dict[str, Any]:
+    """データセットをストリーミングで読み込み、データベースに格納します。
+
+    保持するのは各ステージ間のキューと書き込み中のバッチのみなので、
+    メモリ使用量はデータセットの大きさに依存しません。
+
+    Args:
+        source: 読み込むデータソース（iter_samples を参照）
+        split: Hugging Faceのデータセットを使う場合のスプリット名
+        batch_size: 1トランザクションで書き込むレコード数
+        queue_size: ステージ間のキューに保持する最大レコード数
+        parse_workers: テストフィールドの解析に使うプロセス数（0の場合はCPUコア数）
+        parse_report: 問題ごとの解析時間をJSONLで書き出すファイルのパス
+        dedup: 近似重複のコードの埋め込み取得を省略するかどうか
+        shards: 埋め込みベクトルを書き込むシャード数（0の場合はシャードに書き込まない）
+
+    Returns:
+        Dict[str, Any]: 処理結果の統計情報
+    """
+    stats = PipelineStats(
+        total_solutions=0,
+        successful_solutions=0,
+        failed_solutions=0,
+        successful_test_cases=0,
+        parse_seconds=0.0,
+        near_duplicates=0,
+    )
+
+    try:
+        print("Initializing database...")
+        create_database()
+
+        if shards and get_shards_version(shards) != get_corpus_version():
+            print(f"Rebuilding {shards} embedding shards...")
+            with memory.stage("rebuild_shards"):
+                export_embeddings_to_shards(shards)
+
+        print(f"Streaming dataset from {source}...")
+        bedrock_client = BedrockClient(resolve_input_format())
+
+        # 下流から順に close できるよう、各ステージのジェネレータを保持する
+        stages = [
+            parse_stage(iter_samples(source, split), stats, parse_workers, parse_report)
+        ]
+        index = None
+        if dedup:
+            with memory.stage("dedup_index"):
+                index = load_near_duplicate_index()
+            stages.append(dedup_stage(stages[-1], index, stats))
+        stages.append(prefetch(stages[-1], queue_size))
+        stages.append(embed_stage(stages[-1], bedrock_client, stats, index))
+        stages.append(prefetch(stages[-1], queue_size))
+        try:
+            # 各ステージは並行して進むため、パイプライン全体を1つの区間として計測する
+            with memory.stage("pipeline"):
+                write_stage(batched(stages[-1], batch_size), stats, index, shards)
+        finally:
+            for stage in reversed(stages):
+                stage.close()
+        if shards:
+            mark_shards_version(shards, get_corpus_version())
+        # 引数の数による候補の絞り込みに使うシグネチャを作成する
+        with memory.stage("signatures"):
+            sync_signatures()
+
+        stats["tokens_saved"] = bedrock_client.tokens_saved
+        return stats
+    except Exception as e:
+        print(f"Error streaming dataset: {e}")
+        import traceback
+
+        traceback.print_exc()
+        return stats
@@ -1,24 +1,28 @@
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterator, List, Optional, Tuple
+import argparse
 import json
 import os
-from database import connection
-from database.code_repository import (
-    insert_code,
-    update_embedding,
-    get_code_by_id,
-    get_embeddings,
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from database.connection import create_database
+from database.result_repository import (
+    get_cached_result,
+    result_cache_key,
+    save_cached_result,
 )
-from database.test_repository import insert_test_case, get_test_cases
-from embedding.api_client import BedrockClient
 from embedding.gemini_client import GeminiClient
-from embedding.similarity import find_most_similar
+from profiling import memory, timeline
+from sandbox.executor import MAX_ACTUAL_OUTPUT_CHARS, execute_test_case, truncate_output
+from sandbox.pool import SANDBOX_ERROR_PREFIX, SandboxPool
+from service.client import DEFAULT_SERVICE_URL, SimilarityClient
+from service.query_cache import DEFAULT_MAX_ENTRIES, QueryResultCache, query_cache_key
 
 # from sample_codes import code_samples
 
 
 class CodeProcessor:
     def __init__(self):
-        self.bedrock_client = BedrockClient()
         self.gemini_client = GeminiClient()
 
     # def process_sample_code(self, code_data: Dict) -> Optional[int]:
@@ -45,7 +49,65 @@ class CodeProcessor:
     #     return None
 
 
+class ExecutionPolicy:
+    """テストスイートの実行を途中で打ち切るための方針。
+
+    Args:
+        max_failures: この件数だけ失敗したら打ち切る（0の場合は打ち切らない）
+        sample_size: まず入力の大きさで層別した標本をこの件数だけ実行し、
+            全て成功した場合のみ残りを実行する（0の場合は標本を使わない）
+        time_budget: 実行時間がこの秒数を超えたら打ち切る（0の場合は制限しない）
+    """
+
+    def __init__(
+        self, max_failures: int = 0, sample_size: int = 0, time_budget: float = 0.0
+    ):
+        self.max_failures = max_failures
+        self.sample_size = sample_size
+        self.time_budget = time_budget
+
+    def order(self, test_cases: List[Tuple[str, str]]) -> Tuple[List[int], List[int]]:
+        """テストケースを (標本, 残り) のインデックスに分けます。
+
+        入力の文字列長で並べたテストケースを sample_size 個の層に分け、
+        各層の中央のテストケースを標本とします。
+        """
+        if not self.sample_size or self.sample_size >= len(test_cases):
+            return list(range(len(test_cases))), []
+
+        by_size = sorted(range(len(test_cases)), key=lambda i: len(test_cases[i][0]))
+        stratum = len(by_size) / self.sample_size
+        sample = sorted(
+            by_size[int(stratum * k + stratum / 2)] for k in range(self.sample_size)
+        )
+        sampled = set(sample)
+        rest = [i for i in range(len(test_cases)) if i not in sampled]
+        return sample, rest
+
+
 class TestRunner:
+    def __init__(
+        self,
+        use_cache: bool = True,
+        force_rerun: bool = False,
+        sandbox: Optional[SandboxPool] = None,
+    ):
+        """
+        Args:
+            use_cache: テスト結果をキャッシュに保存し、同じコードとテストケースでは再利用するかどうか
+            force_rerun: キャッシュがあっても再実行するかどうか（結果はキャッシュに上書きされます）
+            sandbox: テストケースを実行するワーカープール（Noneの場合はこのプロセス内で実行）
+        """
+        self.use_cache = use_cache
+        self.force_rerun = force_rerun
+        self.sandbox = sandbox
+        self.cached_count = 0
+        self.executed_count = 0
+        self.stop_reason = None
+        self._count_lock = threading.Lock()
+        if use_cache:
+            create_database()
+
     @staticmethod
     def write_failed_test_case(
         code_id: int,
@@ -70,7 +132,56 @@ class TestRunner:
             f.write("\n")
 
     @staticmethod
+    def execute_test_case(
+        code: str, input_val: str, expected_output: str
+    ) -> Tuple[bool, str]:
+        """テストケースをこのプロセス内で実行し、(成功したかどうか, 実際の出力) を返します。"""
+        return execute_test_case(code, input_val, expected_output)
+
+    def probe_test_case(
+        self,
+        code: str,
+        input_val: str,
+        expected_output: str,
+        timeout: Optional[float] = None,
+    ) -> Tuple[bool, str]:
+        """テストケースを実行し、(成功したかどうか, 実際の出力) を返します。
+
+        同じコード・テストケース・インタプリタの結果がキャッシュにあれば、実行せずに返します。
+        失敗は記録しないため、候補の選別にも使えます。複数のスレッドから呼び出せます。
+        timeout はサンドボックスで実行する場合の実時間の上限です（プールの上限より短い場合のみ有効）。
+        """
+        key = None
+        cached = None
+        if self.use_cache:
+            key = result_cache_key(code, input_val, expected_output)
+            if not self.force_rerun:
+                cached = get_cached_result(*key)
+
+        if cached is not None:
+            with self._count_lock:
+                self.cached_count += 1
+            # 出力を切り詰める前に保存された結果もある
+            success, actual = cached
+            actual = truncate_output(actual, MAX_ACTUAL_OUTPUT_CHARS)
+        else:
+            with self._count_lock:
+                self.executed_count += 1
+            if self.sandbox is not None:
+                success, actual = self.sandbox.run(
+                    code, input_val, expected_output, timeout
+                )
+            else:
+                success, actual = self.execute_test_case(
+                    code, input_val, expected_output
+                )
+            # 時間切れやワーカーの異常終了はコードの結果ではないのでキャッシュしない
+            if key is not None and not actual.startswith(SANDBOX_ERROR_PREFIX):
+                save_cached_result(*key, success, actual)
+        return success, actual
+
     def run_test_case(
+        self,
         code: str,
         input_val: str,
         expected_output: str,
@@ -78,123 +189,612 @@ class TestRunner:
         question_name: str = "unknown",
     ) -> Tuple[bool, str]:
         """テストケースを実行します。失敗した場合は別ファイルに記録します。"""
-        try:
-            # コードをグローバル名前空間で実行
-            namespace = {}
-            exec(code, namespace)
-
-            # 関数名を取得（最初の関数定義を使用）
-            func_name = next(
-                (
-                    name
-                    for name, obj in namespace.items()
-                    if callable(obj) and name != "__builtins__"
-                ),
-                None,
+        success, actual = self.probe_test_case(code, input_val, expected_output)
+        self._record_failure(
+            code_id, input_val, expected_output, success, actual, question_name
+        )
+        return success, actual
+
+    @staticmethod
+    def _record_failure(
+        code_id: int,
+        input_val: str,
+        expected_output: str,
+        success: bool,
+        actual: str,
+        question_name: str,
+    ) -> None:
+        if not success and actual != "No function found in code":
+            TestRunner.write_failed_test_case(
+                code_id, input_val, expected_output, actual, question_name
             )
-            if not func_name:
-                return False, "No function found in code"
-
-            # 入力値を引数リストに変換
-            import ast
-
-            try:
-                args = ast.literal_eval(input_val)
-                if not isinstance(args, list):
-                    args = [args]
-            except:
-                args = [input_val]
-
-            # 期待される出力を評価
-            try:
-                expected = ast.literal_eval(expected_output)
-            except:
-                expected = expected_output
-
-            # 関数を実行
-            actual = namespace[func_name](*args)
-
-            # タプルとリストを同等とみなす比較
-            if isinstance(actual, (list, tuple)) and isinstance(
-                expected, (list, tuple)
-            ):
-                success = list(actual) == list(expected)
-            else:
-                success = actual == expected
 
-            if not success:
-                TestRunner.write_failed_test_case(
-                    code_id, input_val, expected_output, str(actual), question_name
+    def run_test_suite(
+        self,
+        code: str,
+        test_cases: List[Tuple[str, str]],
+        code_id: int,
+        question_name: str = "unknown",
+        policy: Optional[ExecutionPolicy] = None,
+    ) -> Iterator[Tuple[str, str, bool, str]]:
+        """テストスイートを実行し、結果を1件ずつ返します。
+
+        policy に従って途中で打ち切った場合は、その理由を stop_reason に設定します。
+        time_budget がある場合、サンドボックスで実行するテストケースには残り時間を
+        実時間の上限として渡し、予算を使い切った時点で実行中のテストケースも打ち切ります
+        （打ち切ったテストケースは結果に含めません）。
+        cached_count と executed_count は、プローブなど以前の実行の件数を含めないよう
+        このスイートの開始時に0に戻します。
+
+        Yields:
+            Tuple[str, str, bool, str]: (入力値, 期待される出力, 成功したかどうか, 実際の出力)
+        """
+        policy = policy or ExecutionPolicy()
+        self.stop_reason = None
+        with self._count_lock:
+            self.cached_count = 0
+            self.executed_count = 0
+        sample, rest = policy.order(test_cases)
+        start = time.monotonic()
+        failures = 0
+
+        for phase, indices in (("sample", sample), ("rest", rest)):
+            if phase == "rest" and rest and failures:
+                self.stop_reason = (
+                    f"標本の{len(sample)}件中{failures}件が失敗したため、"
+                    "残りのテストケースを実行しませんでした"
                 )
-            return success, str(actual)
+                return
+            for i in indices:
+                remaining = None
+                if policy.time_budget:
+                    remaining = policy.time_budget - (time.monotonic() - start)
+                    if remaining <= 0:
+                        self.stop_reason = (
+                            f"実行時間が{policy.time_budget}秒を超えました"
+                        )
+                        return
 
-        except Exception as e:
-            error_message = f"Error: {str(e)}"
-            TestRunner.write_failed_test_case(
-                code_id, input_val, expected_output, error_message, question_name
+                input_val, expected_output = test_cases[i]
+                success, actual = self.probe_test_case(
+                    code, input_val, expected_output, remaining
+                )
+                if (
+                    remaining is not None
+                    and actual.startswith(SANDBOX_ERROR_PREFIX)
+                    and time.monotonic() - start >= policy.time_budget
+                ):
+                    # 予算の残り時間で打ち切られたテストケースはコードの失敗として扱わない
+                    self.stop_reason = f"実行時間が{policy.time_budget}秒を超えました"
+                    return
+                self._record_failure(
+                    code_id, input_val, expected_output, success, actual, question_name
+                )
+                yield input_val, expected_output, success, actual
+
+                if not success:
+                    failures += 1
+                    if policy.max_failures and failures >= policy.max_failures:
+                        self.stop_reason = f"{failures}件失敗したため打ち切りました"
+                        return
+
+
+class StreamingResultReporter:
+    """テスト結果を受け取るたびに表示し、件数だけを保持するレポーター。
+
+    結果のリストを保持しないため、メモリ使用量と最初の表示までの時間は
+    テストスイートの大きさに依存しません。
+
+    Args:
+        total: テストケースの総数（進捗の表示に使用）
+        sample_limit: 詳細を表示するテストケースの数
+        max_output_chars: 表示・書き出しする入力値と出力の最大文字数（0の場合は切り詰めない）
+        jsonl_path: 指定した場合は、結果を1件ずつJSONL形式で書き出すファイル
+    """
+
+    def __init__(
+        self,
+        total: int,
+        sample_limit: int = 3,
+        max_output_chars: int = 200,
+        jsonl_path: Optional[str] = None,
+    ):
+        self.total = total
+        self.sample_limit = sample_limit
+        self.max_output_chars = max_output_chars
+        self.count = 0
+        self.passed = 0
+        self._jsonl = open(jsonl_path, "w", encoding="utf-8") if jsonl_path else None
+
+    def add(
+        self, input_val: str, expected_output: str, success: bool, actual: str
+    ) -> None:
+        """1件の結果を表示し、件数を更新します。"""
+        self.count += 1
+        if success:
+            self.passed += 1
+        print(f"[{self.count}/{self.total}] {'✓ Pass' if success else '✗ Fail'}")
+
+        if self.count <= self.sample_limit:
+            if self.count == 1:
+                print(f"\n=== テスト実行結果 ({self.sample_limit}つのサンプル) ===")
+            print(f"\nテストケース {self.count}:")
+            print(f"入力値: {truncate_output(input_val, self.max_output_chars)}")
+            print(
+                f"期待される出力: "
+                f"{truncate_output(expected_output, self.max_output_chars)}"
             )
-            return False, error_message
+            print(f"実際の出力: {truncate_output(actual, self.max_output_chars)}")
+            print(f"結果: {'✓ Pass' if success else '✗ Fail'}\n")
 
+        if self._jsonl is not None:
+            record = {
+                "index": self.count,
+                "input": truncate_output(input_val, self.max_output_chars),
+                "expected_output": truncate_output(
+                    expected_output, self.max_output_chars
+                ),
+                "actual_output": truncate_output(actual, self.max_output_chars),
+                "success": success,
+            }
+            self._jsonl.write(json.dumps(record, ensure_ascii=False) + "\n")
+            self._jsonl.flush()
 
-class TestResultFormatter:
-    @staticmethod
-    def format_test_results(
-        test_results: List[Tuple[str, str, bool, str]], limit: int = 3
-    ) -> str:
-        """テスト結果を整形します。"""
-        total_tests = len(test_results)
-        passed_tests = sum(1 for _, _, success, _ in test_results if success)
-        pass_rate = (passed_tests / total_tests * 100) if total_tests > 0 else 0
-
-        output = ["\n=== テスト実行結果 (3つのサンプル) ==="]
-        for i, (input_val, expected, success, actual) in enumerate(
-            test_results[:limit], 1
-        ):
-            output.extend(
-                [
-                    f"\nテストケース {i}:",
-                    f"入力値: {input_val}",
-                    f"期待される出力: {expected}",
-                    f"実際の出力: {actual}",
-                    f"結果: {'✓ Pass' if success else '✗ Fail'}",
-                ]
+    def summary(self, cache_stats: Optional[Dict[str, int]] = None) -> str:
+        """これまでの結果のサマリーを返します。"""
+        pass_rate = (self.passed / self.count * 100) if self.count > 0 else 0
+        output = [
+            "\n=== テスト結果サマリー ===",
+            f"テスト成功: {self.passed}/{self.count}",
+            f"成功率: {pass_rate:.1f}%",
+        ]
+        if cache_stats is not None:
+            output.append(
+                f"キャッシュ利用: {cache_stats['cached']}件 / "
+                f"実行: {cache_stats['executed']}件"
             )
+        return "\n".join(output)
+
+    def close(self) -> None:
+        if self._jsonl is not None:
+            self._jsonl.close()
+            self._jsonl = None
+
+
+class SearchResources:
+    """生成コードに依存しない検索の準備（サービスの確認、依存関係の読み込み、
+    埋め込みクライアントの作成、コーパスの読み込み）をまとめたクラス。
 
-        output.extend(
-            [
-                f"\n=== テスト結果サマリー ===",
-                f"テスト成功: {passed_tests}/{total_tests}",
-                f"成功率: {pass_rate:.1f}%",
-            ]
+    start() でバックグラウンドのスレッドで準備を始めておくと、コード生成と並行して
+    準備が進み、検索までの時間が max(生成, 準備) + 埋め込み + 検索 に縮まります。
+    start() を呼ばずに wait() を呼んだ場合は、そこで準備を始めて完了を待ちます。
+    準備のスレッドはデーモンスレッドで、検索せずに終了する場合は cancel() で
+    残りの準備を打ち切れます。プロセスの終了を準備の完了まで待たせることはありません。
+
+    Args:
+        quantized, rerank, shards: WarmCorpus に渡す検索方式（検索時の引数と同じ値にします）
+        service_url: 常駐サービスのURL。応答があればコーパスは読み込みません
+    """
+
+    def __init__(
+        self,
+        quantized: bool = False,
+        rerank: int = 200,
+        shards: int = 0,
+        service_url: Optional[str] = None,
+    ):
+        self.quantized = quantized
+        self.rerank = rerank
+        self.shards = shards
+        self.service_url = service_url
+        self.service_available = False
+        self.bedrock_client = None
+        self.corpus = None
+        self._future = None
+        self._lock = threading.Lock()
+        self._cancelled = threading.Event()
+
+    def start(self) -> "SearchResources":
+        """バックグラウンドのスレッドで準備を始めます。"""
+        self._future = Future()
+        # ThreadPoolExecutor のスレッドは終了時に待ち合わせられるため、デーモンスレッドにする
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+        return self
+
+    def close(self) -> None:
+        """残りの準備を打ち切り、読み込んだコーパスのワーカープロセスを終了します。"""
+        self.cancel()
+        with self._lock:
+            if self.corpus is not None:
+                self.corpus.close()
+                self.corpus = None
+
+    def cancel(self) -> None:
+        """まだ始めていない準備の手順を打ち切ります（実行中の手順は最後まで進みます）。"""
+        self._cancelled.set()
+
+    def _run(self) -> None:
+        if not self._future.set_running_or_notify_cancel():
+            return
+        try:
+            self._prepare()
+        except BaseException as e:
+            self._future.set_exception(e)
+        else:
+            self._future.set_result(None)
+
+    def wait(self) -> "SearchResources":
+        """準備の完了を待ちます。準備中に発生した例外はここで送出されます。"""
+        if self._future is None:
+            self.start()
+        with timeline.stage("warmup.wait"):
+            self._future.result()
+        return self
+
+    def _prepare(self) -> None:
+        with memory.stage("warmup"), timeline.stage("warmup"):
+            if self.service_url:
+                with timeline.stage("warmup.service"):
+                    self.service_available = (
+                        SimilarityClient(self.service_url).health() is not None
+                    )
+                if self.service_available or self._cancelled.is_set():
+                    return
+                print(f"Similarity service unavailable ({self.service_url})")
+            self.load_local()
+
+    def load_local(self) -> None:
+        """プロセス内で検索するための埋め込みクライアントとコーパスを用意します。"""
+        with self._lock:
+            if self.corpus is not None:
+                return
+            # 重い依存関係はサービスを使わない場合にのみ読み込む
+            with timeline.stage("warmup.imports"):
+                from embedding.api_client import BedrockClient
+                from embedding.preprocess import resolve_input_format
+                from service.corpus import WarmCorpus
+            with timeline.stage("warmup.clients"):
+                self.bedrock_client = BedrockClient(resolve_input_format())
+            if self._cancelled.is_set():
+                return
+            with timeline.stage("warmup.corpus"):
+                corpus = WarmCorpus(
+                    quantized=self.quantized, rerank=self.rerank, shards=self.shards
+                )
+                corpus.refresh()
+                self.corpus = corpus
+
+
+def find_similar_candidates(
+    code: str,
+    top_n: int = 3,
+    quantized: bool = False,
+    rerank: int = 200,
+    service_url: Optional[str] = None,
+    shards: int = 0,
+    signature_filter: bool = True,
+    query_cache: Optional[QueryResultCache] = None,
+    resources: Optional[SearchResources] = None,
+) -> Optional[List[Dict]]:
+    """類似コードとそのテストケースを取得します。
+
+    service_url が指定されていれば常駐サービスに問い合わせ、接続できない場合は
+    このプロセス内でコーパスを読み込んで検索します。signature_filter が True の場合は、
+    テスト入力の引数の数で code の関数を呼び出せない候補を類似度の計算の前に除外します。
+    query_cache を指定すると、コーパスが変わっていない間は同じ検索の結果を再利用し、
+    埋め込みAPIの呼び出しと検索を省略します。resources を指定すると、
+    先に準備を始めておいたクライアントとコーパスを使います。
+
+    Returns:
+        Optional[List[Dict]]: code_id, similarity, code, test_cases を含む候補のリスト。
+        コーパスが空の場合はNone
+    """
+    cache_key = cache_state = None
+    if query_cache is not None:
+        cache_key = query_cache_key(
+            code,
+            top_n,
+            quantized=quantized,
+            rerank=rerank,
+            shards=shards,
+            signature_filter=signature_filter,
         )
+        cache_state = query_cache.current_state()
+        cached = query_cache.get(cache_key, cache_state)
+        if cached is not None:
+            print("キャッシュされた検索結果を使用します")
+            return cached
 
-        return "\n".join(output)
+    own_resources = resources is None
+    if own_resources:
+        resources = SearchResources(
+            quantized=quantized,
+            rerank=rerank,
+            shards=shards,
+            service_url=service_url,
+        )
+    try:
+        candidates = _search_similar_candidates(
+            code, top_n, service_url, signature_filter, resources
+        )
+    finally:
+        if own_resources:
+            resources.close()
+    if query_cache is not None and candidates is not None:
+        query_cache.put(cache_key, cache_state, candidates)
+    return candidates
+
+
+def _search_similar_candidates(
+    code: str,
+    top_n: int,
+    service_url: Optional[str],
+    signature_filter: bool,
+    resources: SearchResources,
+) -> Optional[List[Dict]]:
+    resources.wait()
+    if resources.service_available:
+        with timeline.stage("search"):
+            response = SimilarityClient(service_url).search(
+                code,
+                top_n=top_n,
+                signature_filter=signature_filter,
+                quantized=resources.quantized,
+                rerank=resources.rerank,
+                shards=resources.shards,
+            )
+        if response is not None:
+            return response["candidates"]
+        print("プロセス内で検索します")
+        resources.load_local()
+
+    from service.corpus import compatible_code_ids, search_candidates
+
+    with timeline.stage("filter"):
+        allowed_ids = compatible_code_ids(code) if signature_filter else None
+    if allowed_ids is not None and not len(allowed_ids):
+        # 呼び出せる候補がなければ埋め込みも計算しない
+        return []
+    bedrock_client = resources.bedrock_client
+    with timeline.stage("embed"):
+        code_embedding = bedrock_client.get_embedding(code)
+    if bedrock_client.tokens_saved:
+        print(
+            f"埋め込み入力の前処理で {bedrock_client.tokens_saved} トークン削減しました"
+        )
+    with timeline.stage("search"):
+        return search_candidates(
+            resources.corpus, code_embedding, top_n=top_n, allowed_ids=allowed_ids
+        )
+
+
+def rank_candidates_by_probes(
+    code: str,
+    candidates: List[Dict],
+    test_runner: TestRunner,
+    probe_size: int = 3,
+    workers: int = 1,
+) -> List[Dict]:
+    """各候補のテストケースの一部（プローブ）を生成コードに対して並列に実行し、候補を並べ替えます。
+
+    プローブは入力の大きさで層別して選びます。プローブの成功率の高い順に並べ、
+    同率の場合は類似度の高い順とします。テストケースのない候補は除外します。
+
+    Args:
+        code: テスト対象の生成コード
+        candidates: find_similar_candidates が返した候補のリスト
+        test_runner: プローブを実行するテストランナー
+        probe_size: 候補1件あたりに実行するテストケースの数（1以上）
+        workers: 同時に実行するプローブの数
+
+    Returns:
+        List[Dict]: probe_passed と probe_total を追加した候補のリスト
+    """
+    # sample_size が0の ExecutionPolicy は全件を実行するため、プローブにならない
+    if probe_size < 1:
+        raise ValueError(f"probe_size must be at least 1: {probe_size}")
+    sampler = ExecutionPolicy(sample_size=probe_size)
+    ranked = []
+    probes = []
+    for candidate in candidates:
+        test_cases = candidate["test_cases"]
+        if not test_cases:
+            continue
+        sample, _ = sampler.order(test_cases)
+        ranked.append(dict(candidate, probe_passed=0, probe_total=len(sample)))
+        probes.extend((len(ranked) - 1, test_cases[i]) for i in sample)
+
+    with ThreadPoolExecutor(max_workers=max(workers, 1)) as executor:
+        futures = [
+            (index, executor.submit(test_runner.probe_test_case, code, *test_case))
+            for index, test_case in probes
+        ]
+        for index, future in futures:
+            success, _ = future.result()
+            if success:
+                ranked[index]["probe_passed"] += 1
+
+    ranked.sort(
+        key=lambda c: (c["probe_passed"] / c["probe_total"], c["similarity"]),
+        reverse=True,
+    )
+    return ranked
+
+
+def run_full_suite(
+    code: str,
+    code_id: int,
+    test_cases: List[Tuple[str, str]],
+    test_runner: TestRunner,
+    question_file: str,
+    policy: Optional[ExecutionPolicy] = None,
+    max_output_chars: int = 200,
+    results_jsonl: Optional[str] = None,
+) -> None:
+    """テストスイートを実行し、結果を実行した順に表示してから最後にサマリーを表示します。
+
+    Args:
+        max_output_chars: 表示する入力値と出力の最大文字数（0の場合は切り詰めない）
+        results_jsonl: 指定した場合は、結果を1件ずつ書き出すJSONLファイル
+    """
+    print("\n~~~ テスト実行開始 ~~~")
+    reporter = StreamingResultReporter(
+        len(test_cases),
+        max_output_chars=max_output_chars,
+        jsonl_path=results_jsonl,
+    )
+    # Get question name from the current file being processed
+    question_name = os.path.splitext(os.path.basename(question_file))[0]
+    try:
+        with memory.stage("tests"), timeline.stage("tests"):
+            for result in test_runner.run_test_suite(
+                code, test_cases, code_id, question_name, policy
+            ):
+                reporter.add(*result)
+    finally:
+        reporter.close()
+
+    if test_runner.stop_reason:
+        print(f"\n{test_runner.stop_reason}")
+        print(f"未実行のテストケース: {len(test_cases) - reporter.count}件")
+
+    print(
+        reporter.summary(
+            cache_stats={
+                "cached": test_runner.cached_count,
+                "executed": test_runner.executed_count,
+            }
+        )
+    )
+
+    # 失敗したテストケースの情報を表示
+    failed_tests_file = f"failed_tests/failed_tests_{code_id}_{question_name}.json"
+    if os.path.exists(failed_tests_file):
+        print(f"\n失敗したテストケースの詳細は {failed_tests_file} に保存されました。")
+    else:
+        print("\nすべてのテストケースが成功しました。")
+
+
+def auto_select_and_test(
+    code: str,
+    test_runner: TestRunner,
+    question_file: str,
+    candidates: List[Dict],
+    probe_size: int = 3,
+    policy: Optional[ExecutionPolicy] = None,
+    max_output_chars: int = 200,
+    results_jsonl: Optional[str] = None,
+) -> None:
+    """プローブの結果で候補を自動的に選び、そのテストスイートで生成コードをテストします。"""
+    workers = test_runner.sandbox.size if test_runner.sandbox is not None else 1
+    start = time.perf_counter()
+    with memory.stage("probes"), timeline.stage("probes"):
+        ranked = rank_candidates_by_probes(
+            code, candidates, test_runner, probe_size=probe_size, workers=workers
+        )
+    if not ranked:
+        print("\nテストケースを持つ類似コードが見つかりません")
+        return
+
+    print(
+        f"\n=== プローブによる再順位付け "
+        f"({len(ranked)}件, {time.perf_counter() - start:.2f}秒) ==="
+    )
+    for i, candidate in enumerate(ranked[:5], 1):
+        print(
+            f"{i}. コード ID: {candidate['code_id']}, "
+            f"プローブ: {candidate['probe_passed']}/{candidate['probe_total']}, "
+            f"類似度: {candidate['similarity']:.4f}"
+        )
+
+    selected = ranked[0]
+    print(
+        f"\nコード ID {selected['code_id']} のテストスイートで生成コードをテストします"
+    )
+    run_full_suite(
+        code,
+        selected["code_id"],
+        selected["test_cases"],
+        test_runner,
+        question_file,
+        policy,
+        max_output_chars,
+        results_jsonl,
+    )
 
 
 def find_and_test_similar_code(
-    code: str, test_runner: TestRunner, question_file: str
+    code: str,
+    test_runner: TestRunner,
+    question_file: str,
+    quantized: bool = False,
+    rerank: int = 200,
+    service_url: Optional[str] = None,
+    shards: int = 0,
+    policy: Optional[ExecutionPolicy] = None,
+    auto_candidates: int = 0,
+    probe_size: int = 3,
+    signature_filter: bool = True,
+    max_output_chars: int = 200,
+    results_jsonl: Optional[str] = None,
+    query_cache: Optional[QueryResultCache] = None,
+    resources: Optional[SearchResources] = None,
 ) -> None:
-    """類似コードを検索し、テストを実行します。"""
-    bedrock = BedrockClient()
-    code_embedding = bedrock.get_embedding(code)
-    code_embeddings = get_embeddings()
+    """類似コードを検索し、テストを実行します。
+
+    quantized が True の場合は、int8量子化ベクトルで候補を rerank 件に絞り込んでから
+    元の精度で再スコアリングします。テストは policy に従って途中で打ち切られることがあり、
+    結果は実行した順に表示されます。
 
-    if not code_embeddings:
+    auto_candidates を指定した場合は、上位 auto_candidates 件の候補をプローブで
+    再順位付けし、選択や確認を求めずに最上位の候補のテストスイートを実行します。
+    signature_filter が True の場合は、引数の数が合わない候補を検索の前に除外します。
+    結果の表示は max_output_chars 文字に切り詰められ、results_jsonl を指定すると
+    1件ずつJSONLファイルにも書き出されます。query_cache を指定すると、
+    同じコードの検索結果をコーパスが変わるまで再利用します。resources には
+    コード生成と並行して準備を始めておいた SearchResources を渡せます。
+    """
+    with memory.stage("search"):
+        candidates = find_similar_candidates(
+            code,
+            top_n=auto_candidates or 3,
+            quantized=quantized,
+            rerank=rerank,
+            service_url=service_url,
+            shards=shards,
+            signature_filter=signature_filter,
+            query_cache=query_cache,
+            resources=resources,
+        )
+    if candidates is None:
         print("\nコードデータが見つかりません")
         return
 
-    top_matches = find_most_similar(code_embedding, code_embeddings, top_n=3)
-    if not top_matches:
+    if not candidates:
         print("\n類似コードが見つかりません")
         return
 
+    if auto_candidates:
+        auto_select_and_test(
+            code,
+            test_runner,
+            question_file,
+            candidates,
+            probe_size,
+            policy,
+            max_output_chars,
+            results_jsonl,
+        )
+        return
+
     print("\n=== 上位3つの類似コード ===")
-    for i, (match_id, similarity) in enumerate(top_matches, 1):
-        print(f"{i}. コード ID: {match_id}, 類似度: {similarity:.4f}")
-        similar_code = get_code_by_id(match_id)
+    for i, candidate in enumerate(candidates, 1):
+        match_id = candidate["code_id"]
+        print(f"{i}. コード ID: {match_id}, 類似度: {candidate['similarity']:.4f}")
+        similar_code = candidate["code"]
         if similar_code:
             print(f"\nコード:\n{similar_code}")
-            test_cases = get_test_cases(match_id)
+            test_cases = candidate["test_cases"]
             if test_cases:
                 print("\nテストケース:")
                 for j, (input_val, expected_output) in enumerate(test_cases[:3], 1):
@@ -213,19 +813,20 @@ def find_and_test_similar_code(
                 input("\nテストを実行するコードの番号を選択してください (1-3): ")
             )
             if 1 <= choice <= 3:
-                selected_id, _ = top_matches[choice - 1]
+                selected = candidates[choice - 1]
+                selected_id = selected["code_id"]
                 break
             else:
                 print("1から3の数字を入力してください。")
         except ValueError:
             print("有効な数字を入力してください。")
 
-    similar_code = get_code_by_id(selected_id)
+    similar_code = selected["code"]
     if not similar_code:
         print(f"\nコード ID {selected_id} の取得に失敗しました")
         return
 
-    test_cases = get_test_cases(selected_id)
+    test_cases = selected["test_cases"]
     if not test_cases:
         print(f"\nコード ID {selected_id} のテストケースが見つかりません")
         return
@@ -235,36 +836,212 @@ def find_and_test_similar_code(
 
     if user_input == "y":
         # すべてのテストケースの実行
-        print("\n~~~ テスト実行開始 ~~~")
-        test_results = []
-        for input_val, expected_output in test_cases:
-            # Get question name from the current file being processed
-            question_name = os.path.splitext(os.path.basename(question_file))[0]
-            success, actual = test_runner.run_test_case(
-                similar_code, input_val, expected_output, selected_id, question_name
-            )
-            test_results.append((input_val, expected_output, success, actual))
-
-        # 結果サマリーの表示（3つのサンプルのみ）
-        print(TestResultFormatter.format_test_results(test_results))
-
-        # 失敗したテストケースの情報を表示
-        question_name = os.path.splitext(os.path.basename(question_file))[0]
-        failed_tests_file = (
-            f"failed_tests/failed_tests_{selected_id}_{question_name}.json"
+        run_full_suite(
+            similar_code,
+            selected_id,
+            test_cases,
+            test_runner,
+            question_file,
+            policy,
+            max_output_chars,
+            results_jsonl,
         )
-        if os.path.exists(failed_tests_file):
-            print(
-                f"\n失敗したテストケースの詳細は {failed_tests_file} に保存されました。"
-            )
-        else:
-            print("\nすべてのテストケースが成功しました。")
     else:
         print("\nテストケースの実行をスキップしました")
 
 
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="類似コードの検索とテスト実行")
+    parser.add_argument(
+        "--question",
+        default="questions/question_01.txt",
+        help="コード生成に使う質問ファイル",
+    )
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="int8量子化ベクトルによる2段階検索を使う",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=200,
+        help="2段階検索で元の精度で再スコアリングする候補の数",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="埋め込みベクトルをN個のシャードに分割して並列に検索する",
+    )
+    parser.add_argument(
+        "--auto-rerank",
+        type=int,
+        default=0,
+        metavar="K",
+        help="上位K件の候補をプローブの成功率で再順位付けし、最上位の候補を自動的に選ぶ",
+    )
+    parser.add_argument(
+        "--probe-size",
+        type=int,
+        default=3,
+        help="再順位付けで候補1件あたりに実行するテストケースの数（1以上）",
+    )
+    parser.add_argument(
+        "--no-signature-filter",
+        action="store_true",
+        help="テスト入力の引数の数が生成コードの関数と合わない候補も検索の対象にする",
+    )
+    parser.add_argument(
+        "--no-result-cache",
+        action="store_true",
+        help="テスト結果のキャッシュを使わない",
+    )
+    parser.add_argument(
+        "--force-rerun",
+        action="store_true",
+        help="キャッシュされたテスト結果を使わずに全て再実行する",
+    )
+    parser.add_argument(
+        "--max-failures",
+        type=int,
+        default=0,
+        help="この件数だけテストが失敗したら実行を打ち切る",
+    )
+    parser.add_argument(
+        "--sample",
+        type=int,
+        default=0,
+        help="まず層別した標本をこの件数だけ実行し、全て成功した場合のみ残りを実行する",
+    )
+    parser.add_argument(
+        "--time-budget",
+        type=float,
+        default=0.0,
+        help="テスト実行がこの秒数を超えたら打ち切る",
+    )
+    parser.add_argument(
+        "--max-output-chars",
+        type=int,
+        default=200,
+        help="表示する入力値と出力の最大文字数（0の場合は切り詰めない）",
+    )
+    parser.add_argument(
+        "--results-jsonl",
+        metavar="FILE",
+        help="テスト結果を1件ずつJSONL形式で書き出すファイル",
+    )
+    parser.add_argument(
+        "--sandbox-workers",
+        type=int,
+        default=2,
+        help="テストを実行するワーカープロセス数（0の場合はこのプロセス内で実行）",
+    )
+    parser.add_argument(
+        "--test-timeout",
+        type=float,
+        default=5.0,
+        help="テストケース1件あたりの実時間の上限（秒）",
+    )
+    parser.add_argument(
+        "--cpu-limit",
+        type=float,
+        default=5.0,
+        help="テストケース1件あたりのCPU時間の上限（秒）",
+    )
+    parser.add_argument(
+        "--memory-limit-mb",
+        type=int,
+        default=512,
+        help="テストを実行するワーカーのメモリ使用量の上限（MB）",
+    )
+    parser.add_argument(
+        "--service-url",
+        default=DEFAULT_SERVICE_URL,
+        help="常駐している類似コード検索サービスのURL",
+    )
+    parser.add_argument(
+        "--no-service",
+        action="store_true",
+        help="サービスを使わずにプロセス内で検索する",
+    )
+    parser.add_argument(
+        "--memory-profile",
+        metavar="FILE",
+        help="tracemallocでステージごとのメモリ使用量を計測し、結果をJSONファイルに書き出す",
+    )
+    parser.add_argument(
+        "--no-overlap",
+        action="store_true",
+        help="コーパスの読み込みなどの検索の準備をコード生成と並行して行わない",
+    )
+    parser.add_argument(
+        "--timeline",
+        action="store_true",
+        help="ステージごとの開始・終了時刻を表示する",
+    )
+    parser.add_argument(
+        "--timeline-json",
+        metavar="FILE",
+        help="ステージごとの開始・終了時刻をJSONファイルにも書き出す（--timeline を含む）",
+    )
+    parser.add_argument(
+        "--no-query-cache",
+        action="store_true",
+        help="類似コード検索の結果のキャッシュを使わない",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="データベースに保持する検索結果の最大数",
+    )
+    args = parser.parse_args()
+    if args.probe_size < 1:
+        parser.error("--probe-size must be at least 1")
+    return args
+
+
 def main():
+    args = parse_args()
+    # スレッドを起動する前にワーカーと forkserver を起動しておく
+    sandbox = None
+    if args.sandbox_workers:
+        sandbox = SandboxPool(
+            workers=args.sandbox_workers,
+            timeout=args.test_timeout,
+            cpu_seconds=args.cpu_limit,
+            memory_mb=args.memory_limit_mb,
+        )
+    # ワーカーの起動より後に開始し、計測の負荷をワーカーに持ち込まない
+    if args.memory_profile:
+        memory.start_profiling(args.memory_profile)
+    if args.timeline or args.timeline_json:
+        timeline.start_timeline()
+    try:
+        run(args, sandbox)
+    finally:
+        timeline.stop_timeline(args.timeline_json)
+        memory.stop_profiling()
+        if sandbox is not None:
+            sandbox.close()
+
+
+def run(args: argparse.Namespace, sandbox: Optional[SandboxPool] = None):
     processor = CodeProcessor()
+    service_url = None if args.no_service else args.service_url
+    resources = SearchResources(
+        quantized=args.quantized,
+        rerank=args.rerank,
+        shards=args.shards,
+        service_url=service_url,
+    )
+    if args.memory_profile and not args.no_overlap:
+        # 並行して読み込んだコーパスの割り当てが generate に計上されないようにする
+        print("--memory-profile を指定したため、検索の準備はコード生成の後に行います")
+    elif not args.no_overlap:
+        # コーパスの読み込みなどは生成コードに依存しないため、生成と並行して進める
+        resources.start()
 
     # サンプルコードの登録
     # for code_data in code_samples:
@@ -272,24 +1049,59 @@ def main():
 
     # 類似コード検索のデモ
     print("\n=== 類似コードの検索 ===")
-    question_file = "questions/question_01.txt"
+    question_file = args.question
     try:
         with open(question_file, "r", encoding="utf-8") as f:
             prompt = f.read().strip()
         print(f"プロンプト: {prompt}")
 
-        ai_code = processor.gemini_client.generate_code(prompt)
+        with memory.stage("generate"), timeline.stage("generate"):
+            ai_code = processor.gemini_client.generate_code(prompt)
     except FileNotFoundError:
         print("エラー: question.txtファイルが見つかりません")
+        resources.cancel()
         return
     except Exception as e:
         print(f"エラー: プロンプトの読み込み中にエラーが発生しました - {str(e)}")
+        resources.cancel()
         return
     if ai_code:
         print(f"\nAI生成コード:\n{ai_code}")
-        find_and_test_similar_code(ai_code, TestRunner(), question_file)
+        try:
+            find_and_test_similar_code(
+                ai_code,
+                TestRunner(
+                    use_cache=not args.no_result_cache,
+                    force_rerun=args.force_rerun,
+                    sandbox=sandbox,
+                ),
+                question_file,
+                quantized=args.quantized,
+                rerank=args.rerank,
+                service_url=service_url,
+                shards=args.shards,
+                policy=ExecutionPolicy(
+                    max_failures=args.max_failures,
+                    sample_size=args.sample,
+                    time_budget=args.time_budget,
+                ),
+                auto_candidates=args.auto_rerank,
+                probe_size=args.probe_size,
+                signature_filter=not args.no_signature_filter,
+                max_output_chars=args.max_output_chars,
+                results_jsonl=args.results_jsonl,
+                query_cache=(
+                    None
+                    if args.no_query_cache
+                    else QueryResultCache(args.query_cache_size, persist=True)
+                ),
+                resources=resources,
+            )
+        finally:
+            resources.close()
     else:
         print("コードの生成に失敗しました")
+        resources.cancel()
 
 
 if __name__ == "__main__":
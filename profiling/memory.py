@@ -0,0 +1,171 @@
+"""tracemalloc によるメモリ使用量のプロファイリング。
+
+start_profiling を呼ぶと有効になり、stage で囲んだ区間ごとにスナップショットを取って
+ピーク使用量と割り当てが増えた箇所の上位を記録します。stop_profiling で結果を
+JSONファイルに書き出します。有効でない間は各関数は何もしません。
+
+tracemalloc のピークはプロセスで1つしかないため、ステージを開始するたびにそれまでの
+ピークを開いている全てのステージに反映してからリセットします。入れ子のステージや
+別スレッドで並行するステージがあっても、各ステージのピークはその区間のプロセス全体の
+ピークになります（並行するステージの割り当ても含みます）。
+"""
+
+import json
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class MemoryProfiler:
+    """ステージごとのメモリ使用量を記録するプロファイラ。
+
+    Args:
+        path: 結果を書き出すJSONファイルのパス
+        top: ステージごとに記録する割り当て箇所の数
+        frames: 割り当て箇所として保存するスタックフレームの数
+    """
+
+    def __init__(self, path: str, top: int = 10, frames: int = 1):
+        self.path = path
+        self.top = top
+        self.frames = frames
+        self.stages: List[Dict] = []
+        self.objects: List[Dict] = []
+        self._lock = threading.Lock()
+        # 開いているステージごとの、最後にピークをリセットするまでのピーク
+        self._open_peaks: List[List[int]] = []
+        self._overall_peak = 0
+
+    def start(self) -> None:
+        tracemalloc.start(self.frames)
+
+    def _fold_peak(self) -> None:
+        """現在のピークを開いている全てのステージのピークに反映します（ロックを取って呼ぶ）。"""
+        _, peak = tracemalloc.get_traced_memory()
+        self._overall_peak = max(self._overall_peak, peak)
+        for open_peak in self._open_peaks:
+            open_peak[0] = max(open_peak[0], peak)
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """区間の前後でスナップショットを取り、ピークと増えた割り当て箇所を記録します。"""
+        before = tracemalloc.take_snapshot()
+        with self._lock:
+            self._fold_peak()
+            tracemalloc.reset_peak()
+            current_before, _ = tracemalloc.get_traced_memory()
+            open_peak = [current_before]
+            self._open_peaks.append(open_peak)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self._lock:
+                self._fold_peak()
+                self._open_peaks.remove(open_peak)
+                current_after, _ = tracemalloc.get_traced_memory()
+            peak = open_peak[0]
+            after = tracemalloc.take_snapshot()
+            stats = after.compare_to(
+                before, "traceback" if self.frames > 1 else "lineno"
+            )
+            record = {
+                "stage": name,
+                "seconds": round(seconds, 3),
+                "current_before_kb": current_before // 1024,
+                "current_after_kb": current_after // 1024,
+                "peak_kb": peak // 1024,
+                "top_allocations": [
+                    {
+                        "site": [
+                            f"{frame.filename}:{frame.lineno}"
+                            for frame in stat.traceback
+                        ],
+                        "size_diff_kb": round(stat.size_diff / 1024, 1),
+                        "count_diff": stat.count_diff,
+                    }
+                    for stat in stats[: self.top]
+                ],
+            }
+            with self._lock:
+                self.stages.append(record)
+            print(
+                f"[memory] {name}: peak {peak / 1024 / 1024:.1f} MB, "
+                f"{(current_after - current_before) / 1024 / 1024:+.1f} MB"
+            )
+
+    def record_embedding_rows(
+        self, label: str, rows: List[Tuple[int, list]], matrix_bytes: int = 0
+    ) -> None:
+        """埋め込みベクトルの行（Pythonのリストとfloat）のオブジェクト数と大きさを記録します。"""
+        floats = 0
+        container_bytes = 0
+        for row in rows:
+            floats += len(row[1])
+            container_bytes += sys.getsizeof(row) + sys.getsizeof(row[1])
+        record = {
+            "label": label,
+            "rows": len(rows),
+            "float_objects": floats,
+            "estimated_kb": (container_bytes + floats * sys.getsizeof(0.0)) // 1024,
+        }
+        if matrix_bytes:
+            record["matrix_kb"] = matrix_bytes // 1024
+        with self._lock:
+            self.objects.append(record)
+
+    def stop(self) -> None:
+        """トレースを終了し、結果をファイルに書き出します。"""
+        with self._lock:
+            self._fold_peak()
+        tracemalloc.stop()
+        report = {
+            "python_version": sys.version.split()[0],
+            "overall_peak_kb": self._overall_peak // 1024,
+            "stages": self.stages,
+            "embedding_rows": self.objects,
+        }
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[memory] プロファイル結果を {self.path} に書き出しました")
+
+
+_active: Optional[MemoryProfiler] = None
+
+
+def start_profiling(path: str, top: int = 10, frames: int = 1) -> MemoryProfiler:
+    """メモリのプロファイリングを開始します。"""
+    global _active
+    _active = MemoryProfiler(path, top=top, frames=frames)
+    _active.start()
+    return _active
+
+
+def stop_profiling() -> None:
+    """プロファイリングを終了し、結果を書き出します。開始していなければ何もしません。"""
+    global _active
+    if _active is not None:
+        profiler, _active = _active, None
+        profiler.stop()
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """プロファイリング中であれば、この区間のメモリ使用量を記録します。"""
+    if _active is None:
+        yield
+        return
+    with _active.stage(name):
+        yield
+
+
+def record_embedding_rows(
+    label: str, rows: List[Tuple[int, list]], matrix_bytes: int = 0
+) -> None:
+    """プロファイリング中であれば、埋め込みベクトルの行のオブジェクト数を記録します。"""
+    if _active is not None:
+        _active.record_embedding_rows(label, rows, matrix_bytes)
@@ -0,0 +1,108 @@
+"""処理のステージごとの開始・終了時刻の記録。
+
+start_timeline を呼ぶと有効になり、stage で囲んだ区間の開始と終了を、開始時点からの
+経過時間とスレッド名とともに記録します。memory と異なり、別スレッドで並行する
+ステージや入れ子のステージも記録できます。stop_timeline で一覧を表示し、
+パスを指定した場合はJSONファイルにも書き出します。有効でない間は各関数は何もしません。
+"""
+
+import json
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+
+class StageTimeline:
+    """ステージの開始・終了時刻を記録するクラス。"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.stages: List[Dict] = []
+        self._lock = threading.Lock()
+
+    def now(self) -> float:
+        """記録の開始からの経過秒数を返します。"""
+        return time.perf_counter() - self.origin
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """区間の開始と終了の時刻を記録します。"""
+        start = self.now()
+        try:
+            yield
+        finally:
+            record = {
+                "stage": name,
+                "thread": threading.current_thread().name,
+                "start": round(start, 4),
+                "end": round(self.now(), 4),
+            }
+            with self._lock:
+                self.stages.append(record)
+
+    def report(self) -> Dict:
+        """記録したステージを開始順に並べ、全体の経過時間と各ステージの所要時間の合計を返します。
+
+        合計が経過時間より長い分だけ、ステージが並行して実行されたことになります。
+        """
+        with self._lock:
+            stages = sorted(self.stages, key=lambda s: (s["start"], s["end"]))
+        return {
+            "elapsed": round(self.now(), 4),
+            "sum_of_stages": round(
+                sum(s["end"] - s["start"] for s in stages if "." not in s["stage"]), 4
+            ),
+            "stages": stages,
+        }
+
+    def stop(self, path: Optional[str] = None) -> Dict:
+        """記録の一覧を表示し、path を指定した場合はJSONファイルにも書き出します。"""
+        report = self.report()
+        print("\n=== ステージごとの時刻（秒） ===")
+        for s in report["stages"]:
+            print(
+                f"  {s['stage']:<24} {s['start']:8.3f} → {s['end']:8.3f} "
+                f"({s['end'] - s['start']:.3f}) [{s['thread']}]"
+            )
+        print(
+            f"  全体 {report['elapsed']:.3f} 秒 "
+            f"(ステージの合計 {report['sum_of_stages']:.3f} 秒)"
+        )
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(report, f, ensure_ascii=False, indent=2)
+            print(f"[timeline] 結果を {path} に書き出しました")
+        return report
+
+
+_active: Optional[StageTimeline] = None
+
+
+def start_timeline() -> StageTimeline:
+    """ステージの時刻の記録を開始します。"""
+    global _active
+    _active = StageTimeline()
+    return _active
+
+
+def stop_timeline(path: Optional[str] = None) -> None:
+    """記録を終了して一覧を表示します。開始していなければ何もしません。"""
+    global _active
+    if _active is not None:
+        timeline, _active = _active, None
+        timeline.stop(path)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """記録中であれば、この区間の開始と終了の時刻を記録します。
+
+    名前に "." を含むステージ（例: "warmup.corpus"）は他のステージの内訳とみなし、
+    所要時間の合計には含めません。
+    """
+    if _active is None:
+        yield
+        return
+    with _active.stage(name):
+        yield
@@ -0,0 +1,73 @@
+import ast
+from typing import Tuple
+
+# 実際の出力として返す最大文字数。巨大な戻り値やエラーメッセージを
+# ワーカーからのパイプやテスト結果のキャッシュにそのまま流さないよう、ここで切り詰める
+MAX_ACTUAL_OUTPUT_CHARS = 2000
+
+
+def truncate_output(value: str, max_chars: int) -> str:
+    """長すぎる出力を先頭 max_chars 文字に切り詰め、省略した文字数を付け加えます。"""
+    if max_chars <= 0 or len(value) <= max_chars:
+        return value
+    return f"{value[:max_chars]}... ({len(value) - max_chars}文字省略)"
+
+
+def execute_test_case(
+    code: str, input_val: str, expected_output: str
+) -> Tuple[bool, str]:
+    """テストケースを実行し、(成功したかどうか, 実際の出力) を返します。
+
+    成否は切り詰める前の出力で判定し、出力は MAX_ACTUAL_OUTPUT_CHARS 文字に切り詰めます。
+    """
+    success, actual = _execute_test_case(code, input_val, expected_output)
+    return success, truncate_output(actual, MAX_ACTUAL_OUTPUT_CHARS)
+
+
+def _execute_test_case(
+    code: str, input_val: str, expected_output: str
+) -> Tuple[bool, str]:
+    try:
+        # コードをグローバル名前空間で実行
+        namespace = {}
+        exec(code, namespace)
+
+        # 関数名を取得（最初の関数定義を使用）
+        func_name = next(
+            (
+                name
+                for name, obj in namespace.items()
+                if callable(obj) and name != "__builtins__"
+            ),
+            None,
+        )
+        if not func_name:
+            return False, "No function found in code"
+
+        # 入力値を引数リストに変換
+        try:
+            args = ast.literal_eval(input_val)
+            if not isinstance(args, list):
+                args = [args]
+        except:
+            args = [input_val]
+
+        # 期待される出力を評価
+        try:
+            expected = ast.literal_eval(expected_output)
+        except:
+            expected = expected_output
+
+        # 関数を実行
+        actual = namespace[func_name](*args)
+
+        # タプルとリストを同等とみなす比較
+        if isinstance(actual, (list, tuple)) and isinstance(expected, (list, tuple)):
+            success = list(actual) == list(expected)
+        else:
+            success = actual == expected
+
+        return success, str(actual)
+
+    except Exception as e:
+        return False, f"Error: {str(e)}"
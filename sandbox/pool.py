@@ -0,0 +1,219 @@
+"""テスト対象のコードを隔離して実行する、事前に起動したワーカープロセスのプール。
+
+各ワーカーは起動時にメモリ使用量の上限（RLIMIT_AS）を設定し、テストごとに
+CPU時間の上限（RLIMIT_CPU）を設け直します。親プロセスはテストごとの実時間の
+上限を監視し、時間切れや異常終了したワーカーを強制終了して新しいワーカーに
+置き換えます。
+
+ワーカーは forkserver から fork します。forkserver はプールの作成時に起動する
+単一スレッドのプロセスで、重い依存関係を読み込んだりスレッドを起動したりした後の
+親プロセスではなく、そこから置き換えのワーカーも作られます。
+"""
+
+import math
+import multiprocessing
+import queue
+import signal
+import threading
+from typing import Optional, Tuple
+
+from .executor import execute_test_case
+
+try:
+    import resource
+except ImportError:  # Windowsでは resource モジュールが使えない
+    resource = None
+
+# この接頭辞で始まる結果は、コードではなく実行環境に起因する（キャッシュしてはならない）
+SANDBOX_ERROR_PREFIX = "Sandbox error:"
+
+
+def _set_cpu_limit(cpu_seconds: float) -> None:
+    """これまでの使用量に cpu_seconds を加えた値をCPU時間のソフトリミットに設定します。"""
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    used = usage.ru_utime + usage.ru_stime
+    _, hard = resource.getrlimit(resource.RLIMIT_CPU)
+    soft = math.ceil(used + cpu_seconds)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(resource.RLIMIT_CPU, (soft, hard))
+
+
+def _worker_main(conn, cpu_seconds: float, memory_bytes: int) -> None:
+    """ワーカープロセスの本体。親から受け取ったテストケースを順に実行します。"""
+    # Ctrl+C は親プロセスが処理する
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if resource is not None and memory_bytes:
+        try:
+            _, hard = resource.getrlimit(resource.RLIMIT_AS)
+            resource.setrlimit(resource.RLIMIT_AS, (memory_bytes, hard))
+        except (ValueError, OSError) as e:
+            print(f"Could not set memory limit in sandbox worker: {e}")
+
+    while True:
+        try:
+            task = conn.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        if resource is not None and cpu_seconds:
+            try:
+                _set_cpu_limit(cpu_seconds)
+            except (ValueError, OSError):
+                pass
+        try:
+            result = execute_test_case(*task)
+        except MemoryError:
+            result = (False, "Error: MemoryError")
+        conn.send(result)
+
+
+class _Worker:
+    def __init__(self, context, cpu_seconds: float, memory_bytes: int):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=_worker_main,
+            args=(child_conn, cpu_seconds, memory_bytes),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.tasks = 0
+
+    def kill(self) -> None:
+        if self.process.is_alive():
+            self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+    def stop(self) -> None:
+        try:
+            self.conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+        self.process.join(timeout=1)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.conn.close()
+
+
+class SandboxPool:
+    """事前に起動したワーカーでテストケースを実行するプール。
+
+    複数のスレッドから同時に run を呼び出せます。空いているワーカーがない場合は
+    いずれかのワーカーが空くまで待ちます。
+
+    Args:
+        workers: ワーカープロセス数
+        timeout: テストケース1件あたりの実時間の上限（秒）
+        cpu_seconds: テストケース1件あたりのCPU時間の上限（秒、0の場合は制限しない）
+        memory_mb: ワーカーのメモリ使用量の上限（MB、0の場合は制限しない）
+        max_tasks: この件数を実行したワーカーは新しいワーカーに置き換える
+    """
+
+    def __init__(
+        self,
+        workers: int = 2,
+        timeout: float = 5.0,
+        cpu_seconds: float = 5.0,
+        memory_mb: int = 512,
+        max_tasks: int = 500,
+    ):
+        methods = multiprocessing.get_all_start_methods()
+        if "forkserver" in methods:
+            self.context = multiprocessing.get_context("forkserver")
+            # 起動スクリプトに加えてワーカーの本体を forkserver に読み込んでおく
+            self.context.set_forkserver_preload(["__main__", __name__])
+        else:
+            self.context = multiprocessing.get_context()
+        self.timeout = timeout
+        self.cpu_seconds = cpu_seconds
+        self.memory_bytes = memory_mb * 1024 * 1024
+        self.max_tasks = max_tasks
+        self.size = max(workers, 1)
+        self.replaced = 0
+        self._lock = threading.Lock()
+        self._idle = queue.Queue()
+        self._workers = []
+        for _ in range(self.size):
+            self._add_worker()
+
+    def _add_worker(self) -> None:
+        worker = _Worker(self.context, self.cpu_seconds, self.memory_bytes)
+        with self._lock:
+            self._workers.append(worker)
+        self._idle.put(worker)
+
+    def _replace(self, worker: _Worker) -> None:
+        worker.kill()
+        with self._lock:
+            self._workers.remove(worker)
+            self.replaced += 1
+        self._add_worker()
+
+    def run(
+        self,
+        code: str,
+        input_val: str,
+        expected_output: str,
+        timeout: Optional[float] = None,
+    ) -> Tuple[bool, str]:
+        """テストケースをワーカーで実行し、(成功したかどうか, 実際の出力) を返します。
+
+        時間切れやワーカーの異常終了（メモリ・CPU時間の上限超過を含む）の場合は
+        ワーカーを置き換え、SANDBOX_ERROR_PREFIX で始まるメッセージを返します。
+        timeout を指定した場合は、プールの timeout より短ければそちらを実時間の上限とします。
+        """
+        limit = self.timeout if timeout is None else max(min(self.timeout, timeout), 0)
+        worker = self._idle.get()
+        try:
+            worker.conn.send((code, input_val, expected_output))
+            if not worker.conn.poll(limit):
+                self._replace(worker)
+                return False, f"{SANDBOX_ERROR_PREFIX} timed out after {limit:g}s"
+            result = worker.conn.recv()
+        except (EOFError, BrokenPipeError, OSError):
+            worker.process.join(timeout=1)
+            exitcode = worker.process.exitcode
+            self._replace(worker)
+            return (
+                False,
+                f"{SANDBOX_ERROR_PREFIX} worker exited ({_describe(exitcode)})",
+            )
+
+        worker.tasks += 1
+        if worker.tasks >= self.max_tasks:
+            worker.stop()
+            with self._lock:
+                self._workers.remove(worker)
+            self._add_worker()
+        else:
+            self._idle.put(worker)
+        return result
+
+    def close(self) -> None:
+        """全てのワーカーを終了します。"""
+        with self._lock:
+            workers = list(self._workers)
+            self._workers.clear()
+        for worker in workers:
+            worker.stop()
+
+    def __enter__(self) -> "SandboxPool":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def _describe(exitcode: Optional[int]) -> str:
+    if exitcode is None:
+        return "unknown status"
+    if exitcode < 0:
+        try:
+            return f"signal {signal.Signals(-exitcode).name}"
+        except ValueError:
+            return f"signal {-exitcode}"
+    return f"exit code {exitcode}"
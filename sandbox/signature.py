@@ -0,0 +1,143 @@
+"""テスト対象の関数のシグネチャとテスト入力の引数の数を求めます。
+
+execute_test_case は名前空間で最初に見つかった呼び出し可能なオブジェクトを
+エントリポイントとし、リストのテスト入力を位置引数に展開して呼び出します。
+ここではその規則に従い、実行せずに ast だけで同じ関数を特定します。
+"""
+
+import ast
+from typing import Dict, Optional
+
+from database.connection import create_database
+from database.signature_repository import (
+    get_codes_without_signature,
+    get_test_cases_without_arg_count,
+    save_code_signatures,
+    save_test_arg_counts,
+)
+
+# 評価結果が呼び出し可能なオブジェクトにならない式
+_NON_CALLABLE_EXPRS = (
+    ast.Constant,
+    ast.BinOp,
+    ast.UnaryOp,
+    ast.BoolOp,
+    ast.Compare,
+    ast.List,
+    ast.Tuple,
+    ast.Set,
+    ast.Dict,
+    ast.ListComp,
+    ast.SetComp,
+    ast.DictComp,
+    ast.GeneratorExp,
+    ast.JoinedStr,
+)
+
+
+def extract_signature(code: str) -> Optional[Dict]:
+    """コードのエントリポイントとなる関数のシグネチャを求めます。
+
+    最初の関数定義より前にクラス定義・from import・代入など呼び出し可能な
+    オブジェクトになりうる文がある場合や、デコレータ付きの関数の場合は、
+    実行時のエントリポイントを特定できないためNoneを返します。
+
+    Args:
+        code: シグネチャを求めるコード
+
+    Returns:
+        Optional[Dict]: function_name, min_args, max_args（可変長引数の場合はNone）,
+        defaults を含む辞書。特定できない場合はNone
+    """
+    try:
+        tree = ast.parse(code)
+    except (SyntaxError, ValueError):
+        return None
+
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef)):
+            if node.decorator_list:
+                return None
+            args = node.args
+            positional = len(args.posonlyargs) + len(args.args)
+            required_kwonly = sum(1 for d in args.kw_defaults if d is None)
+            if required_kwonly:
+                # キーワード専用の必須引数があると位置引数だけでは呼び出せない
+                return None
+            return {
+                "function_name": node.name,
+                "min_args": positional - len(args.defaults),
+                "max_args": None if args.vararg else positional,
+                "defaults": len(args.defaults),
+            }
+        if isinstance(node, (ast.ClassDef, ast.ImportFrom)):
+            return None
+        if isinstance(node, (ast.Assign, ast.AnnAssign)) and _may_be_callable(
+            node.value
+        ):
+            return None
+    return None
+
+
+def _may_be_callable(value: Optional[ast.expr]) -> bool:
+    """代入される値が呼び出し可能なオブジェクトになりうるかどうかを返します。"""
+    return value is not None and not isinstance(value, _NON_CALLABLE_EXPRS)
+
+
+def count_test_args(input_val: str) -> int:
+    """テスト入力を execute_test_case と同じ規則で展開したときの引数の数を返します。"""
+    try:
+        args = ast.literal_eval(input_val)
+    except Exception:
+        return 1
+    return len(args) if isinstance(args, list) else 1
+
+
+def sync_signatures(batch_size: int = 500) -> int:
+    """シグネチャが未作成のコードと、引数の数が未計算のテストケースを処理します。
+
+    Returns:
+        int: 新たに処理したコードとテストケースの数
+    """
+    create_database()
+    count = 0
+    after_id = 0
+    while True:
+        rows = get_codes_without_signature(after_id, batch_size)
+        if not rows:
+            break
+        signatures = []
+        for code_id, code in rows:
+            signature = extract_signature(code)
+            if signature is None:
+                signatures.append((code_id, None, None, None, None))
+            else:
+                signatures.append(
+                    (
+                        code_id,
+                        signature["function_name"],
+                        signature["min_args"],
+                        signature["max_args"],
+                        signature["defaults"],
+                    )
+                )
+        if not save_code_signatures(signatures):
+            return count
+        count += len(rows)
+        after_id = rows[-1][0]
+
+    after_id = 0
+    while True:
+        rows = get_test_cases_without_arg_count(after_id, batch_size)
+        if not rows:
+            break
+        if not save_test_arg_counts(
+            [
+                (test_case_id, count_test_args(input_val))
+                for test_case_id, input_val in rows
+            ]
+        ):
+            return count
+        count += len(rows)
+        after_id = rows[-1][0]
+    return count
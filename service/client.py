@@ -0,0 +1,70 @@
+import json
+import urllib.error
+import urllib.request
+from typing import Dict, Optional
+
+DEFAULT_SERVICE_URL = "http://127.0.0.1:8765"
+
+
+class SimilarityClient:
+    """常駐している類似コード検索サービスのクライアント。"""
+
+    def __init__(self, base_url: str = DEFAULT_SERVICE_URL, timeout: float = 30.0):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def search(
+        self,
+        code: str,
+        top_n: int = 3,
+        signature_filter: bool = True,
+        quantized: Optional[bool] = None,
+        rerank: Optional[int] = None,
+        shards: Optional[int] = None,
+    ) -> Optional[Dict]:
+        """サービスに類似コードの検索を依頼します。
+
+        Args:
+            code: 検索対象のコード
+            top_n: 返す類似コードの数
+            signature_filter: 引数の数が合わない候補を除外するかどうか
+            quantized, rerank, shards: 検索方式（Noneの場合はサービスの起動時の設定）
+
+        Returns:
+            Optional[Dict]: corpus_version と candidates を含む応答。
+            サービスに接続できない場合はNone
+        """
+        body = {"code": code, "top_n": top_n, "signature_filter": signature_filter}
+        for name, value in (
+            ("quantized", quantized),
+            ("rerank", rerank),
+            ("shards", shards),
+        ):
+            if value is not None:
+                body[name] = value
+        request = urllib.request.Request(
+            f"{self.base_url}/search",
+            data=json.dumps(body).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST",
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError, ValueError) as e:
+            print(f"Similarity service unavailable ({self.base_url}): {e}")
+            return None
+
+    def health(self) -> Optional[Dict]:
+        """サービスの状態を取得します。
+
+        Returns:
+            Optional[Dict]: corpus_version などを含む応答。サービスに接続できない場合はNone
+        """
+        try:
+            with urllib.request.urlopen(
+                f"{self.base_url}/health", timeout=self.timeout
+            ) as response:
+                return json.loads(response.read())
+        except (urllib.error.URLError, OSError, ValueError):
+            return None
@@ -0,0 +1,240 @@
+"""検索用コーパスをメモリ上に保持し、データベースの更新に追従させます。"""
+
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from database.code_repository import (
+    get_code_by_id,
+    get_corpus_version,
+    get_embeddings,
+)
+from database.connection import create_database
+from database.shards import export_embeddings_to_shards, get_shards_version
+from database.signature_repository import get_compatible_code_ids
+from database.test_repository import get_test_cases_with_duplicates
+from embedding.minhash import collapse_near_duplicates
+from embedding.quantization import QuantizedIndex
+from embedding.sharded_search import ShardedSearcher
+from profiling.memory import record_embedding_rows
+from sandbox.signature import extract_signature, sync_signatures
+
+# 近似重複をまとめる場合に、返す件数の何倍を検索するか
+COLLAPSE_SEARCH_FACTOR = 4
+
+
+class WarmCorpus:
+    """埋め込みベクトルの検索インデックスを一度だけ読み込み、使い回すためのクラス。
+
+    検索のたびにコーパスの版数を確認し、変わっていればシグネチャを同期して
+    インデックスを作り直します。
+    作り直しの間も古いインデックスで検索を続けられるよう、参照の差し替えで更新します。
+
+    shards を指定した場合は、シャードに分割した埋め込みベクトルをプロセスプールで
+    並列に検索します（quantized は無視されます）。シャードの版数がコーパスと
+    異なる場合は、code_comparison.db からシャードを作り直します。
+    """
+
+    def __init__(
+        self,
+        quantized: bool = False,
+        rerank: int = 200,
+        shards: int = 0,
+        workers: Optional[int] = None,
+    ):
+        self.quantized = quantized
+        self.rerank = rerank
+        self.shards = shards
+        self.workers = workers
+        self.version = None
+        self._index = None
+        self._searcher = None
+        self._lock = threading.Lock()
+        create_database()
+
+    def _build(self):
+        if self.shards:
+            if get_shards_version(self.shards) != get_corpus_version():
+                print(f"Rebuilding {self.shards} embedding shards...")
+                export_embeddings_to_shards(self.shards)
+            if self._searcher is None:
+                self._searcher = ShardedSearcher(self.shards, self.workers)
+            return self._searcher, self._searcher.size()
+
+        if self.quantized:
+            return QuantizedIndex.load()
+
+        code_embeddings = get_embeddings()
+        if not code_embeddings:
+            return np.empty(0, dtype=np.int64), np.empty((0, 0), dtype=np.float32)
+        ids = np.asarray([code_id for code_id, _ in code_embeddings], dtype=np.int64)
+        matrix = np.asarray(
+            [embedding for _, embedding in code_embeddings], dtype=np.float32
+        )
+        matrix /= np.maximum(np.linalg.norm(matrix, axis=1, keepdims=True), 1e-12)
+        record_embedding_rows("WarmCorpus", code_embeddings, matrix.nbytes)
+        return ids, matrix
+
+    def close(self) -> None:
+        """シャードを検索するワーカープロセスを終了します。"""
+        with self._lock:
+            if self._searcher is not None:
+                self._searcher.close()
+                self._searcher = None
+            self._index = None
+
+    def refresh(self) -> bool:
+        """コーパスが更新されていればインデックスを読み込み直します。
+
+        Returns:
+            bool: 読み込み直した場合はTrue
+        """
+        version = get_corpus_version()
+        if self._index is not None and version is not None and version == self.version:
+            return False
+
+        with self._lock:
+            # 他のスレッドが既に読み込み直していれば何もしない
+            if (
+                self._index is not None
+                and version is not None
+                and version == self.version
+            ):
+                return False
+            # 取り込み以外で追加されたコードやテストケースのシグネチャを作成しておく
+            sync_signatures()
+            self._index = self._build()
+            self.version = version
+            print(f"Loaded corpus (version {version}, {self.size} codes)")
+            return True
+
+    @property
+    def size(self) -> int:
+        if self._index is None:
+            return 0
+        if self.shards:
+            return self._index[1]
+        if self.quantized:
+            return len(self._index)
+        return len(self._index[0])
+
+    def search(
+        self,
+        target_embedding: list,
+        top_n: int = 3,
+        allowed_ids: Optional[np.ndarray] = None,
+    ) -> List[Tuple[int, float]]:
+        """最も類似したコードを見つけます。
+
+        allowed_ids を指定した場合は、そのコードIDだけを類似度の計算の対象とします。
+
+        Returns:
+            [(コードID, 類似度)]の形式で上位n個の類似コードのリスト
+        """
+        self.refresh()
+        index = self._index
+        if self.shards:
+            return index[0].search(
+                target_embedding, top_n=top_n, allowed_ids=allowed_ids
+            )
+        if self.quantized:
+            return index.search(
+                target_embedding,
+                top_n=top_n,
+                rerank=self.rerank,
+                allowed_ids=allowed_ids,
+            )
+
+        ids, matrix = index
+        if allowed_ids is not None:
+            mask = np.isin(ids, allowed_ids)
+            ids, matrix = ids[mask], matrix[mask]
+        if not len(ids):
+            return []
+        target = np.asarray(target_embedding, dtype=np.float32)
+        target /= max(float(np.linalg.norm(target)), 1e-12)
+        scores = matrix @ target
+        count = min(top_n, len(scores))
+        top = np.argpartition(-scores, count - 1)[:count]
+        top = top[np.argsort(-scores[top])]
+        return [(int(ids[i]), float(scores[i])) for i in top]
+
+
+def fetch_candidates(
+    matches: List[Tuple[int, float]],
+    top_n: Optional[int] = None,
+    collapse: bool = True,
+) -> List[Dict]:
+    """検索結果のコードとテストケースを取得します。
+
+    collapse が True の場合は近似重複のコードをまとめ、互いに異なるコードだけを残します。
+    取り込み時に埋め込みを共有させた近似重複のテストケースは、代表コードの候補に含めます。
+
+    Args:
+        matches: [(コードID, 類似度)] の形式の検索結果（類似度の高い順）
+        top_n: 返す候補の数（Noneの場合は全て）
+        collapse: 近似重複をまとめるかどうか
+
+    Returns:
+        List[Dict]: code_id, similarity, code, test_cases を含む辞書のリスト
+    """
+    candidates = [
+        {"code_id": code_id, "similarity": similarity, "code": get_code_by_id(code_id)}
+        for code_id, similarity in matches
+    ]
+    top_n = top_n or len(candidates)
+    if collapse:
+        candidates = collapse_near_duplicates(candidates, top_n)
+    else:
+        candidates = candidates[:top_n]
+
+    for candidate in candidates:
+        candidate["test_cases"] = [
+            list(test_case)
+            for test_case in get_test_cases_with_duplicates(candidate["code_id"])
+        ]
+    return candidates
+
+
+def compatible_code_ids(code: str) -> Optional[np.ndarray]:
+    """コードの関数をテスト入力の引数の数どおりに呼び出せる候補のコードIDを返します。
+
+    シグネチャは取り込みの最後とインデックスの読み込み時（WarmCorpus.refresh）に
+    作成済みのものを使います。
+
+    Returns:
+        Optional[np.ndarray]: 候補のコードIDの配列。コードの関数を特定できない場合はNone
+    """
+    signature = extract_signature(code)
+    if signature is None:
+        return None
+    code_ids = get_compatible_code_ids(signature["min_args"], signature["max_args"])
+    if code_ids is None:
+        return None
+    return np.fromiter(sorted(code_ids), dtype=np.int64, count=len(code_ids))
+
+
+def search_candidates(
+    corpus: WarmCorpus,
+    target_embedding: list,
+    top_n: int = 3,
+    collapse: bool = True,
+    allowed_ids: Optional[np.ndarray] = None,
+) -> Optional[List[Dict]]:
+    """類似コードを検索し、そのコードとテストケースをまとめて返します。
+
+    近似重複をまとめる場合は、まとめた後も top_n 件残るよう多めに検索します。
+    allowed_ids を指定した場合は、そのコードIDだけを検索の対象とします。
+
+    Returns:
+        Optional[List[Dict]]: 候補のリスト。コーパスが空の場合はNone
+    """
+    corpus.refresh()
+    if not corpus.size:
+        return None
+    if allowed_ids is not None and not len(allowed_ids):
+        return []
+    search_n = top_n * COLLAPSE_SEARCH_FACTOR if collapse else top_n
+    matches = corpus.search(target_embedding, top_n=search_n, allowed_ids=allowed_ids)
+    return fetch_candidates(matches, top_n=top_n, collapse=collapse)
@@ -0,0 +1,126 @@
+"""類似コード検索の結果を再利用するためのLRUキャッシュ。
+
+同じコードを同じ条件で検索した結果を、コーパスが変わっていない間だけ返します。
+insert_code や update_embedding でコーパスの版数が変わると、古い結果は使われません。
+"""
+
+import copy
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from database.connection import create_database
+from database.query_cache_repository import (
+    get_cached_query,
+    get_corpus_state,
+    save_cached_query,
+)
+
+DEFAULT_MAX_ENTRIES = 256
+
+
+def query_cache_key(
+    code: str,
+    top_n: int,
+    quantized: bool,
+    rerank: int,
+    shards: int,
+    signature_filter: bool,
+) -> str:
+    """検索のキーを作成します。
+
+    CLIとサービスで同じ検索が同じキーになるよう、検索結果に影響する条件は
+    すべて必須の引数にしています。
+
+    Args:
+        code: 検索対象のコード
+        top_n: 返す類似コードの数
+        quantized, rerank, shards: 検索に使う WarmCorpus の検索方式
+        signature_filter: 引数の数で候補を絞り込むかどうか
+
+    Returns:
+        str: コードと条件のSHA-256
+    """
+    options = {
+        "quantized": bool(quantized),
+        "rerank": int(rerank),
+        "shards": int(shards),
+        "signature_filter": bool(signature_filter),
+    }
+    payload = json.dumps(
+        {"code": code, "top_n": top_n, "options": options}, sort_keys=True
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class QueryResultCache:
+    """検索結果の上限付きLRUキャッシュ。
+
+    Args:
+        max_entries: 保持する検索結果の最大数
+        persist: データベースにも保存し、次回以降の実行でも使うかどうか
+    """
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES, persist: bool = False):
+        self.max_entries = max_entries
+        self.persist = persist
+        self.hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Tuple[str, List[Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if persist:
+            create_database()
+
+    @staticmethod
+    def current_state() -> Optional[str]:
+        """現在のコーパスの状態を返します。検索の前に取得し、get と put に渡します。"""
+        return get_corpus_state()
+
+    def get(self, key: str, state: Optional[str]) -> Optional[List[Dict]]:
+        """キャッシュされた検索結果を返します。ない場合やコーパスが変わった場合はNone。"""
+        if state is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] != state:
+                # コーパスが変わったので古い結果をまとめて破棄する
+                self._entries = OrderedDict(
+                    (k, v) for k, v in self._entries.items() if v[0] == state
+                )
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return copy.deepcopy(entry[1])
+
+        candidates = get_cached_query(key, state) if self.persist else None
+        with self._lock:
+            if candidates is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, state, candidates)
+        return copy.deepcopy(candidates)
+
+    def put(self, key: str, state: Optional[str], candidates: List[Dict]) -> None:
+        """検索結果を、検索の前に取得したコーパスの状態とともに保存します。
+
+        検索中にコーパスが変わっても、古い状態のキーで保存されるため次回は使われません。
+        """
+        if state is None:
+            return
+        with self._lock:
+            self._remember(key, state, copy.deepcopy(candidates))
+        if self.persist:
+            save_cached_query(key, state, candidates, self.max_entries)
+
+    def _remember(self, key: str, state: str, candidates: List[Dict]) -> None:
+        self._entries[key] = (state, candidates)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._entries)
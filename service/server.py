@@ -0,0 +1,245 @@
+"""類似コード検索を常駐プロセスとして提供するHTTPサーバー。
+
+コーパスと検索インデックス、埋め込みクライアントを起動時に一度だけ用意し、
+localhost 上で埋め込み・検索・候補取得のリクエストを並行して処理します。
+同じコードの検索結果はコーパスが変わるまでキャッシュから返します。
+
+    python -m service.server --port 8765
+"""
+
+import argparse
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from database.code_repository import get_corpus_version
+from embedding.api_client import BedrockClient
+from embedding.preprocess import resolve_input_format
+from .corpus import WarmCorpus, compatible_code_ids, search_candidates
+from .query_cache import DEFAULT_MAX_ENTRIES, QueryResultCache, query_cache_key
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+
+
+class SimilarityRequestHandler(BaseHTTPRequestHandler):
+    """POST /search と GET /health を処理するリクエストハンドラ。"""
+
+    server_version = "SimilarityService/1.0"
+
+    def _send_json(self, status: int, body: dict) -> None:
+        payload = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path != "/health":
+            self._send_json(404, {"error": "not found"})
+            return
+        corpus = self.server.corpus
+        corpus.refresh()
+        self.server.refresh_input_format()
+        self._send_json(
+            200,
+            {
+                "status": "ok",
+                "corpus_version": corpus.version,
+                "codes": corpus.size,
+                "embedding_input": self.server.bedrock_client.input_format,
+                "tokens_saved": self.server.bedrock_client.tokens_saved,
+                "query_cache": {
+                    "entries": len(self.server.query_cache),
+                    "hits": self.server.query_cache.hits,
+                    "misses": self.server.query_cache.misses,
+                },
+            },
+        )
+
+    def do_POST(self):
+        if self.path != "/search":
+            self._send_json(404, {"error": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length))
+            code = request["code"]
+            top_n = int(request.get("top_n", 3))
+            signature_filter = bool(request.get("signature_filter", True))
+            default = self.server.corpus
+            quantized = bool(request.get("quantized", default.quantized))
+            rerank = int(request.get("rerank", default.rerank))
+            shards = int(request.get("shards", default.shards))
+        except (ValueError, KeyError, TypeError) as e:
+            self._send_json(400, {"error": f"invalid request: {e}"})
+            return
+
+        query_cache = self.server.query_cache
+        try:
+            corpus = self.server.get_corpus(quantized, rerank, shards)
+            cache_key = query_cache_key(
+                code,
+                top_n,
+                quantized=corpus.quantized,
+                rerank=corpus.rerank,
+                shards=corpus.shards,
+                signature_filter=signature_filter,
+            )
+            cache_state = query_cache.current_state()
+            candidates = query_cache.get(cache_key, cache_state)
+            cached = candidates is not None
+            if not cached:
+                candidates = self._search(corpus, code, top_n, signature_filter)
+                if candidates is not None:
+                    query_cache.put(cache_key, cache_state, candidates)
+        except Exception as e:
+            print(f"Error handling search request: {e}")
+            self._send_json(500, {"error": str(e)})
+            return
+
+        self._send_json(
+            200,
+            {
+                "corpus_version": corpus.version,
+                "candidates": candidates,
+                "cached": cached,
+            },
+        )
+
+    def _search(
+        self, corpus: WarmCorpus, code: str, top_n: int, signature_filter: bool
+    ):
+        allowed_ids = compatible_code_ids(code) if signature_filter else None
+        if allowed_ids is not None and not len(allowed_ids):
+            # 呼び出せる候補がなければ埋め込みも計算しない
+            return []
+        self.server.refresh_input_format()
+        code_embedding = self.server.bedrock_client.get_embedding(code)
+        return search_candidates(corpus, code_embedding, top_n, allowed_ids=allowed_ids)
+
+    def log_message(self, format, *args):
+        print(f"[{self.address_string()}] {format % args}")
+
+
+class SimilarityServer(ThreadingHTTPServer):
+    """検索方式ごとのコーパスを保持するHTTPサーバー。
+
+    起動時の設定のコーパスを最初に読み込み、リクエストで別の検索方式
+    （quantized, rerank, shards）が指定された場合はそのコーパスを初回に読み込みます。
+    """
+
+    daemon_threads = True
+
+    def __init__(self, address, quantized: bool, rerank: int, shards: int):
+        super().__init__(address, SimilarityRequestHandler)
+        self.corpus = WarmCorpus(quantized=quantized, rerank=rerank, shards=shards)
+        self._corpora = {(quantized, rerank, shards): self.corpus}
+        self._corpora_lock = threading.Lock()
+        self.bedrock_client = None
+        self._input_format_version = None
+
+    def refresh_input_format(self) -> None:
+        """コーパスの版数が変わっていれば、埋め込みの前処理の形式を読み込み直します。
+
+        埋め込み直し（embedding/preprocess.py の --reembed）で形式が変わった後も、
+        検索するコードをコーパスと同じ形式で埋め込むためです。
+        """
+        version = get_corpus_version()
+        if version is not None and version == self._input_format_version:
+            return
+        input_format = resolve_input_format()
+        if input_format != self.bedrock_client.input_format:
+            print(f"Embedding input format changed to {input_format}")
+            self.bedrock_client.input_format = input_format
+        self._input_format_version = version
+
+    def server_close(self) -> None:
+        super().server_close()
+        with self._corpora_lock:
+            for corpus in self._corpora.values():
+                corpus.close()
+
+    def get_corpus(self, quantized: bool, rerank: int, shards: int) -> WarmCorpus:
+        """検索方式に対応するコーパスを返します。"""
+        key = (quantized, rerank, shards)
+        with self._corpora_lock:
+            corpus = self._corpora.get(key)
+            if corpus is None:
+                corpus = WarmCorpus(quantized=quantized, rerank=rerank, shards=shards)
+                self._corpora[key] = corpus
+        return corpus
+
+
+def serve(
+    host: str = DEFAULT_HOST,
+    port: int = DEFAULT_PORT,
+    quantized: bool = False,
+    rerank: int = 200,
+    shards: int = 0,
+    query_cache_size: int = DEFAULT_MAX_ENTRIES,
+    persist_query_cache: bool = False,
+) -> None:
+    """コーパスを読み込んでからリクエストの受け付けを開始します。
+
+    persist_query_cache が True の場合は、検索結果のキャッシュをデータベースにも保存し、
+    再起動後やCLIのプロセス内検索と共有します。
+    """
+    server = SimilarityServer((host, port), quantized, rerank, shards)
+    server.bedrock_client = BedrockClient(resolve_input_format())
+    server.refresh_input_format()
+    server.query_cache = QueryResultCache(query_cache_size, persist=persist_query_cache)
+    server.corpus.refresh()
+
+    print(f"Similarity service listening on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="類似コード検索サービス")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument(
+        "--quantized",
+        action="store_true",
+        help="int8量子化ベクトルによる2段階検索を使う",
+    )
+    parser.add_argument(
+        "--rerank",
+        type=int,
+        default=200,
+        help="2段階検索で元の精度で再スコアリングする候補の数",
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=0,
+        help="埋め込みベクトルをN個のシャードに分割して並列に検索する",
+    )
+    parser.add_argument(
+        "--query-cache-size",
+        type=int,
+        default=DEFAULT_MAX_ENTRIES,
+        help="キャッシュする検索結果の最大数",
+    )
+    parser.add_argument(
+        "--persist-query-cache",
+        action="store_true",
+        help="検索結果のキャッシュをデータベースにも保存する",
+    )
+    args = parser.parse_args()
+    serve(
+        args.host,
+        args.port,
+        args.quantized,
+        args.rerank,
+        args.shards,
+        args.query_cache_size,
+        args.persist_query_cache,
+    )